@@ -38,6 +38,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'records.middleware.DoHFastPathMiddleware',  # Must stay ahead of sessions/CSRF/auth
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -126,3 +127,104 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DB = 0
+
+# DNS server tuning
+DNS_UDP_MAX_CONCURRENCY = 256  # Max UDP queries resolved in parallel
+DNS_TCP_MAX_CONNECTIONS = 1024  # Concurrent TCP connections per process
+DNS_TCP_IDLE_TIMEOUT = 10  # Seconds before an idle TCP connection is closed
+DNS_TCP_MAX_PIPELINE = 32  # Outstanding queries per TCP connection
+DNS_TCP_MAX_CONCURRENCY = 128  # Max TCP queries resolved in parallel
+
+# In-process L1 cache in front of Redis
+DNS_L1_CACHE_MAX_ENTRIES = 4096  # 0 disables the L1 cache
+DNS_L1_CACHE_MAX_TTL = 60  # Upper bound (seconds) on how long an entry is kept locally
+
+# 'records' caches parsed RRsets; 'wire' caches raw upstream packets and
+# serves hits by rewriting the transaction ID and TTLs
+DNS_CACHE_MODE = 'records'
+
+# Seconds between checks for manual record changes made by other processes
+DNS_MANUAL_RECORDS_RECHECK_INTERVAL = 1.0
+
+# Upstream forwarding
+DNS_UPSTREAM_SOCKETS_PER_SERVER = 4  # Long-lived UDP sockets kept per upstream
+DNS_UPSTREAM_TIMEOUT = 2.0  # Seconds to wait for each upstream
+DNS_UPSTREAM_RACE = False  # Send each miss to the two fastest upstreams at once
+DNS_UPSTREAM_EXPLORE_RATIO = 0.05  # Share of queries that try upstreams in random order
+# Replace each upstream socket (fresh source port) after this many queries or seconds
+DNS_UPSTREAM_SOCKET_MAX_QUERIES = 1000
+DNS_UPSTREAM_SOCKET_MAX_AGE = 60.0
+# Send query names in random case and require replies to echo it (DNS 0x20)
+DNS_UPSTREAM_RANDOMIZE_CASE = True
+
+# Coalesce identical cache misses across processes with a short Redis lock
+DNS_SINGLEFLIGHT_REDIS_LOCK = False
+DNS_SINGLEFLIGHT_LOCK_TTL = 3.0  # Seconds; also how long other processes wait
+
+# Refresh-ahead prefetching of popular cache entries
+DNS_PREFETCH_ENABLED = True
+DNS_PREFETCH_THRESHOLD = 0.1  # Refresh when served in the last 10% of the TTL
+DNS_PREFETCH_MIN_HITS = 5  # Hits within the window before an entry counts as popular
+DNS_PREFETCH_WINDOW = 300  # Seconds over which hits are counted
+DNS_PREFETCH_MAX_PER_SECOND = 20.0  # Background refreshes started per second
+DNS_PREFETCH_WORKERS = 4
+
+# Serve-stale (RFC 8767): keep expired entries and answer with them when
+# upstreams are slow or unreachable
+DNS_SERVE_STALE_WINDOW = 86400  # Seconds expired data is kept; 0 disables
+DNS_SERVE_STALE_CLIENT_TIMEOUT = 1.8  # Seconds to wait for upstream before serving stale
+DNS_SERVE_STALE_TTL = 30  # TTL of answers served from stale data
+DNS_SERVE_STALE_WORKERS = 8  # Threads retrying unanswered refreshes in the background
+DNS_SERVE_STALE_QUEUE_SIZE = 256  # Refreshes queued or running at most; more are dropped
+
+# Negative caching (RFC 2308): NXDOMAIN/NODATA answers are cached for
+# min(SOA TTL, SOA MINIMUM) seconds, capped here
+DNS_NEGATIVE_CACHE_MAX_TTL = 3600
+
+# EDNS0: UDP payload size advertised to clients and upstreams (0 disables EDNS)
+DNS_EDNS_UDP_PAYLOAD = 1232
+
+# Batch DNS-JSON endpoint (dns-query/batch): most questions per request,
+# threads resolving cache misses concurrently (WSGI; ASGI uses the event loop)
+# and seconds a batch waits for upstream before the rest are answered SERVFAIL
+DNS_BATCH_MAX_QUERIES = 1000
+DNS_BATCH_WORKERS = 16
+DNS_BATCH_TIMEOUT = 5
+
+# Logging pipeline (dns_core.logger): records are queued without blocking and
+# written in batches by a background thread; when the queue is full they are
+# dropped and counted. Files rotate past DNS_LOG_MAX_BYTES (0 = never) and on
+# DNS_LOG_ROTATE_INTERVAL second boundaries (0 = never). DNS_LOG_JSON writes
+# one JSON object per line.
+DNS_LOG_QUEUE_ENABLED = True
+DNS_LOG_QUEUE_SIZE = 10000
+DNS_LOG_BATCH_SIZE = 256
+DNS_LOG_MAX_BYTES = 100 * 1024 * 1024
+DNS_LOG_BACKUP_COUNT = 5
+DNS_LOG_ROTATE_INTERVAL = 0
+DNS_LOG_JSON = False
+
+# Query log volume: fraction of queries written to dns_queries.log one line
+# each (NXDOMAIN and errors are always written), and optional per-interval
+# summary lines counting queries by domain/type/source/status/cache
+DNS_QUERY_LOG_SAMPLE_RATE = 1.0
+DNS_QUERY_LOG_AGGREGATE = False
+DNS_QUERY_LOG_AGGREGATE_INTERVAL = 60
+DNS_QUERY_LOG_AGGREGATE_MAX_KEYS = 2000
+
+# Metrics (/metrics, Prometheus text format): each process pushes its counter
+# and histogram changes to Redis every DNS_METRICS_PUSH_INTERVAL seconds
+DNS_METRICS_ENABLED = True
+DNS_METRICS_PUSH_INTERVAL = 10
+DNS_METRICS_SCRAPE_PUSH_INTERVAL = 1.0  # A scrape also pushes, at most this often per process
+
+# Tracing: queries slower than this many milliseconds are written to
+# slow_queries.log with their per-stage timings (0 disables tracing)
+DNS_SLOW_QUERY_MS = 500
+
+# On-demand profiler (POST /api/v1/admin/profile): every process checks for
+# a profiling request every DNS_PROFILE_POLL_INTERVAL seconds and samples its
+# thread stacks every DNS_PROFILE_SAMPLE_INTERVAL seconds into logs/profiles/
+DNS_PROFILE_ENABLED = True
+DNS_PROFILE_POLL_INTERVAL = 5
+DNS_PROFILE_SAMPLE_INTERVAL = 0.01
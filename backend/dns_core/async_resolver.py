@@ -0,0 +1,303 @@
+"""
+Asynchronous resolver for the DoH endpoint when served over ASGI.
+Cache hits are answered without leaving the event loop (L1 cache, then
+redis.asyncio) and misses are forwarded with the async upstream client, so a
+worker process can have thousands of DoH queries in flight. Answers, caching
+and logging match resolver.py, whose helpers are shared.
+"""
+import asyncio
+import struct
+import time
+from django.conf import settings
+from .packet import (
+    parse_qname, build_response, RR_TYPE_MAP, TYPE_CODE, build_query,
+    patch_cached_response, set_edns_payload, strip_opt_record
+)
+from .records import UPSTREAM_SERVERS
+from .redis_cache import (
+    get_cached_records_async,
+    get_cached_records_any_async,
+    get_stale_records_async,
+    get_cached_response_async,
+    get_negative_entry_async,
+    get_cached_batch_async,
+    get_stale_window,
+    get_cache_mode,
+    cached_response_ttl,
+    normalize_domain
+)
+from .manual_records import get_manual_records_async
+from .upstream import get_async_upstream_client
+from .resolver import (
+    _cached_answers, _records_lifetime, _maybe_prefetch, _negative_answer, _question_section,
+    _stale_from_records, _stale_from_wire, _json_from_records, _json_from_wire, _json_from_negative,
+    _json_from_upstream, _json_servfail, _query_status, cache_upstream
+)
+from .logger import log_dns_query
+from .metrics import timed
+from .tracing import traced, annotate
+
+# Upstream queries in flight on this process's event loop, by (qname, qtype, qclass)
+_upstream_flights = {}
+
+# Queries that joined a flight instead of querying upstream (SingleFlight.coalesced)
+_coalesced_flights = 0
+
+@traced
+async def resolve_dns_async(data, client_ip=None, source='binary'):
+    """resolve_dns for asyncio code"""
+    transaction_id = data[:2]
+    with timed('parse'):
+        domain, offset = parse_qname(data, 12)
+        qtype, qclass = struct.unpack("!HH", data[offset:offset + 4])
+    question_section = data[12:offset + 4]
+    qtype_name = RR_TYPE_MAP.get(qtype, str(qtype))
+    annotate(domain=domain, type=qtype_name, source=source)
+    wire_mode = get_cache_mode() == 'wire'
+
+    cached_records = []
+    with timed('cache'):
+        if wire_mode:
+            pass  # Whole responses are cached; checked after manual records
+        elif qtype_name == "ANY":
+            cached_records = await get_cached_records_any_async(domain)
+        else:
+            cached_records = await get_cached_records_async(domain, qtype_name)
+
+    if cached_records:
+        _maybe_prefetch(domain, qtype, qclass, qtype_name, wire_mode,
+                        *_records_lifetime(cached_records))
+
+    answers = _cached_answers(cached_records)
+    with timed('manual'):
+        answers.extend(await get_manual_records_async(domain, qtype_name))
+
+    if answers:
+        with timed('build'):
+            response = build_response(transaction_id, question_section, answers)
+        log_dns_query(domain, qtype_name, source=source, status='success',
+                     answer_count=len(answers), from_cache=True, client_ip=client_ip)
+        return response
+
+    if wire_mode:
+        with timed('cache'):
+            cached = await get_cached_response_async(domain, qtype, qclass)
+        if cached:
+            stored_at, ttl_offsets, packet = cached
+            elapsed = int(time.time() - stored_at)
+            with timed('build'):
+                response = patch_cached_response(
+                    packet, ttl_offsets, elapsed, transaction_id, question_section
+                )
+            ttl = cached_response_ttl(packet, ttl_offsets)
+            _maybe_prefetch(domain, qtype, qclass, qtype_name, wire_mode, ttl - elapsed, ttl)
+            log_dns_query(domain, qtype_name, source=source,
+                         status='nxdomain' if response[3] & 0x0F == 3 else 'success',
+                         answer_count=struct.unpack_from("!H", response, 6)[0],
+                         from_cache=True, client_ip=client_ip)
+            return response
+    else:
+        with timed('cache'):
+            negative = await get_negative_entry_async(domain, qtype_name)
+        if negative:
+            rcode, authority = _negative_answer(negative)
+            log_dns_query(domain, qtype_name, source=source,
+                         status='nxdomain' if rcode == 3 else 'success',
+                         answer_count=0, from_cache=True, client_ip=client_ip)
+            return build_response(transaction_id, question_section, [], rcode=rcode,
+                                  authority=authority)
+
+    with timed('upstream'):
+        response, stale = await resolve_miss_async(data, domain, qtype, qclass, qtype_name,
+                                                   wire_mode)
+    if response:
+        log_dns_query(domain, qtype_name, source=source,
+                     status=_query_status(response[3] & 0x0F, stale),
+                     answer_count=struct.unpack_from("!H", response, 6)[0],
+                     from_cache=stale, client_ip=client_ip)
+        return response
+
+    log_dns_query(domain, qtype_name, source=source, status='nxdomain',
+                 answer_count=0, from_cache=False, client_ip=client_ip)
+    return build_response(transaction_id, question_section, [], rcode=3)
+
+
+@traced
+async def resolve_dns_json_async(domain, qtype_name, client_ip=None):
+    """resolve_dns_json for asyncio code"""
+    if not domain.endswith("."):
+        domain = domain + "."
+    annotate(domain=domain, type=qtype_name)
+    qtype = TYPE_CODE[qtype_name]
+    wire_mode = get_cache_mode() == 'wire'
+
+    cached_records = []
+    with timed('cache'):
+        if wire_mode:
+            pass  # Whole responses are cached; checked after manual records
+        elif qtype_name == "ANY":
+            cached_records = await get_cached_records_any_async(domain)
+        else:
+            cached_records = await get_cached_records_async(domain, qtype_name)
+
+    with timed('manual'):
+        manual_records = await get_manual_records_async(domain, qtype_name)
+    result = _json_from_records(domain, qtype, qtype_name, wire_mode, cached_records,
+                                manual_records, client_ip)
+    if result:
+        return result
+
+    with timed('cache'):
+        if wire_mode:
+            cached = await get_cached_response_async(domain, qtype)
+        else:
+            negative = await get_negative_entry_async(domain, qtype_name)
+    if wire_mode:
+        result = _json_from_wire(domain, qtype, qtype_name, cached, client_ip)
+    else:
+        result = _json_from_negative(domain, qtype_name, negative, client_ip)
+    if result:
+        return result
+
+    _, query = build_query(domain, qtype_name)
+    with timed('upstream'):
+        response, stale = await resolve_miss_async(query, domain, qtype, 1, qtype_name, wire_mode)
+    return _json_from_upstream(domain, qtype_name, response, stale, client_ip)
+
+
+@traced
+async def resolve_dns_json_batch_async(questions, client_ip=None):
+    """resolve_dns_json_batch for asyncio code"""
+    questions = [(domain if domain.endswith(".") else domain + ".", qtype_name)
+                 for domain, qtype_name in questions]
+    wire_mode = get_cache_mode() == 'wire'
+    unique = list(dict.fromkeys(questions))
+    annotate(questions=len(questions))
+    batched = [question for question in unique if question[1] != "ANY"]
+    with timed('cache'):
+        cached = dict(zip(batched, await get_cached_batch_async(batched, wire_mode)))
+
+    results = {}
+    misses = []
+    for domain, qtype_name in unique:
+        qtype = TYPE_CODE[qtype_name]
+        if qtype_name == "ANY":
+            cached_records, negative, wire = await get_cached_records_any_async(domain), None, None
+        else:
+            cached_records, negative, wire = cached[(domain, qtype_name)]
+        result = (
+            _json_from_records(domain, qtype, qtype_name, wire_mode, cached_records,
+                               await get_manual_records_async(domain, qtype_name), client_ip)
+            or _json_from_wire(domain, qtype, qtype_name, wire, client_ip)
+            or _json_from_negative(domain, qtype_name, negative, client_ip)
+        )
+        if result:
+            results[(domain, qtype_name)] = result
+        else:
+            misses.append((domain, qtype_name))
+
+    tasks = [
+        asyncio.ensure_future(_resolve_json_miss_async(domain, qtype_name, wire_mode))
+        for domain, qtype_name in misses
+    ]
+    if tasks:
+        # Misses still unresolved at the deadline keep running and fill the cache
+        await asyncio.wait(tasks, timeout=getattr(settings, 'DNS_BATCH_TIMEOUT', 5))
+    for (domain, qtype_name), task in zip(misses, tasks):
+        if not task.done():
+            results[(domain, qtype_name)] = _json_servfail(domain, qtype_name, client_ip)
+            continue
+        response, stale = task.result()
+        results[(domain, qtype_name)] = _json_from_upstream(
+            domain, qtype_name, response, stale, client_ip
+        )
+    return [results[question] for question in questions]
+
+
+async def _resolve_json_miss_async(domain, qtype_name, wire_mode):
+    _, query = build_query(domain, qtype_name)
+    try:
+        with timed('upstream'):
+            return await resolve_miss_async(query, domain, TYPE_CODE[qtype_name], 1, qtype_name,
+                                            wire_mode)
+    except Exception:
+        return None, False
+
+
+async def resolve_miss_async(data, domain, qtype, qclass, qtype_name, wire_mode):
+    """resolve_miss for asyncio code: upstream first, stale data if it is too slow"""
+    stale = await _stale_response_async(data, domain, qtype, qclass, qtype_name, wire_mode)
+    if stale is None:
+        return await resolve_upstream_async(data, domain, qtype, qclass, qtype_name, wire_mode), False
+
+    # The refresh keeps running after the deadline and fills the cache
+    refresh = asyncio.ensure_future(
+        resolve_upstream_async(data, domain, qtype, qclass, qtype_name, wire_mode)
+    )
+    try:
+        response = await asyncio.wait_for(
+            asyncio.shield(refresh), getattr(settings, 'DNS_SERVE_STALE_CLIENT_TIMEOUT', 1.8)
+        )
+    except asyncio.TimeoutError:
+        return stale, True
+    except Exception:
+        response = None
+    if not response or struct.unpack("!H", response[2:4])[0] & 0x000F in (2, 5):
+        return stale, True
+    return response, False
+
+async def _stale_response_async(data, domain, qtype, qclass, qtype_name, wire_mode):
+    if not get_stale_window():
+        return None
+    if wire_mode:
+        cached = await get_cached_response_async(domain, qtype, qclass, include_stale=True)
+        return _stale_from_wire(data, cached)
+    if qtype_name == "ANY":
+        return None
+    return _stale_from_records(data, await get_stale_records_async(domain, qtype_name))
+
+async def resolve_upstream_async(data, domain, qtype, qclass, qtype_name, wire_mode):
+    """
+    Forward a query upstream and cache the reply; concurrent misses for the
+    same question on this event loop share one upstream query.
+    (DNS_SINGLEFLIGHT_REDIS_LOCK is not used on the async path.)
+    """
+    global _coalesced_flights
+    key = (normalize_domain(domain), qtype, qclass)
+    flight = _upstream_flights.get(key)
+    if flight is not None:
+        _coalesced_flights += 1
+        response = await asyncio.shield(flight)
+        if response:
+            response = patch_cached_response(response, (), 0, data[:2], _question_section(data))
+        return response
+
+    flight = _upstream_flights[key] = asyncio.get_running_loop().create_future()
+    response = None
+    try:
+        with timed('forward'):
+            response = await forward_to_upstream_async(data)
+        if response:
+            # Cache writes use the blocking client, off the event loop
+            with timed('cache_write'):
+                await asyncio.get_running_loop().run_in_executor(
+                    None, cache_upstream, domain, qtype, qclass, qtype_name, wire_mode, response
+                )
+        return response
+    finally:
+        del _upstream_flights[key]
+        flight.set_result(response)
+
+async def forward_to_upstream_async(data):
+    """forward_to_upstream for asyncio code"""
+    try:
+        udp_payload = getattr(settings, 'DNS_EDNS_UDP_PAYLOAD', 1232)
+        if udp_payload:
+            data = set_edns_payload(data, udp_payload)
+        client = get_async_upstream_client(UPSTREAM_SERVERS)
+        response = await client.query(data)
+        if response and response[2] & 0x02:
+            response = await client.query_tcp(data) or response
+        return strip_opt_record(response) if response else None
+    except Exception:
+        return None
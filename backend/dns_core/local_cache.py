@@ -0,0 +1,93 @@
+"""
+In-process L1 cache for DNS records.
+A bounded TTL/LRU cache that sits in front of Redis so the hottest names are
+answered without any network I/O.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+class LocalCache:
+    """
+    Thread-safe LRU cache whose entries also expire after their TTL.
+
+    Entries are kept for at most max_ttl seconds regardless of the record TTL,
+    which bounds how long a process can serve data that another process has
+    already replaced in Redis.
+    """
+
+    def __init__(self, max_entries=4096, max_ttl=60):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value or None if missing/expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        """Store a value for min(ttl, max_ttl) seconds, evicting the LRU entry if full"""
+        if self.max_entries <= 0:
+            return
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+_local_cache = None
+
+def get_local_cache():
+    """Get or create the process-wide L1 cache"""
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LocalCache(
+            max_entries=getattr(settings, 'DNS_L1_CACHE_MAX_ENTRIES', 4096),
+            max_ttl=getattr(settings, 'DNS_L1_CACHE_MAX_TTL', 60),
+        )
+    return _local_cache
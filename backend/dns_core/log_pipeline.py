@@ -0,0 +1,222 @@
+"""
+Non-blocking logging pipeline.
+Loggers hand records to a bounded in-memory queue and a single background
+thread formats and writes them in batches, so a slow disk never shows up as
+DNS latency. When the queue is full records are dropped and counted instead
+of blocking the caller.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks: records that do not fit in the queue are
+    counted in `dropped`. Records are queued as they are, so the message is
+    only formatted on the writer thread (log calls must pass immutable args).
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Writer thread of the pipeline. Takes up to batch_size records per wakeup,
+    hands each to the handler registered for its logger name and flushes the
+    handlers once per batch. Drops reported by `source` are written to the
+    `drop_logger` handler as a warning.
+    """
+
+    def __init__(self, queue, routes, source=None, batch_size=256, drop_logger=None):
+        super().__init__(queue, *dict.fromkeys(routes.values()))
+        self.routes = routes
+        self.source = source
+        self.batch_size = batch_size
+        self.drop_logger = drop_logger
+        self._reported_drops = 0
+
+    def handle(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+    def enqueue_sentinel(self):
+        # Unlike put_nowait, this waits for room when the queue is full
+        self.queue.put(self._sentinel, timeout=5)
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size and batch[-1] is not self._sentinel:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is not self._sentinel:
+                    self.handle(record)
+                q.task_done()
+            self._report_drops()
+            for handler in self.handlers:
+                handler.flush()
+            if batch[-1] is self._sentinel:
+                return
+
+    def _report_drops(self):
+        dropped = self.source.dropped if self.source is not None else 0
+        if dropped == self._reported_drops or self.drop_logger not in self.routes:
+            return
+        self.handle(logging.makeLogRecord({
+            'name': self.drop_logger,
+            'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': 'Log queue full, dropped %d records',
+            'args': (dropped - self._reported_drops,),
+        }))
+        self._reported_drops = dropped
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    File handler for the writer thread: records are written without a flush
+    each, and flush() (once per batch) also rotates the file when it has grown
+    past max_bytes or an `interval` seconds boundary has passed.
+
+    Interval boundaries are aligned to the epoch, so worker processes sharing
+    a file rotate it together; a process that finds the file already rotated
+    by another one just reopens it.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, interval=0, autoflush=False):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.autoflush = autoflush
+        self.rollover_at = self._next_rollover(time.time())
+
+    def _next_rollover(self, now):
+        if not self.interval:
+            return None
+        return (now // self.interval + 1) * self.interval
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+            return
+        if self.autoflush:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream is None:
+                return
+            self.stream.flush()
+            now = time.time()
+            if ((self.maxBytes and self.stream.tell() >= self.maxBytes)
+                    or (self.rollover_at is not None and now >= self.rollover_at)):
+                self._rotate(now)
+        except OSError:
+            pass
+        finally:
+            self.release()
+
+    def _rotate(self, now):
+        self.rollover_at = self._next_rollover(now)
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except OSError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+        else:
+            self.doRollover()
+
+
+class JSONLineFormatter(logging.Formatter):
+    """Formats each record as one compact JSON object"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), ensure_ascii=False)
+
+
+class LogPipeline:
+    """
+    One queue and writer thread shared by several loggers, each written to
+    its own handler. Restarted in child processes after a fork.
+    """
+
+    def __init__(self, queue_size=10000, batch_size=256, drop_logger=None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.drop_logger = drop_logger
+        self.routes = {}
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.listener = None
+
+    def add(self, logger, handler):
+        """Send a logger's records through the pipeline to handler"""
+        self.routes[logger.name] = handler
+        logger.addHandler(self.handler)
+
+    def start(self):
+        self.listener = BatchQueueListener(
+            self.handler.queue, self.routes, source=self.handler,
+            batch_size=self.batch_size, drop_logger=self.drop_logger
+        )
+        self.listener.start()
+
+    def stop(self):
+        """Write out everything queued and stop the writer thread"""
+        if self.listener is not None and self.listener._thread is not None:
+            try:
+                self.listener.stop()
+            except queue.Full:
+                pass
+
+    def restart_after_fork(self):
+        # The writer thread does not survive a fork and the queue's locks may
+        # have been held by it, so the child gets a fresh queue and thread
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.handler.dropped = 0
+        self.start()
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'queue_size': self.queue_size,
+            'dropped': self.handler.dropped,
+        }
@@ -1,11 +1,18 @@
 """
 DNS System Logger
-Logs all DNS queries, API requests, and admin actions
+Logs all DNS queries, API requests, and admin actions.
+Records are queued and written by a background thread (see log_pipeline).
 """
+import atexit
 import logging
+import os
+import random
 from pathlib import Path
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from .log_pipeline import LogPipeline, BatchRotatingFileHandler, JSONLineFormatter
+from .query_log import QueryAggregator
+from . import metrics
 
 # Create logs directory if it doesn't exist
 try:
@@ -19,74 +26,161 @@ LOGS_DIR.mkdir(exist_ok=True)
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
+
+def _setting(name, default):
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
+
+
+# Records are queued and written by one background thread (see log_pipeline)
+_pipeline = None
+if _setting('DNS_LOG_QUEUE_ENABLED', True):
+    _pipeline = LogPipeline(
+        queue_size=_setting('DNS_LOG_QUEUE_SIZE', 10000),
+        batch_size=_setting('DNS_LOG_BATCH_SIZE', 256),
+        drop_logger='dns.system',
+    )
+
+
+def _configure_logger(name, filename):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if logger.handlers:
+        return logger
+    handler = BatchRotatingFileHandler(
+        LOGS_DIR / filename,
+        max_bytes=_setting('DNS_LOG_MAX_BYTES', 0),
+        backup_count=_setting('DNS_LOG_BACKUP_COUNT', 5),
+        interval=_setting('DNS_LOG_ROTATE_INTERVAL', 0),
+        autoflush=_pipeline is None,
+    )
+    if _setting('DNS_LOG_JSON', False):
+        handler.setFormatter(JSONLineFormatter(datefmt=DATE_FORMAT))
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+    if _pipeline is not None:
+        _pipeline.add(logger, handler)
+    else:
+        logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+
 # DNS Query Logger
-dns_logger = logging.getLogger('dns.queries')
-dns_logger.setLevel(logging.INFO)
-if not dns_logger.handlers:
-    dns_handler = logging.FileHandler(LOGS_DIR / 'dns_queries.log')
-    dns_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-    dns_logger.addHandler(dns_handler)
-    dns_logger.propagate = False
+dns_logger = _configure_logger('dns.queries', 'dns_queries.log')
 
 # API Request Logger
-api_logger = logging.getLogger('dns.api')
-api_logger.setLevel(logging.INFO)
-if not api_logger.handlers:
-    api_handler = logging.FileHandler(LOGS_DIR / 'api_requests.log')
-    api_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-    api_logger.addHandler(api_handler)
-    api_logger.propagate = False
+api_logger = _configure_logger('dns.api', 'api_requests.log')
 
 # Admin Action Logger
-admin_logger = logging.getLogger('dns.admin')
-admin_logger.setLevel(logging.INFO)
-if not admin_logger.handlers:
-    admin_handler = logging.FileHandler(LOGS_DIR / 'admin_actions.log')
-    admin_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-    admin_logger.addHandler(admin_handler)
-    admin_logger.propagate = False
+admin_logger = _configure_logger('dns.admin', 'admin_actions.log')
 
 # Web UI Logger
-web_logger = logging.getLogger('dns.web')
-web_logger.setLevel(logging.INFO)
-if not web_logger.handlers:
-    web_handler = logging.FileHandler(LOGS_DIR / 'web_ui.log')
-    web_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-    web_logger.addHandler(web_handler)
-    web_logger.propagate = False
+web_logger = _configure_logger('dns.web', 'web_ui.log')
 
 # General System Logger
-system_logger = logging.getLogger('dns.system')
-system_logger.setLevel(logging.INFO)
-if not system_logger.handlers:
-    system_handler = logging.FileHandler(LOGS_DIR / 'system.log')
-    system_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-    system_logger.addHandler(system_handler)
-    system_logger.propagate = False
+system_logger = _configure_logger('dns.system', 'system.log')
+
+# Slow Query Logger (DNS_SLOW_QUERY_MS)
+slow_logger = _configure_logger('dns.slow', 'slow_queries.log')
+
+if _pipeline is not None and _pipeline.routes:
+    _pipeline.start()
+    atexit.register(_pipeline.stop)
+    os.register_at_fork(after_in_child=_pipeline.restart_after_fork)
+
+
+# Query log volume: DNS_QUERY_LOG_SAMPLE_RATE is the fraction of queries
+# logged individually (NXDOMAIN and errors always are); with
+# DNS_QUERY_LOG_AGGREGATE, per-interval counts are written as summary lines
+QUERY_LOG_SAMPLE_RATE = _setting('DNS_QUERY_LOG_SAMPLE_RATE', 1.0)
+QUERY_LOG_ALWAYS = frozenset({'nxdomain', 'error'})
+
+
+def _write_query_summary(counts, overflow, interval):
+    # Busiest keys first, in case the log queue cannot take them all
+    for (domain, record_type, source, status, from_cache), count in sorted(
+            counts.items(), key=lambda item: item[1], reverse=True):
+        dns_logger.info(
+            "DNS Query Summary | Domain: %s | Type: %s | Source: %s | Status: %s | "
+            "Source: %s | Count: %d | Interval: %ds",
+            domain, record_type, source, status,
+            'CACHED' if from_cache else 'UPSTREAM', count, interval
+        )
+    if overflow:
+        dns_logger.info("DNS Query Summary | Other keys: %d queries | Interval: %ds",
+                        overflow, interval)
+
+
+_query_aggregator = None
+if _setting('DNS_QUERY_LOG_AGGREGATE', False):
+    _query_aggregator = QueryAggregator(
+        _write_query_summary,
+        interval=_setting('DNS_QUERY_LOG_AGGREGATE_INTERVAL', 60),
+        max_keys=_setting('DNS_QUERY_LOG_AGGREGATE_MAX_KEYS', 2000),
+    )
+    # Registered after the pipeline, so the last summary is written before it stops
+    atexit.register(_query_aggregator.stop)
+    os.register_at_fork(after_in_child=_query_aggregator.reset_after_fork)
+
+
+def stop_logging():
+    """Write out queued records and stop the writer thread (for processes exiting without atexit)"""
+    if _query_aggregator is not None:
+        _query_aggregator.stop()
+    if _pipeline is not None:
+        _pipeline.stop()
+
+
+def get_log_stats():
+    """Queue depth and dropped record count of the logging pipeline (empty if disabled)"""
+    return _pipeline.stats() if _pipeline is not None else {}
+
+
+# Metrics transport label of each query log source (DoH answers log 'binary' or 'doh-json')
+_TRANSPORTS = {'binary': 'doh', 'doh-json': 'doh'}
 
 
 def log_dns_query(domain, record_type, source='unknown', status='success', 
                   answer_count=0, from_cache=False, client_ip=None):
-    """Log a DNS query"""
-    cache_status = 'CACHED' if from_cache else 'UPSTREAM'
-    log_msg = (
-        f"DNS Query | Domain: {domain} | Type: {record_type} | "
-        f"Source: {source} | Status: {status} | Answers: {answer_count} | "
-        f"Source: {cache_status} | Client: {client_ip or 'N/A'}"
+    """Log a DNS query (sampled and/or aggregated, see DNS_QUERY_LOG_SAMPLE_RATE)"""
+    with metrics.timed('log'):
+        metrics.inc('dns_queries_total', transport=_TRANSPORTS.get(source, source), status=status,
+                    cache='hit' if from_cache else 'miss')
+        if _query_aggregator is not None:
+            _query_aggregator.add((domain, record_type, source, status, from_cache))
+        if (QUERY_LOG_SAMPLE_RATE < 1.0 and status not in QUERY_LOG_ALWAYS
+                and random.random() >= QUERY_LOG_SAMPLE_RATE):
+            return
+        # Formatted lazily, on the log writer thread
+        dns_logger.info(
+            "DNS Query | Domain: %s | Type: %s | Source: %s | Status: %s | Answers: %s | "
+            "Source: %s | Client: %s",
+            domain, record_type, source, status, answer_count,
+            'CACHED' if from_cache else 'UPSTREAM', client_ip or 'N/A'
+        )
+
+
+def log_slow_query(name, elapsed, spans, details):
+    """Log a query slower than DNS_SLOW_QUERY_MS with its per-stage breakdown"""
+    slow_logger.warning(
+        "Slow Query | %s | %s | Total: %.2fms | %s",
+        name, ' | '.join(f"{key}: {value}" for key, value in details.items()),
+        elapsed * 1000, ' '.join(f"{stage}={seconds * 1000:.2f}ms" for stage, seconds in spans)
     )
-    dns_logger.info(log_msg)
 
 
 def log_api_request(method, endpoint, user=None, status_code=200, 
                     response_time=None, client_ip=None):
     """Log an API request"""
     username = user.username if user and hasattr(user, 'username') else 'anonymous'
-    log_msg = (
-        f"API Request | Method: {method} | Endpoint: {endpoint} | "
-        f"User: {username} | Status: {status_code} | "
-        f"Response Time: {response_time or 'N/A'}ms | Client: {client_ip or 'N/A'}"
+    api_logger.info(
+        "API Request | Method: %s | Endpoint: %s | User: %s | Status: %s | "
+        "Response Time: %sms | Client: %s",
+        method, endpoint, username, status_code, response_time or 'N/A', client_ip or 'N/A'
     )
-    api_logger.info(log_msg)
 
 
 def log_admin_action(action, user, resource_type, resource_id=None, 
@@ -2,6 +2,7 @@
 Run UDP/TCP DNS servers and the HTTPS DoH server in one command.
 """
 import os
+import signal
 import sys
 import subprocess
 import threading
@@ -11,6 +12,7 @@ from django.core.management.base import BaseCommand
 
 from dns_core.tcp_server import start_tcp_server
 from dns_core.udp_server import start_udp_server
+from dns_core.workers import DNSWorkerPool
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent
 CERT_DIR = BASE_DIR / 'certs'
@@ -52,6 +54,17 @@ class Command(BaseCommand):
             default=120,
             help='Gunicorn worker timeout in seconds (default: 120)'
         )
+        parser.add_argument(
+            '--asgi',
+            action='store_true',
+            help='Serve DoH from async uvicorn workers (ASGI) instead of sync workers'
+        )
+        parser.add_argument(
+            '--dns-workers',
+            type=int,
+            default=0,
+            help='Run DNS in N SO_REUSEPORT worker processes instead of threads (default: 0)'
+        )
 
     def handle(self, *args, **options):
         bind_address = options['bind']
@@ -59,6 +72,8 @@ class Command(BaseCommand):
         cert_file = options['cert']
         key_file = options['key']
         timeout = options['timeout']
+        dns_workers = options['dns_workers']
+        use_asgi = options['asgi']
 
         if not os.path.exists(cert_file) or not os.path.exists(key_file):
             self.stdout.write(
@@ -86,26 +101,50 @@ class Command(BaseCommand):
             )
             sys.exit(1)
 
-        udp_thread = threading.Thread(target=start_udp_server, daemon=True)
-        tcp_thread = threading.Thread(target=start_tcp_server, daemon=True)
-        udp_thread.start()
-        tcp_thread.start()
+        if use_asgi:
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                self.stdout.write(
+                    self.style.ERROR(
+                        f'\n❌ Uvicorn is not installed (needed for --asgi)!\n\n'
+                        f'Please install it:\n'
+                        f'   pip install uvicorn\n'
+                    )
+                )
+                sys.exit(1)
+
+        pool = None
+        if dns_workers > 0:
+            # Fork the workers before starting any threads in this process
+            pool = DNSWorkerPool(dns_workers)
+            pool.start()
+            threading.Thread(target=pool.supervise, daemon=True).start()
+            # On SIGTERM, unwind to the finally below so the workers are stopped too
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            dns_mode = f'{dns_workers} worker processes'
+        else:
+            udp_thread = threading.Thread(target=start_udp_server, daemon=True)
+            tcp_thread = threading.Thread(target=start_tcp_server, daemon=True)
+            udp_thread.start()
+            tcp_thread.start()
+            dns_mode = 'threads'
 
         self.stdout.write(
             self.style.SUCCESS(
-                f'\n✅ UDP/TCP DNS servers started on port 8053\n'
+                f'\n✅ UDP/TCP DNS servers started on port 8053 ({dns_mode})\n'
                 f'✅ Starting HTTPS DoH server at https://{bind_address}\n'
                 f'   Certificate: {cert_file}\n'
                 f'   Key: {key_file}\n'
-                f'   Workers: {workers}\n'
+                f'   Workers: {workers} ({"ASGI/uvicorn" if use_asgi else "sync"})\n'
                 f'   ⚠️  Using self-signed certificate - browser will show security warning\n\n'
             )
         )
 
-        wsgi_module = 'backend.wsgi:application'
+        app_module = 'backend.asgi:application' if use_asgi else 'backend.wsgi:application'
         cmd = [
             'gunicorn',
-            wsgi_module,
+            app_module,
             '--bind', bind_address,
             '--keyfile', key_file,
             '--certfile', cert_file,
@@ -115,6 +154,8 @@ class Command(BaseCommand):
             '--error-logfile', '-',
             '--log-level', 'info',
         ]
+        if use_asgi:
+            cmd += ['--worker-class', 'uvicorn.workers.UvicornWorker']
 
         try:
             subprocess.run(cmd, check=True)
@@ -125,3 +166,6 @@ class Command(BaseCommand):
                 self.style.ERROR(f'\n❌ Gunicorn failed to start: {e}\n')
             )
             sys.exit(1)
+        finally:
+            if pool is not None:
+                pool.stop()
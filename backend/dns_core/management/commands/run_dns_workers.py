@@ -0,0 +1,56 @@
+"""
+Run the UDP/TCP DNS servers in several SO_REUSEPORT worker processes.
+"""
+import os
+
+from django.core.management.base import BaseCommand
+
+from dns_core.udp_server import DNS_PORT
+from dns_core.workers import DNSWorkerPool
+
+
+class Command(BaseCommand):
+    help = 'Run N DNS worker processes sharing port 8053 (SO_REUSEPORT) under a supervisor'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of DNS worker processes (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=DNS_PORT,
+            help=f'DNS port (default: {DNS_PORT})'
+        )
+        parser.add_argument(
+            '--report-interval',
+            type=float,
+            default=60.0,
+            help='Seconds between per-worker query count reports (default: 60)'
+        )
+
+    def handle(self, *args, **options):
+        pool = DNSWorkerPool(
+            options['workers'],
+            port=options['port'],
+            report_interval=options['report_interval'],
+        )
+        pool.start()
+        # SIGTERM/SIGINT end supervise() and the workers are stopped below
+        pool.stop_on_signals()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'\n✅ {options["workers"]} DNS workers started on port {options["port"]}\n'
+            )
+        )
+        try:
+            pool.supervise(on_report=lambda summary: self.stdout.write(summary))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stdout.write(self.style.WARNING('\nStopping DNS workers...'))
+            pool.stop()
+            self.stdout.write(pool.report())
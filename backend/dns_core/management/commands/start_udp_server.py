@@ -5,10 +5,17 @@ from dns_core.udp_server import start_udp_server
 class Command(BaseCommand):
     help = 'Start the UDP DNS server on port 8053'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-concurrency',
+            type=int,
+            default=None,
+            help='Max queries resolved in parallel (default: DNS_UDP_MAX_CONCURRENCY)'
+        )
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS('Starting UDP DNS server...'))
         try:
-            start_udp_server()
+            start_udp_server(max_concurrency=options['max_concurrency'])
         except KeyboardInterrupt:
             self.stdout.write(self.style.WARNING('\nUDP DNS server stopped.'))
-
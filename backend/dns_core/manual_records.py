@@ -0,0 +1,164 @@
+"""
+In-memory index of manual (admin-added) DNS records.
+Keeps the resolver hot path off the ORM: records are loaded once, keyed
+case-insensitively by (name, type) with pre-encoded rdata, and updated from
+model signals. Other processes notice changes through a version counter in
+Redis and reload.
+"""
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from records.models import DNSRecord
+from .packet import _build_rdata
+from .redis_cache import get_redis_client, normalize_domain
+
+VERSION_KEY = "dns:manual:version"
+
+
+def _make_entry(record):
+    """Build the answer dict served for a manual record"""
+    try:
+        rdata = _build_rdata(record.record_type, record.value, record.priority)
+    except (OSError, ValueError):
+        rdata = None
+    return {
+        "type": record.record_type,
+        "value": record.value,
+        "ttl": record.ttl,
+        "priority": record.priority,
+        "rdata": rdata,
+    }
+
+
+def _insert(records, keys_by_id, record):
+    key = (normalize_domain(record.domain), record.record_type.upper())
+    records.setdefault(key[0], {}).setdefault(key[1], {})[record.id] = _make_entry(record)
+    keys_by_id[record.id] = key
+
+
+class ManualRecordIndex:
+    """Case-insensitive {name: {type: {id: answer}}} index of manual records"""
+
+    def __init__(self, recheck_interval=1.0):
+        self.recheck_interval = recheck_interval
+        self._records = None
+        self._keys_by_id = {}
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+
+    def load(self):
+        """(Re)build the whole index from the database"""
+        version = self._read_version()
+        records = {}
+        keys_by_id = {}
+        for record in DNSRecord.objects.filter(is_manual=True):
+            _insert(records, keys_by_id, record)
+        with self._lock:
+            self._records = records
+            self._keys_by_id = keys_by_id
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def lookup(self, domain, record_type):
+        """Return the manual answers for a domain/type ("ANY" returns all types)"""
+        self._ensure_fresh()
+        return self._find(domain, record_type)
+
+    async def lookup_async(self, domain, record_type):
+        """lookup for asyncio code; (re)loading and version checks run in a thread"""
+        if self._records is None or time.monotonic() - self._checked_at >= self.recheck_interval:
+            await sync_to_async(self._ensure_fresh)()
+        return self._find(domain, record_type)
+
+    def _find(self, domain, record_type):
+        with self._lock:
+            types = self._records.get(normalize_domain(domain))
+            if not types:
+                return []
+            if record_type == "ANY":
+                return [entry for entries in types.values() for entry in entries.values()]
+            entries = types.get(record_type.upper())
+            return list(entries.values()) if entries else []
+
+    def update_record(self, record):
+        """Apply a saved record to the index"""
+        with self._lock:
+            if self._records is not None:
+                self._apply_locked(record)
+        self._bump_version()
+
+    def remove_record(self, record_id):
+        """Drop a deleted record from the index"""
+        with self._lock:
+            if self._records is not None:
+                self._remove_locked(record_id)
+        self._bump_version()
+
+    def _apply_locked(self, record):
+        self._remove_locked(record.id)
+        if record.is_manual:
+            _insert(self._records, self._keys_by_id, record)
+
+    def _remove_locked(self, record_id):
+        key = self._keys_by_id.pop(record_id, None)
+        if key is None:
+            return
+        types = self._records.get(key[0], {})
+        entries = types.get(key[1], {})
+        entries.pop(record_id, None)
+        if not entries:
+            types.pop(key[1], None)
+        if not types:
+            self._records.pop(key[0], None)
+
+    def _ensure_fresh(self):
+        if self._records is None:
+            self.load()
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.recheck_interval:
+            return
+        self._checked_at = now
+        version = self._read_version()
+        if version is not None and version != self._version:
+            self.load()
+
+    def _read_version(self):
+        try:
+            return int(get_redis_client().get(VERSION_KEY) or 0)
+        except Exception:
+            return None
+
+    def _bump_version(self):
+        """Tell other processes to reload; reload here too if we missed a change"""
+        try:
+            version = get_redis_client().incr(VERSION_KEY)
+        except Exception:
+            return
+        with self._lock:
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+            else:
+                self._version = None
+
+
+_manual_index = None
+
+def get_manual_index():
+    """Get or create the process-wide manual record index"""
+    global _manual_index
+    if _manual_index is None:
+        _manual_index = ManualRecordIndex(
+            recheck_interval=getattr(settings, 'DNS_MANUAL_RECORDS_RECHECK_INTERVAL', 1.0)
+        )
+    return _manual_index
+
+def get_manual_records(domain, record_type):
+    """Return manual answers for a domain/type from the in-memory index"""
+    return get_manual_index().lookup(domain, record_type)
+
+async def get_manual_records_async(domain, record_type):
+    """get_manual_records for asyncio code"""
+    return await get_manual_index().lookup_async(domain, record_type)
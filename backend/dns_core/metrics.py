@@ -0,0 +1,351 @@
+"""
+Metrics registry for the resolver, cache and upstreams.
+Counters and latency histograms are kept in process memory (a dict update
+under a lock) and a background thread pushes the deltas to Redis every
+DNS_METRICS_PUSH_INTERVAL seconds, so every worker process adds into the
+same totals. The /metrics endpoint renders the Redis totals in the
+Prometheus text format.
+
+At each push the stats other components keep for themselves are read too
+(_process_samples): their counters are added to the totals and their
+gauges are stored per process (labelled instance="host:pid") in a hash
+that expires when the process stops pushing. The hashes are listed in a
+sorted set scored by their expiry time, so a scrape reads that instead of
+scanning the keyspace; a scrape also pushes this process's own changes,
+at most every DNS_METRICS_SCRAPE_PUSH_INTERVAL seconds.
+"""
+import atexit
+import os
+import re
+import socket
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from .redis_cache import get_redis_client
+from .tracing import add_span
+
+COUNTERS_KEY = 'dns:metrics:counters'
+HISTOGRAMS_KEY = 'dns:metrics:histograms'
+GAUGES_KEY_PREFIX = 'dns:metrics:gauges:'
+GAUGES_INDEX_KEY = 'dns:metrics:gauge_keys'
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels, extra=''):
+    """Prometheus sample name, e.g. dns_queries_total{transport="udp"}"""
+    parts = [f'{key}="{_escape(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return f"{name}{{{','.join(parts)}}}" if parts else name
+
+
+def _process_samples():
+    """
+    Samples of this process's own stats as (kind, name, labels, value):
+    'counter' values are totals since the process started, 'gauge' values
+    are current readings.
+    """
+    # Imported here: these modules import metrics themselves
+    from . import async_resolver, resolver
+    from .local_cache import get_local_cache
+    from .logger import get_log_stats
+    from .prefetch import get_prefetch_stats
+    from .upstream import get_upstream_stats
+
+    samples = []
+    for server, stats in get_upstream_stats().items():
+        labels = (('server', server),)
+        if stats['srtt_ms'] is not None:
+            samples.append(('gauge', 'dns_upstream_srtt_seconds', labels, stats['srtt_ms'] / 1000))
+        samples.extend((
+            ('gauge', 'dns_upstream_outstanding_queries', labels, stats['outstanding']),
+            ('counter', 'dns_upstream_race_wins_total', labels, stats['race_wins']),
+            ('counter', 'dns_upstream_dropped_replies_total', labels, stats['dropped_replies']),
+        ))
+    l1 = get_local_cache().stats()
+    samples.extend((
+        ('counter', 'dns_l1_cache_lookups_total', (('result', 'hit'),), l1['hits']),
+        ('counter', 'dns_l1_cache_lookups_total', (('result', 'miss'),), l1['misses']),
+        ('counter', 'dns_l1_cache_evictions_total', (), l1['evictions']),
+        ('gauge', 'dns_l1_cache_entries', (), l1['size']),
+    ))
+    samples.append(('counter', 'dns_singleflight_coalesced_total', (),
+                    resolver._upstream_flights.coalesced + async_resolver._coalesced_flights))
+    prefetch = get_prefetch_stats()
+    if prefetch:
+        samples.extend(
+            ('counter', 'dns_prefetch_refreshes_total', (('result', result),), prefetch[result])
+            for result in ('scheduled', 'completed', 'failed', 'rate_limited')
+        )
+        samples.append(('gauge', 'dns_prefetch_inflight', (), prefetch['inflight']))
+    refresh = resolver.get_refresh_stats()
+    if refresh:
+        samples.extend(
+            ('counter', 'dns_serve_stale_refreshes_total', (('result', result),), refresh[result])
+            for result in ('scheduled', 'coalesced', 'dropped')
+        )
+        samples.append(('gauge', 'dns_serve_stale_refreshes_pending', (), refresh['pending']))
+    log = get_log_stats()
+    if log:
+        samples.extend((
+            ('counter', 'dns_log_dropped_records_total', (), log['dropped']),
+            ('gauge', 'dns_log_queue_depth', (), log['queued']),
+        ))
+    return samples
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of one process, identified by (name, labels)
+    where labels is a tuple of (key, value) pairs. Holds the changes since
+    the last push() only.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, push_interval=10):
+        self.buckets = buckets
+        self.push_interval = push_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        # Process stats counter totals as of the last push
+        self._collected = {}
+        self._push_lock = threading.Lock()
+        self._pushed_at = float('-inf')
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def inc(self, name, labels=(), value=1):
+        if self._thread is None:
+            self._start()
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        if self._thread is None:
+            self._start()
+        key = (name, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then the +Inf bucket, then the sum
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def _take(self):
+        with self._lock:
+            counters, histograms = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+        return counters, histograms
+
+    def _restore(self, counters, histograms):
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in histograms.items():
+                current = self._histograms.setdefault(key, [0] * len(values[:-1]) + [0.0])
+                for index, value in enumerate(values):
+                    current[index] += value
+
+    def _collect(self, counters):
+        """Add the process stats counters' increments since the last push to counters; returns the gauges"""
+        try:
+            samples = _process_samples()
+        except Exception:
+            return {}
+        instance = (('instance', f'{socket.gethostname()}:{os.getpid()}'),)
+        gauges = {}
+        for kind, name, labels, value in samples:
+            if kind == 'gauge':
+                gauges[_series(name, labels + instance)] = value
+                continue
+            key = (name, labels)
+            last = self._collected.get(key)
+            # A total below the last one means the stats were reset (a new client)
+            delta = value - last if last is not None and value >= last else value
+            self._collected[key] = value
+            # Pushed even when 0 the first time, so the series exists
+            if delta or last is None:
+                counters[key] = counters.get(key, 0) + delta
+        return gauges
+
+    def push(self, max_age=None):
+        """
+        Add this process's changes to the totals in Redis; kept for the next
+        push on failure. With max_age, skipped if the last successful push is
+        more recent than max_age seconds.
+        """
+        with self._push_lock:
+            if max_age is not None and time.monotonic() - self._pushed_at < max_age:
+                return True
+            return self._push()
+
+    def _push(self):
+        counters, histograms = self._take()
+        gauges = self._collect(counters)
+        try:
+            pipe = get_redis_client().pipeline(transaction=False)
+            for (name, labels), value in counters.items():
+                pipe.hincrby(COUNTERS_KEY, _series(name, labels), value)
+            for (name, labels), values in histograms.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    pipe.hincrby(HISTOGRAMS_KEY, _series(f'{name}_bucket', labels, f'le="{bound}"'),
+                                 cumulative)
+                pipe.hincrby(HISTOGRAMS_KEY, _series(f'{name}_count', labels), cumulative)
+                pipe.hincrbyfloat(HISTOGRAMS_KEY, _series(f'{name}_sum', labels), values[-1])
+            gauges_key = f'{GAUGES_KEY_PREFIX}{socket.gethostname()}:{os.getpid()}'
+            ttl = max(int(self.push_interval * 3), 30)
+            pipe.delete(gauges_key)
+            if gauges:
+                pipe.hset(gauges_key, mapping=gauges)
+                pipe.expire(gauges_key, ttl)
+                pipe.zadd(GAUGES_INDEX_KEY, {gauges_key: time.time() + ttl})
+                pipe.expire(GAUGES_INDEX_KEY, ttl)
+            else:
+                pipe.zrem(GAUGES_INDEX_KEY, gauges_key)
+            pipe.execute()
+            self._pushed_at = time.monotonic()
+            return True
+        except Exception:
+            self._restore(counters, histograms)
+            return False
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stopping,), name='dns-metrics', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self, stopping):
+        while not stopping.wait(self.push_interval):
+            self.push()
+
+    def reset_after_fork(self):
+        # The pusher thread does not survive a fork and the parent pushes its own changes.
+        # _collected is kept: the child inherits the stats objects it was taken from
+        self._lock = threading.Lock()
+        self._push_lock = threading.Lock()
+        self._pushed_at = float('-inf')
+        self._counters, self._histograms = {}, {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def stop(self):
+        self._stopping.set()
+        self.push()
+
+
+class timed:
+    """
+    Context manager observing the seconds spent in a resolver stage, also
+    recorded as a span of the current request's trace (see tracing)
+    """
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        observe('dns_stage_duration_seconds', elapsed, stage=self.stage)
+        add_span(self.stage, elapsed)
+        return False
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """Get or create the process-wide registry, or None if metrics are disabled"""
+    global _registry
+    if _registry is None and getattr(settings, 'DNS_METRICS_ENABLED', True):
+        with _registry_lock:
+            if _registry is None:
+                registry = MetricsRegistry(
+                    push_interval=getattr(settings, 'DNS_METRICS_PUSH_INTERVAL', 10)
+                )
+                atexit.register(registry.stop)
+                os.register_at_fork(after_in_child=registry.reset_after_fork)
+                _registry = registry
+    return _registry
+
+def inc(name, value=1, **labels):
+    """Increment a counter"""
+    registry = _registry or get_registry()
+    if registry is not None:
+        registry.inc(name, tuple(labels.items()), value)
+
+def observe(name, value, **labels):
+    """Record a value (seconds) in a latency histogram"""
+    registry = _registry or get_registry()
+    if registry is not None:
+        registry.observe(name, value, tuple(labels.items()))
+
+
+_SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{.*\})?$')
+_LE = re.compile(r',?le="([^"]*)"')
+
+def _sort_key(sample, histogram):
+    match = _SAMPLE.match(sample)
+    name, labels = match.group('name'), match.group('labels') or ''
+    if not histogram:
+        return (name, labels, 0, 0.0)
+    family, _, suffix = name.rpartition('_')
+    le = _LE.search(labels)
+    bound = float(le.group(1)) if le else 0.0
+    labels = _LE.sub('', labels).replace('{,', '{')
+    return (family, '' if labels == '{}' else labels, ('bucket', 'sum', 'count').index(suffix), bound)
+
+def render_metrics():
+    """Push this process's changes and render the cluster-wide totals in the Prometheus text format"""
+    registry = get_registry()
+    if registry is not None:
+        registry.push(max_age=getattr(settings, 'DNS_METRICS_SCRAPE_PUSH_INTERVAL', 1.0))
+    r = get_redis_client()
+    pipe = r.pipeline(transaction=False)
+    # Processes that stopped pushing drop out of the index once their hash expired
+    pipe.zremrangebyscore(GAUGES_INDEX_KEY, '-inf', time.time())
+    pipe.zrange(GAUGES_INDEX_KEY, 0, -1)
+    pipe.hgetall(COUNTERS_KEY)
+    pipe.hgetall(HISTOGRAMS_KEY)
+    _, gauge_keys, counters, histograms = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for key in gauge_keys:
+        pipe.hgetall(key)
+    process_gauges = pipe.execute()
+    gauges = {}
+    for samples in process_gauges:
+        gauges.update(samples)
+
+    lines = []
+    for samples, kind in ((counters, 'counter'), (gauges, 'gauge'), (histograms, 'histogram')):
+        histogram = kind == 'histogram'
+        samples = {key.decode('utf-8'): value.decode('utf-8') for key, value in samples.items()}
+        family = None
+        for sample in sorted(samples, key=lambda sample: _sort_key(sample, histogram)):
+            name = _SAMPLE.match(sample).group('name')
+            if histogram:
+                name = name.rpartition('_')[0]
+            if name != family:
+                family = name
+                lines.append(f"# TYPE {family} {kind}")
+            lines.append(f'{sample} {samples[sample]}')
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,7 @@
 import os
 import struct
 import socket
+from functools import lru_cache
 
 TYPE_MAP = {
     1: "A",
@@ -14,6 +15,11 @@ TYPE_MAP = {
 }
 TYPE_CODE = {v: k for k, v in TYPE_MAP.items()}
 
+# Types the message codec can name and encode: the queryable types above plus
+# SOA, which negative answers carry in their authority section (RFC 2308)
+RR_TYPE_MAP = {**TYPE_MAP, 6: "SOA"}
+RR_TYPE_CODE = {v: k for k, v in RR_TYPE_MAP.items()}
+
 def parse_qname(data, offset):
     labels = []
     while True:
@@ -25,16 +31,18 @@ def parse_qname(data, offset):
         offset += length + 1
     return ".".join(labels) + ".", offset
 
+@lru_cache(maxsize=4096)
 def encode_qname(name):
     if not name.endswith("."):
         name += "."
-    parts = name.split(".")
-    out = b""
-    for part in parts:
-        if not part:
-            continue
-        out += bytes([len(part)]) + part.encode("ascii", "ignore")
-    return out + b"\x00"
+    out = bytearray()
+    for part in name.split("."):
+        if part:
+            label = part.encode("ascii", "ignore")
+            out.append(len(label))
+            out += label
+    out.append(0)
+    return bytes(out)
 
 def decode_qname(data, offset):
     labels = []
@@ -65,99 +73,411 @@ def build_query(domain, qtype_str):
     question = encode_qname(domain) + struct.pack("!HH", TYPE_CODE[qtype_str], 1)
     return transaction_id, header + question
 
-def _build_rdata(record_type, value, priority=None):
+_HEADER = struct.Struct("!2sHHHHH")
+_QUESTION_FIXED = struct.Struct("!HH")
+_RR_FIXED = struct.Struct("!HHIH")
+_U16 = struct.Struct("!H")
+_SOA_NUMBERS = struct.Struct("!IIIII")
+
+# Types whose rdata holds domain names that may be compressed (RFC 3597 section 4)
+_COMPRESSIBLE_TYPES = {"CNAME", "NS", "PTR", "MX", "SOA"}
+
+
+@lru_cache(maxsize=4096)
+def _name_suffixes(name):
+    """Split a name into (suffix, encoded label) pairs, longest suffix first"""
+    labels = [label for label in name.split(".") if label]
+    return tuple(
+        (".".join(labels[i:]), bytes([len(encoded)]) + encoded)
+        for i, encoded in enumerate(label.encode("ascii", "ignore") for label in labels)
+    )
+
+
+class MessageWriter(bytearray):
+    """
+    Buffer a DNS message is serialized into in one pass; appending grows it
+    in place (amortized) instead of copying the message for every field.
+
+    Names are compressed (RFC 1035 4.1.4): every suffix written is remembered
+    and later occurrences become pointers to it. Suffixes are matched
+    case-sensitively so names keep the case they were given. Rdata built on
+    its own to be copied into other messages must use compress=False.
+    """
+    __slots__ = ('names', 'question_offset')
+
+    def __init__(self, data=b"", compress=True):
+        super().__init__(data)
+        self.names = {} if compress else None
+        self.question_offset = None
+
+    def add_name(self, name, offset):
+        """Make a name already in the buffer at offset available for compression"""
+        for suffix, label in _name_suffixes(name):
+            if offset >= 0x4000:
+                break
+            self.names.setdefault(suffix, offset)
+            offset += len(label)
+
+    def write_name(self, name):
+        if self.names is None:
+            self += encode_qname(name)
+            return
+        if self.question_offset is not None:
+            # The question name is only parsed once a name is actually written
+            self.add_name(parse_qname(self, self.question_offset)[0], self.question_offset)
+            self.question_offset = None
+        for suffix, label in _name_suffixes(name):
+            pointer = self.names.get(suffix)
+            if pointer is not None:
+                self += _U16.pack(0xC000 | pointer)
+                return
+            if len(self) < 0x4000:
+                self.names[suffix] = len(self)
+            self += label
+        self.append(0)
+
+
+def _write_rdata(writer, record_type, value, priority=None):
     if record_type == "A":
-        return socket.inet_aton(value)
-    if record_type == "AAAA":
-        return socket.inet_pton(socket.AF_INET6, value)
-    if record_type in {"CNAME", "NS", "PTR"}:
-        return encode_qname(value)
-    if record_type == "MX":
-        preference = struct.pack("!H", priority or 0)
-        return preference + encode_qname(value)
-    if record_type == "TXT":
+        writer += socket.inet_aton(value)
+    elif record_type == "AAAA":
+        writer += socket.inet_pton(socket.AF_INET6, value)
+    elif record_type in {"CNAME", "NS", "PTR"}:
+        writer.write_name(value)
+    elif record_type == "MX":
+        writer += _U16.pack(priority or 0)
+        writer.write_name(value)
+    elif record_type == "TXT":
         raw = value.encode("ascii", "ignore")[:255]
-        return bytes([len(raw)]) + raw
-    return b""
-
-def build_response(transaction_id, question_section, answers, rcode=0):
-    flags = 0x8180 if rcode == 0 else 0x8183
-    header = (
-        transaction_id
-        + struct.pack("!H", flags)
-        + b"\x00\x01"
-        + struct.pack("!H", len(answers))
-        + b"\x00\x00"
-        + b"\x00\x00"
-    )
-    if not answers:
-        return header + question_section
+        writer.append(len(raw))
+        writer += raw
+    elif record_type == "SOA":
+        # "mname rname serial refresh retry expire minimum", as parsed below
+        mname, rname, *numbers = value.split()
+        if len(numbers) != 5:
+            raise ValueError(f"Invalid SOA data: {value!r}")
+        writer.write_name(mname)
+        writer.write_name(rname)
+        writer += _SOA_NUMBERS.pack(*map(int, numbers))
+
+def _build_rdata(record_type, value, priority=None):
+    writer = MessageWriter(compress=False)
+    _write_rdata(writer, record_type, value, priority)
+    return bytes(writer)
 
-    response = header + question_section
+def _write_rr(writer, answer):
+    """Write everything of a resource record after its owner name"""
+    record_type = answer["type"]
+    writer += _RR_FIXED.pack(RR_TYPE_CODE[record_type], 1, answer.get("ttl", 60), 0)
+    rdata_start = len(writer)
+    rdata = answer.get("rdata")
+    if rdata is None or record_type in _COMPRESSIBLE_TYPES:
+        # Names in rdata are written here so they can be compressed
+        _write_rdata(writer, record_type, answer["value"], answer.get("priority"))
+    else:
+        writer += rdata
+    # Fill in RDLENGTH now that the rdata is written
+    _U16.pack_into(writer, rdata_start - 2, len(writer) - rdata_start)
+
+def build_response(transaction_id, question_section, answers, rcode=0, authority=None):
+    authority = authority or []
+    writer = MessageWriter(
+        _HEADER.pack(transaction_id, 0x8180 | rcode, 1, len(answers), len(authority), 0)
+    )
+    writer.question_offset = 12
+    writer += question_section
     for answer in answers:
-        name = b"\xc0\x0c"
-        record_type = answer["type"]
-        type_code = struct.pack("!H", TYPE_CODE[record_type])
-        class_in = struct.pack("!H", 1)
-        ttl = struct.pack("!I", answer.get("ttl", 60))
-        rdata = _build_rdata(record_type, answer["value"], answer.get("priority"))
-        rdlength = struct.pack("!H", len(rdata))
-        response += name + type_code + class_in + ttl + rdlength + rdata
-    return response
+        writer += b"\xc0\x0c"
+        _write_rr(writer, answer)
+    for record in authority:
+        writer.write_name(record["name"])
+        _write_rr(writer, record)
+    return bytes(writer)
+
+
+def _read_name(view, offset, names):
+    """
+    Decode the (possibly compressed) name at offset; returns (name, next offset).
+    names caches the names already decoded in this message by offset, so
+    compression pointers to them are resolved without walking the labels again.
+    """
+    start = offset
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = view[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | view[offset + 1]
+            suffix = names.get(offset)
+            if suffix is not None:
+                name = ".".join(labels) + "." + suffix if labels else suffix
+                names[start] = name
+                return name, end
+            jumps += 1
+            if jumps > 127:
+                raise ValueError("Compression pointer loop")
+            continue
+        labels.append(str(view[offset + 1:offset + 1 + length], "ascii", "ignore"))
+        offset += length + 1
+    name = ".".join(labels) + "."
+    names[start] = name
+    return name, (end if end is not None else offset)
+
+
+class Question:
+    __slots__ = ('name', 'qtype', 'qclass')
+
+    def __init__(self, name, qtype, qclass):
+        self.name = name
+        self.qtype = qtype
+        self.qclass = qclass
+
+
+class ResourceRecord:
+    """A parsed RR; rdata stays in the message buffer until value() is called"""
+    __slots__ = ('name', 'rtype', 'rclass', 'ttl', 'rdata_offset', 'rdlength', '_message')
+
+    def __init__(self, name, rtype, rclass, ttl, rdata_offset, rdlength, message):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata_offset = rdata_offset
+        self.rdlength = rdlength
+        self._message = message
+
+    @property
+    def type_name(self):
+        return RR_TYPE_MAP.get(self.rtype) or str(self.rtype)
+
+    def value(self):
+        """Presentation form of the rdata (as in DNS-JSON "data"), or None"""
+        view, names = self._message.view, self._message.names
+        start, rdlength, rtype = self.rdata_offset, self.rdlength, self.rtype
+        if rtype == 1 and rdlength == 4:
+            return socket.inet_ntoa(view[start:start + 4])
+        if rtype == 28 and rdlength == 16:
+            return socket.inet_ntop(socket.AF_INET6, view[start:start + 16])
+        if rtype in {2, 5, 12}:
+            return _read_name(view, start, names)[0]
+        if rtype == 15 and rdlength >= 3:
+            preference = _U16.unpack_from(view, start)[0]
+            return f"{preference} {_read_name(view, start + 2, names)[0]}"
+        if rtype == 16 and rdlength >= 1:
+            length = view[start]
+            return str(view[start + 1:start + 1 + length], "ascii", "ignore")
+        if rtype == 6 and rdlength >= 22:
+            mname, offset = _read_name(view, start, names)
+            rname, offset = _read_name(view, offset, names)
+            numbers = _SOA_NUMBERS.unpack_from(view, offset)
+            return " ".join([mname, rname] + [str(number) for number in numbers])
+        return None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "type": RR_TYPE_MAP.get(self.rtype) or str(self.rtype),
+            "ttl": self.ttl,
+            "data": self.value(),
+        }
+
+
+class Message:
+    """A parsed DNS message; sections are lists of Question/ResourceRecord"""
+    __slots__ = ('transaction_id', 'flags', 'questions', 'answers', 'authority', 'additional',
+                 'view', 'names')
+
+    @classmethod
+    def parse(cls, data):
+        message = cls()
+        message.view = view = memoryview(data)
+        message.names = names = {}
+        size = len(view)
+        message.transaction_id, message.flags, qdcount, ancount, nscount, arcount = (
+            _HEADER.unpack_from(view, 0)
+        )
+        offset = 12
+        message.questions = []
+        for _ in range(qdcount):
+            name, offset = _read_name(view, offset, names)
+            qtype, qclass = _QUESTION_FIXED.unpack_from(view, offset)
+            offset += 4
+            message.questions.append(Question(name, qtype, qclass))
+        sections = []
+        for count in (ancount, nscount, arcount):
+            records = []
+            for _ in range(count):
+                name, offset = _read_name(view, offset, names)
+                rtype, rclass, ttl, rdlength = _RR_FIXED.unpack_from(view, offset)
+                offset += 10
+                if offset + rdlength > size:
+                    raise ValueError("Truncated resource record")
+                records.append(ResourceRecord(name, rtype, rclass, ttl, offset, rdlength, message))
+                offset += rdlength
+            sections.append(records)
+        message.answers, message.authority, message.additional = sections
+        return message
+
+    @property
+    def rcode(self):
+        return self.flags & 0x000F
+
+    def to_dict(self):
+        """The DNS-JSON style dict returned by parse_dns_response"""
+        return {
+            "Status": self.rcode,
+            "TC": (self.flags >> 9) & 1,
+            "RD": (self.flags >> 8) & 1,
+            "RA": (self.flags >> 7) & 1,
+            "Question": [{"name": q.name, "type": q.qtype} for q in self.questions],
+            "Answer": [record.to_dict() for record in self.answers],
+            # Authority carries the SOA of negative answers (RFC 2308)
+            "Authority": [record.to_dict() for record in self.authority],
+            "TransactionID": int.from_bytes(self.transaction_id, "big"),
+        }
+
 
 def parse_dns_response(data):
-    transaction_id = data[:2]
-    flags = struct.unpack("!H", data[2:4])[0]
-    rcode = flags & 0x000F
-    qdcount = struct.unpack("!H", data[4:6])[0]
-    ancount = struct.unpack("!H", data[6:8])[0]
+    return Message.parse(data).to_dict()
+
+def skip_name(data, offset):
+    """Return the offset just past the (possibly compressed) name at offset"""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def find_ttl_offsets(data):
+    """
+    Return the byte offsets of every RR TTL field in a DNS message
+    (answer, authority and additional sections, skipping EDNS OPT records).
+    """
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", data, 4)
     offset = 12
-    questions = []
     for _ in range(qdcount):
-        name, offset = decode_qname(data, offset)
-        qtype, _ = struct.unpack("!HH", data[offset:offset + 4])
-        offset += 4
-        questions.append({"name": name, "type": qtype})
-    answers = []
-    for _ in range(ancount):
-        name, offset = decode_qname(data, offset)
-        atype, aclass, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
-        offset += 10
-        rdata = data[offset:offset + rdlength]
-        offset += rdlength
-        record_type = TYPE_MAP.get(atype, str(atype))
-        value = None
-        if atype == 1 and rdlength == 4:
-            value = socket.inet_ntoa(rdata)
-        elif atype == 28 and rdlength == 16:
-            value = socket.inet_ntop(socket.AF_INET6, rdata)
-        elif atype in {2, 5, 12}:
-            value, _ = decode_qname(data, offset - rdlength)
-        elif atype == 15 and rdlength >= 3:
-            preference = struct.unpack("!H", rdata[:2])[0]
-            exchange, _ = decode_qname(data, offset - rdlength + 2)
-            value = f"{preference} {exchange}"
-        elif atype == 16 and rdlength >= 1:
-            length = rdata[0]
-            value = rdata[1:1 + length].decode("ascii", "ignore")
-        answers.append(
-            {
-                "name": name,
-                "type": record_type,
-                "ttl": ttl,
-                "data": value,
-            }
-        )
-    
-    result = {
-        "Status": rcode,
-        "TC": (flags >> 9) & 1,
-        "RD": (flags >> 8) & 1,
-        "RA": (flags >> 7) & 1,
-        "Question": questions,
-        "Answer": answers,
-        "TransactionID": int.from_bytes(transaction_id, "big"),
+        offset = skip_name(data, offset) + 4
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        rtype, _, _, rdlength = struct.unpack_from("!HHIH", data, offset)
+        if rtype != 41:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+    return offsets
+
+def patch_cached_response(packet, ttl_offsets, elapsed, transaction_id, question_section=None,
+                          fixed_ttl=None):
+    """
+    Turn a cached wire-format response into an answer for a new query:
+    copy it, write the new transaction ID, echo the client's question bytes
+    and decrease every TTL by the seconds elapsed since it was cached
+    (or set every TTL to fixed_ttl, used when serving stale data).
+    """
+    response = bytearray(packet)
+    response[0:2] = transaction_id
+    if question_section:
+        end = 12 + len(question_section)
+        if response[12:end].lower() == question_section.lower():
+            response[12:end] = question_section
+    for offset in ttl_offsets:
+        if fixed_ttl is not None:
+            struct.pack_into("!I", response, offset, fixed_ttl)
+            continue
+        ttl = struct.unpack_from("!I", response, offset)[0]
+        struct.pack_into("!I", response, offset, max(ttl - elapsed, 0))
+    return bytes(response)
+
+def _find_opt(data):
+    """Return the (start, end) offsets of the EDNS OPT record in a message, or None"""
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", data, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+    for _ in range(ancount + nscount + arcount):
+        start = offset
+        offset = skip_name(data, offset)
+        rtype, _, _, rdlength = struct.unpack_from("!HHIH", data, offset)
+        offset += 10 + rdlength
+        if rtype == 41:
+            return start, offset
+    return None
+
+def parse_edns(data):
+    """
+    Return the EDNS0 parameters of a message as {"udp_payload", "version", "do"},
+    or None if it carries no (valid) OPT record.
+    """
+    try:
+        span = _find_opt(data)
+        if span is None:
+            return None
+        udp_payload, flags = struct.unpack_from("!HI", data, span[0] + 3)
+    except (IndexError, struct.error):
+        return None
+    return {
+        "udp_payload": max(udp_payload, 512),
+        "version": (flags >> 16) & 0xFF,
+        "do": bool(flags & 0x8000),
     }
-    
-    
-    return result
+
+def build_opt_record(udp_payload, do=False):
+    """Encode an EDNS0 OPT pseudo-record advertising udp_payload bytes"""
+    return b"\x00" + struct.pack("!HHIH", 41, udp_payload, 0x8000 if do else 0, 0)
+
+def _add_additional(data, record):
+    arcount = struct.unpack_from("!H", data, 10)[0]
+    return data[:10] + struct.pack("!H", arcount + 1) + data[12:] + record
+
+def set_edns_payload(data, udp_payload):
+    """Advertise udp_payload in a query, adding an OPT record if it has none"""
+    span = _find_opt(data)
+    if span is None:
+        return _add_additional(data, build_opt_record(udp_payload))
+    message = bytearray(data)
+    struct.pack_into("!H", message, span[0] + 3, udp_payload)
+    return bytes(message)
+
+def strip_opt_record(data):
+    """Remove the OPT record from a message (it is per hop, never cached)"""
+    span = _find_opt(data)
+    if span is None:
+        return data
+    arcount = struct.unpack_from("!H", data, 10)[0]
+    return data[:10] + struct.pack("!H", arcount - 1) + data[12:span[0]] + data[span[1]:]
+
+def truncate_response(data):
+    """Cut a response down to header and question with the TC bit set"""
+    end = 12
+    for _ in range(struct.unpack_from("!H", data, 4)[0]):
+        end = skip_name(data, end) + 4
+    flags = struct.unpack_from("!H", data, 2)[0] | 0x0200
+    return data[:2] + struct.pack("!HHHHH", flags, struct.unpack_from("!H", data, 4)[0], 0, 0, 0) + data[12:end]
+
+def apply_edns(query, response, udp_payload, udp=True):
+    """
+    Finish a response for its transport: echo an OPT record advertising
+    udp_payload if the query carried one, and over UDP set TC instead of
+    sending more than the client can take (512 bytes without EDNS).
+    A udp_payload of 0 disables EDNS.
+    """
+    response = strip_opt_record(response)
+    edns = parse_edns(query)
+    opt = b""
+    limit = 512
+    if edns is not None and udp_payload:
+        opt = build_opt_record(udp_payload, edns["do"])
+        limit = max(512, min(edns["udp_payload"], udp_payload))
+    if udp and len(response) + len(opt) > limit:
+        response = truncate_response(response)
+    if opt:
+        response = _add_additional(response, opt)
+    return response
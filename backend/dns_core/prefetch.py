@@ -0,0 +1,119 @@
+"""
+Refresh-ahead prefetching of popular cache entries.
+Counts cache hits per RRset; when a popular entry is served in the last part
+of its TTL it is refreshed from upstream in the background, so hot names are
+effectively never cold.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+
+class Prefetcher:
+    """
+    Decide when a cache hit should trigger a background refresh.
+
+    An entry is refreshed when it has been hit at least min_hits times in the
+    current window and is served with at most threshold (a fraction) of its
+    TTL left. Refreshes are rate limited with a token bucket and run on a small
+    thread pool; an entry is never refreshed twice at the same time.
+    """
+
+    def __init__(self, threshold=0.1, min_hits=5, max_per_second=20.0, max_workers=4, window=300):
+        self.threshold = threshold
+        self.min_hits = min_hits
+        self.max_per_second = max_per_second
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dns-prefetch')
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._inflight = set()
+        self._window_started = time.monotonic()
+        self._tokens = max_per_second
+        self._tokens_at = time.monotonic()
+        self.counters = {
+            'scheduled': 0,
+            'completed': 0,
+            'failed': 0,
+            'rate_limited': 0,
+        }
+
+    def _take_token(self, now):
+        self._tokens = min(
+            self.max_per_second,
+            self._tokens + (now - self._tokens_at) * self.max_per_second
+        )
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def observe(self, key, remaining, ttl, refresh):
+        """
+        Record a cache hit served with `remaining` of `ttl` seconds left and
+        schedule refresh() in the background if the entry qualifies.
+        Returns True if a refresh was scheduled.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_started >= self.window:
+                self._hits.clear()
+                self._window_started = now
+            hits = self._hits.get(key, 0) + 1
+            self._hits[key] = hits
+            if hits < self.min_hits or ttl <= 0 or remaining > ttl * self.threshold:
+                return False
+            if key in self._inflight:
+                return False
+            if not self._take_token(now):
+                self.counters['rate_limited'] += 1
+                return False
+            self._inflight.add(key)
+            self.counters['scheduled'] += 1
+        self.executor.submit(self._run, key, refresh)
+        return True
+
+    def _run(self, key, refresh):
+        try:
+            ok = refresh()
+        except Exception:
+            ok = False
+        with self._lock:
+            self._inflight.discard(key)
+            # Start counting afresh for the refreshed entry
+            self._hits.pop(key, None)
+            self.counters['completed' if ok else 'failed'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters,
+                tracked_entries=len(self._hits),
+                inflight=len(self._inflight),
+            )
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+def get_prefetch_stats():
+    """Counters of this process's prefetcher (empty if it was never used)"""
+    return _prefetcher.stats() if _prefetcher is not None else {}
+
+def get_prefetcher():
+    """Get or create the process-wide prefetcher, or None if prefetching is disabled"""
+    global _prefetcher
+    if not getattr(settings, 'DNS_PREFETCH_ENABLED', True):
+        return None
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher(
+                threshold=getattr(settings, 'DNS_PREFETCH_THRESHOLD', 0.1),
+                min_hits=getattr(settings, 'DNS_PREFETCH_MIN_HITS', 5),
+                max_per_second=getattr(settings, 'DNS_PREFETCH_MAX_PER_SECOND', 20.0),
+                max_workers=getattr(settings, 'DNS_PREFETCH_WORKERS', 4),
+                window=getattr(settings, 'DNS_PREFETCH_WINDOW', 300),
+            )
+        return _prefetcher
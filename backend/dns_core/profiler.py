@@ -0,0 +1,168 @@
+"""
+On-demand sampling profiler for live DNS processes.
+An admin request (request_profile, exposed at /api/v1/admin/profile) stores
+a profiling request in Redis. Every process checks for it from a background
+thread every DNS_PROFILE_POLL_INTERVAL seconds and, when it sees a new one,
+samples the stacks of all its threads for the requested number of seconds
+and writes the result to logs/profiles/. No restart or redeploy is needed.
+
+A stack sampler is used rather than cProfile because cProfile only sees the
+thread that enables it, while a worker answers queries on many threads.
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from django.conf import settings
+from .redis_cache import get_redis_client
+
+PROFILE_REQUEST_KEY = 'dns:profile:request'
+
+# Longest profile an admin can request, in seconds
+MAX_PROFILE_SECONDS = 300
+
+
+def get_profiles_dir():
+    return Path(getattr(settings, 'BASE_DIR', Path(__file__).resolve().parent.parent)) / 'logs' / 'profiles'
+
+
+def request_profile(seconds, interval=None):
+    """
+    Ask every DNS process to profile itself for `seconds` seconds, sampling
+    every `interval` seconds. Returns the request as stored in Redis.
+    """
+    request = {
+        'id': uuid.uuid4().hex[:12],
+        'seconds': min(float(seconds), MAX_PROFILE_SECONDS),
+        'interval': interval or getattr(settings, 'DNS_PROFILE_SAMPLE_INTERVAL', 0.01),
+        'requested_at': time.time(),
+    }
+    poll_interval = getattr(settings, 'DNS_PROFILE_POLL_INTERVAL', 5)
+    # Kept long enough for every process to see it once
+    get_redis_client().set(PROFILE_REQUEST_KEY, json.dumps(request),
+                           ex=int(poll_interval * 2 + request['seconds']) + 1)
+    return request
+
+
+def list_profiles():
+    """Profile dumps written so far, newest first"""
+    directory = get_profiles_dir()
+    if not directory.exists():
+        return []
+    return sorted((path.name for path in directory.glob('profile-*.txt')), reverse=True)
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread but its own at a fixed
+    interval and counts them, innermost frame last.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    def report(self, top=40):
+        """Top functions by own and total samples, then the folded stacks (flamegraph input)"""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        thread_samples = sum(self.stacks.values()) or 1
+        lines = [f"# samples: {self.samples}, thread samples: {thread_samples}", "", "# own time"]
+        lines.extend(f"{100.0 * count / thread_samples:6.2f}%  {function}"
+                     for function, count in own.most_common(top))
+        lines += ["", "# total time"]
+        lines.extend(f"{100.0 * count / thread_samples:6.2f}%  {function}"
+                     for function, count in total.most_common(top))
+        lines += ["", "# folded stacks"]
+        lines.extend(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common())
+        return '\n'.join(lines) + '\n'
+
+
+def run_profile(request):
+    """Profile this process as asked and write the report; returns its path"""
+    sampler = StackSampler(request['interval'])
+    sampler.run(request['seconds'])
+    directory = get_profiles_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"profile-{request['id']}-{os.getpid()}.txt"
+    header = (f"# profile {request['id']} of pid {os.getpid()}, {request['seconds']}s "
+              f"every {request['interval']}s\n")
+    path.write_text(header + sampler.report(), encoding='utf-8')
+    from .logger import log_system_event
+    log_system_event('profile', f"Wrote profile {request['id']} to {path}")
+    return path
+
+
+class ProfileWatcher:
+    """Polls Redis for profiling requests and runs each one once in this process"""
+
+    def __init__(self, poll_interval=5):
+        self.poll_interval = poll_interval
+        self.seen = set()
+
+    def check(self):
+        data = get_redis_client().get(PROFILE_REQUEST_KEY)
+        if not data:
+            return None
+        request = json.loads(data)
+        if request['id'] in self.seen:
+            return None
+        self.seen.add(request['id'])
+        if request['requested_at'] + request['seconds'] + self.poll_interval < time.time():
+            return None
+        return run_profile(request)
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.check()
+            except Exception as e:
+                # Redis down, a malformed request or an unwritable profile: try again next poll
+                from .logger import log_system_event
+                log_system_event('profile', f"Profile watcher error: {e!r}", level='error')
+
+
+_watcher_pid = None
+_watcher_lock = threading.Lock()
+
+def ensure_profile_watcher():
+    """Start this process's profile watcher thread (again after a fork) if enabled"""
+    global _watcher_pid
+    if _watcher_pid == os.getpid():
+        return
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+        if not getattr(settings, 'DNS_PROFILE_ENABLED', True):
+            return
+        watcher = ProfileWatcher(getattr(settings, 'DNS_PROFILE_POLL_INTERVAL', 5))
+        threading.Thread(target=watcher.run, name='dns-profile-watcher', daemon=True).start()
@@ -0,0 +1,78 @@
+"""
+Aggregated query logging.
+Instead of one dns_queries.log line per query, counts queries per
+(domain, type, source, status, cache) and writes one summary line per key
+every interval. A sample of individual queries can still be logged in full.
+"""
+import threading
+import time
+
+
+class QueryAggregator:
+    """
+    Per-interval query counts, flushed by a background thread.
+
+    At most max_keys distinct keys are kept per interval; queries for further
+    keys are only counted in the interval's overflow total. write(counts,
+    overflow, interval) is called with the counts of each finished interval.
+    """
+
+    def __init__(self, write, interval=60, max_keys=10000):
+        self.write = write
+        self.interval = interval
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._overflow = 0
+        self._started = time.monotonic()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def add(self, key):
+        """Count one query for key"""
+        if self._thread is None:
+            self._start()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts[key] = count + 1
+            elif len(self._counts) < self.max_keys:
+                self._counts[key] = 1
+            else:
+                self._overflow += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stopping,), name='dns-query-log', daemon=True
+            )
+            self._thread.start()
+
+    def reset_after_fork(self):
+        # The flusher thread does not survive a fork and the parent's counts
+        # are the parent's to write; the child starts afresh
+        self._lock = threading.Lock()
+        self._counts, self._overflow = {}, 0
+        self._started = time.monotonic()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _run(self, stopping):
+        while not stopping.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """Write and reset the counts of the current interval"""
+        with self._lock:
+            counts, overflow = self._counts, self._overflow
+            self._counts, self._overflow = {}, 0
+            now = time.monotonic()
+            interval, self._started = now - self._started, now
+        if counts or overflow:
+            self.write(counts, overflow, interval)
+
+    def stop(self):
+        self._stopping.set()
+        self.flush()
@@ -1,11 +1,38 @@
 """
 Redis cache module for DNS records.
 Uses Redis for caching DNS responses with proper TTL handling.
+
+Each (domain, record type) RRset is stored as a single JSON value, so reading,
+writing or deleting an RRset costs one round trip however many records it has.
+A per-domain hash records which types are cached so ANY lookups never scan
+the keyspace.
+
+Negative answers (NXDOMAIN/NODATA, RFC 2308) are cached under their own
+key per (domain, record type) for the SOA-derived negative TTL.
+
+In "wire" cache mode (DNS_CACHE_MODE) whole upstream responses are cached
+instead, keyed by (qname, qtype, qclass), and served by patching the
+transaction ID and TTLs in place.
+
+The *_async readers serve the ASGI DoH path with redis.asyncio, and
+get_cached_batch looks up many questions in a single pipeline.
 """
+import asyncio
 import json
-import hashlib
+import struct
+import time
+import weakref
 import redis
+import redis.asyncio
 from django.conf import settings
+from .local_cache import get_local_cache
+from .packet import TYPE_CODE, find_ttl_offsets
+
+# Records stay in Redis this many seconds past their TTL (as before the RRset layout)
+CACHE_TTL_BUFFER = 60
+
+# Minimum lifetime of a domain's type index; refreshed on every write to the domain
+TYPE_INDEX_MIN_TTL = 86400 + CACHE_TTL_BUFFER
 
 # Redis connection (lazy initialization)
 _redis_client = None
@@ -22,6 +49,22 @@ def get_redis_client():
         )
     return _redis_client
 
+_async_redis_clients = weakref.WeakKeyDictionary()
+
+def get_async_redis_client():
+    """Get or create the redis.asyncio client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_redis_clients.get(loop)
+    if client is None:
+        client = redis.asyncio.Redis(
+            host=getattr(settings, 'REDIS_HOST', 'localhost'),
+            port=getattr(settings, 'REDIS_PORT', 6379),
+            db=getattr(settings, 'REDIS_DB', 0),
+            decode_responses=False
+        )
+        _async_redis_clients[loop] = client
+    return client
+
 def normalize_domain(domain):
     """Normalize domain name for consistent key generation"""
     domain = domain.lower().strip()
@@ -35,98 +78,207 @@ def normalize_value(value):
         return value.lower().strip()
     return str(value)
 
-def generate_cache_key(domain, record_type, value, priority=None):
+def generate_rrset_key(domain, record_type):
     """
-    Generate a unique Redis key for a DNS record.
-    Format: dns:cache:{domain}:{record_type}:{value_hash}
-    
-    For MX records, priority is included in the hash.
+    Generate the Redis key holding all cached records for a domain/type.
+    Format: dns:cache:rrset:{domain}:{record_type}
     """
     domain = normalize_domain(domain)
     record_type = record_type.upper()
-    value = normalize_value(value)
-    
-    # Create a unique identifier for this record
-    # Include priority for MX records to distinguish different MX records
-    key_parts = [domain, record_type, value]
-    if priority is not None:
-        key_parts.append(str(priority))
-    
-    # Create hash for the value part to handle special characters
-    value_hash = hashlib.md5(':'.join(key_parts).encode('utf-8')).hexdigest()[:12]
-    
-    return f"dns:cache:{domain}:{record_type}:{value_hash}"
-
-def generate_index_key(domain, record_type):
-    """Generate key for the index set that tracks all cache keys for a domain/type"""
-    domain = normalize_domain(domain)
-    record_type = record_type.upper()
-    return f"dns:cache:index:{domain}:{record_type}"
+    return f"dns:cache:rrset:{domain}:{record_type}"
+
+def generate_type_index_key(domain):
+    """
+    Generate the key of the hash listing which types are cached for a domain.
+    Format: dns:cache:types:{domain} -> {record_type: expiry timestamp}
+    """
+    return f"dns:cache:types:{normalize_domain(domain)}"
+
+def _index_rrset(pipe, domain, record_type, redis_ttl, now):
+    """Queue the type index update for an RRset written with redis_ttl"""
+    index_key = generate_type_index_key(domain)
+    pipe.hset(index_key, record_type.upper(), int(now + redis_ttl))
+    pipe.expire(index_key, max(redis_ttl, TYPE_INDEX_MIN_TTL))
+
+def _local_key(domain, record_type):
+    return (normalize_domain(domain), record_type.upper())
+
+def _remaining_ttl(records):
+    """Seconds until the first of these records drops out of Redis"""
+    now = time.time()
+    return min(
+        (
+            record['ttl'] + CACHE_TTL_BUFFER - (now - record['cached_at'])
+            if record.get('cached_at') is not None else int(record.get('ttl', 0))
+            for record in records
+        ),
+        default=0
+    )
+
+def invalidate_local_cache(domain, record_type):
+    """Drop a domain/type (and the domain's ANY entry) from the in-process L1 cache"""
+    local_cache = get_local_cache()
+    local_cache.invalidate(_local_key(domain, record_type))
+    local_cache.invalidate(_local_key(domain, 'ANY'))
+
+def _make_record(domain, record_type, value, ttl, priority=None, cached_at=None):
+    return {
+        'domain': normalize_domain(domain),
+        'record_type': record_type.upper(),
+        'value': value,
+        'ttl': int(ttl),
+        'priority': priority,
+        'cached_at': cached_at if cached_at is not None else time.time(),
+    }
+
+def get_stale_window():
+    """Seconds expired entries are kept for serve-stale (RFC 8767); 0 disables"""
+    return getattr(settings, 'DNS_SERVE_STALE_WINDOW', 0)
+
+def _decode_rrset(data, now=None, include_stale=False):
+    """
+    Decode a stored RRset, dropping records that are past TTL + buffer
+    (or past TTL + the serve-stale window when include_stale is set).
+    """
+    if not data:
+        return []
+    try:
+        records = json.loads(data.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return []
+    now = now if now is not None else time.time()
+    grace = max(CACHE_TTL_BUFFER, get_stale_window()) if include_stale else CACHE_TTL_BUFFER
+    return [
+        record for record in records
+        if record.get('cached_at') is None
+        or record['cached_at'] + record['ttl'] + grace > now
+    ]
+
+def _rrset_redis_ttl(records):
+    # Keep expired records around for the serve-stale window
+    return max(int(record['ttl']) for record in records) + max(CACHE_TTL_BUFFER, get_stale_window())
 
 def get_cached_records(domain, record_type):
     """
     Get all cached records for a domain and record type.
+    Checks the in-process L1 cache first and falls through to Redis on miss.
     Returns list of dicts with record data.
     """
+    local_cache = get_local_cache()
+    local_key = _local_key(domain, record_type)
+    records = local_cache.get(local_key)
+    if records is not None:
+        return records
     try:
         r = get_redis_client()
-        index_key = generate_index_key(domain, record_type)
-        
-        # Get all cache keys for this domain/type
-        cache_keys = r.smembers(index_key)
-        if not cache_keys:
-            return []
-        
-        records = []
-        for key_bytes in cache_keys:
-            key = key_bytes.decode('utf-8')
-            data = r.get(key)
-            if data:
-                try:
-                    record = json.loads(data.decode('utf-8'))
-                    records.append(record)
-                except (json.JSONDecodeError, UnicodeDecodeError):
-                    # Invalid data, remove the key
-                    r.delete(key)
-                    r.srem(index_key, key_bytes)
-        
+        records = _decode_rrset(r.get(generate_rrset_key(domain, record_type)))
+        if records:
+            local_cache.set(local_key, records, _remaining_ttl(records))
         return records
     except Exception:
         # If Redis fails, return empty list (fallback to upstream)
         return []
 
+async def get_cached_records_async(domain, record_type):
+    """get_cached_records for asyncio code"""
+    local_cache = get_local_cache()
+    local_key = _local_key(domain, record_type)
+    records = local_cache.get(local_key)
+    if records is not None:
+        return records
+    try:
+        r = get_async_redis_client()
+        records = _decode_rrset(await r.get(generate_rrset_key(domain, record_type)))
+        if records:
+            local_cache.set(local_key, records, _remaining_ttl(records))
+        return records
+    except Exception:
+        return []
+
+def get_stale_records(domain, record_type):
+    """
+    Get cached records for a domain/type including ones that expired within
+    the serve-stale window. Bypasses the L1 cache, which only holds fresh data.
+    """
+    if not get_stale_window():
+        return []
+    try:
+        r = get_redis_client()
+        return _decode_rrset(r.get(generate_rrset_key(domain, record_type)), include_stale=True)
+    except Exception:
+        return []
+
+async def get_stale_records_async(domain, record_type):
+    """get_stale_records for asyncio code"""
+    if not get_stale_window():
+        return []
+    try:
+        r = get_async_redis_client()
+        return _decode_rrset(await r.get(generate_rrset_key(domain, record_type)), include_stale=True)
+    except Exception:
+        return []
+
+def cache_rrsets(rrsets):
+    """
+    Cache several RRsets in one pipelined round trip, replacing what was cached.
+    rrsets maps (domain, record_type) to a list of (value, ttl, priority) tuples.
+    Returns True if successful, False otherwise.
+    """
+    try:
+        r = get_redis_client()
+        now = time.time()
+        pipe = r.pipeline(transaction=False)
+        for (domain, record_type), entries in rrsets.items():
+            records = [
+                _make_record(domain, record_type, value, ttl, priority, now)
+                for value, ttl, priority in entries
+            ]
+            if not records:
+                continue
+            redis_ttl = _rrset_redis_ttl(records)
+            pipe.setex(
+                generate_rrset_key(domain, record_type),
+                redis_ttl,
+                json.dumps(records)
+            )
+            _index_rrset(pipe, domain, record_type, redis_ttl, now)
+        pipe.execute()
+        for domain, record_type in rrsets:
+            invalidate_local_cache(domain, record_type)
+        return True
+    except Exception:
+        return False
+
+def cache_rrset(domain, record_type, entries):
+    """Cache one RRset given as a list of (value, ttl, priority) tuples"""
+    return cache_rrsets({(domain, record_type): entries})
+
 def cache_record(domain, record_type, value, ttl, priority=None):
     """
-    Cache a DNS record in Redis.
+    Add a single DNS record to its cached RRset in Redis.
+    The read-modify-write runs under WATCH and is retried if the RRset
+    changes meanwhile, so concurrent calls do not lose each other's records.
     Returns True if successful, False otherwise.
     """
     try:
         r = get_redis_client()
-        cache_key = generate_cache_key(domain, record_type, value, priority)
-        index_key = generate_index_key(domain, record_type)
-        
-        # Prepare record data
-        record_data = {
-            'domain': normalize_domain(domain),
-            'record_type': record_type.upper(),
-            'value': value,
-            'ttl': int(ttl),
-            'priority': priority,
-            'cached_at': None  # We'll use Redis TTL instead
-        }
-        
-        # Store in Redis with TTL
-        # Use TTL + small buffer (60 seconds) to ensure we don't serve expired records
-        redis_ttl = int(ttl) + 60
-        r.setex(
-            cache_key,
-            redis_ttl,
-            json.dumps(record_data)
-        )
-        
-        # Add to index set (no expiration on index, keys expire themselves)
-        r.sadd(index_key, cache_key)
-        
+        rrset_key = generate_rrset_key(domain, record_type)
+        record = _make_record(domain, record_type, value, ttl, priority)
+        identity = (normalize_value(value), priority)
+
+        def add_record(pipe):
+            records = [
+                existing for existing in _decode_rrset(pipe.get(rrset_key))
+                if (normalize_value(existing['value']), existing.get('priority')) != identity
+            ]
+            records.append(record)
+            redis_ttl = _rrset_redis_ttl(records)
+            pipe.multi()
+            pipe.setex(rrset_key, redis_ttl, json.dumps(records))
+            _index_rrset(pipe, domain, record_type, redis_ttl, record['cached_at'])
+
+        r.transaction(add_record, rrset_key)
+        invalidate_local_cache(domain, record_type)
         return True
     except Exception:
         return False
@@ -137,52 +289,314 @@ def delete_cached_records(domain, record_type):
     """
     try:
         r = get_redis_client()
-        index_key = generate_index_key(domain, record_type)
-        
-        # Get all cache keys
-        cache_keys = r.smembers(index_key)
-        
-        # Delete all keys
-        if cache_keys:
-            keys_to_delete = [k.decode('utf-8') for k in cache_keys]
-            r.delete(*keys_to_delete)
-        
-        # Delete index
-        r.delete(index_key)
-        
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(generate_rrset_key(domain, record_type))
+        pipe.hdel(generate_type_index_key(domain), record_type.upper())
+        pipe.execute()
+        invalidate_local_cache(domain, record_type)
         return True
     except Exception:
         return False
 
+def _split_type_index(index, now):
+    """Split a domain's type index into (live type names, expired fields)"""
+    live_types, expired_types = [], []
+    for record_type, expires_at in index.items():
+        if int(expires_at) > now:
+            live_types.append(record_type.decode('utf-8'))
+        else:
+            expired_types.append(record_type)
+    return live_types, expired_types
+
 def get_cached_records_any(domain):
     """
     Get all cached records for a domain (any type).
     Returns list of dicts with record data.
     """
+    local_cache = get_local_cache()
+    local_key = _local_key(domain, 'ANY')
+    records = local_cache.get(local_key)
+    if records is not None:
+        return records
     try:
         r = get_redis_client()
-        domain = normalize_domain(domain)
-        
-        # Get all index keys for this domain
-        pattern = f"dns:cache:index:{domain}:*"
-        index_keys = []
-        for key_bytes in r.scan_iter(match=pattern):
-            index_keys.append(key_bytes.decode('utf-8'))
-        
+        index_key = generate_type_index_key(domain)
+        now = time.time()
+
+        # Look up which types are cached for this domain, then fetch them in one MGET
+        live_types, expired_types = _split_type_index(r.hgetall(index_key), now)
+        if expired_types:
+            r.hdel(index_key, *expired_types)
+
         all_records = []
-        for index_key in index_keys:
-            cache_keys = r.smembers(index_key)
-            for key_bytes in cache_keys:
-                key = key_bytes.decode('utf-8')
-                data = r.get(key)
-                if data:
-                    try:
-                        record = json.loads(data.decode('utf-8'))
-                        all_records.append(record)
-                    except (json.JSONDecodeError, UnicodeDecodeError):
-                        pass
-        
+        if live_types:
+            rrset_keys = [generate_rrset_key(domain, record_type) for record_type in live_types]
+            for data in r.mget(rrset_keys):
+                all_records.extend(_decode_rrset(data, now))
+
+        if all_records:
+            local_cache.set(local_key, all_records, _remaining_ttl(all_records))
         return all_records
     except Exception:
         return []
 
+async def get_cached_records_any_async(domain):
+    """get_cached_records_any for asyncio code"""
+    local_cache = get_local_cache()
+    local_key = _local_key(domain, 'ANY')
+    records = local_cache.get(local_key)
+    if records is not None:
+        return records
+    try:
+        r = get_async_redis_client()
+        index_key = generate_type_index_key(domain)
+        now = time.time()
+        live_types, expired_types = _split_type_index(await r.hgetall(index_key), now)
+        if expired_types:
+            await r.hdel(index_key, *expired_types)
+
+        all_records = []
+        if live_types:
+            rrset_keys = [generate_rrset_key(domain, record_type) for record_type in live_types]
+            for data in await r.mget(rrset_keys):
+                all_records.extend(_decode_rrset(data, now))
+
+        if all_records:
+            local_cache.set(local_key, all_records, _remaining_ttl(all_records))
+        return all_records
+    except Exception:
+        return []
+
+def generate_negative_key(domain, record_type):
+    """
+    Generate the Redis key of a cached negative answer for a domain/type.
+    Format: dns:cache:neg:{domain}:{record_type}
+    """
+    return f"dns:cache:neg:{normalize_domain(domain)}:{record_type.upper()}"
+
+def cache_negative(domain, record_type, rcode, soa, ttl):
+    """
+    Cache a negative answer (rcode 3 = NXDOMAIN, 0 = NODATA) for ttl seconds.
+    soa is the authority SOA record as {"name", "ttl", "data"}.
+    Returns True if successful, False otherwise.
+    """
+    entry = {
+        'rcode': rcode,
+        'soa': soa,
+        'ttl': int(ttl),
+        'cached_at': time.time(),
+    }
+    try:
+        get_redis_client().setex(generate_negative_key(domain, record_type), int(ttl), json.dumps(entry))
+        get_local_cache().set(('neg',) + _local_key(domain, record_type), entry, ttl)
+        return True
+    except Exception:
+        return False
+
+def _load_negative_entry(local_key, data):
+    if not data:
+        return None
+    entry = json.loads(data.decode('utf-8'))
+    remaining = entry['cached_at'] + entry['ttl'] - time.time()
+    if remaining <= 0:
+        return None
+    get_local_cache().set(local_key, entry, remaining)
+    return entry
+
+def get_negative_entry(domain, record_type):
+    """Get a cached negative answer for a domain/type, or None"""
+    local_key = ('neg',) + _local_key(domain, record_type)
+    entry = get_local_cache().get(local_key)
+    if entry is not None:
+        return entry
+    try:
+        data = get_redis_client().get(generate_negative_key(domain, record_type))
+        return _load_negative_entry(local_key, data)
+    except Exception:
+        return None
+
+async def get_negative_entry_async(domain, record_type):
+    """get_negative_entry for asyncio code"""
+    local_key = ('neg',) + _local_key(domain, record_type)
+    entry = get_local_cache().get(local_key)
+    if entry is not None:
+        return entry
+    try:
+        data = await get_async_redis_client().get(generate_negative_key(domain, record_type))
+        return _load_negative_entry(local_key, data)
+    except Exception:
+        return None
+
+def get_cache_mode():
+    """Return the configured cache mode: 'records' (default) or 'wire'"""
+    return getattr(settings, 'DNS_CACHE_MODE', 'records')
+
+def generate_response_key(qname, qtype, qclass=1):
+    """
+    Generate the Redis key for a cached wire-format response.
+    Format: dns:cache:wire:{qname}:{qtype}:{qclass}
+    """
+    return f"dns:cache:wire:{normalize_domain(qname)}:{int(qtype)}:{int(qclass)}"
+
+def _encode_cached_response(stored_at, ttl_offsets, packet):
+    # Layout: stored_at (double), offset count, TTL offsets, then the raw packet
+    header = struct.pack(f"!dH{len(ttl_offsets)}H", stored_at, len(ttl_offsets), *ttl_offsets)
+    return header + packet
+
+def _decode_cached_response(data):
+    stored_at, count = struct.unpack_from("!dH", data, 0)
+    ttl_offsets = struct.unpack_from(f"!{count}H", data, 10)
+    return stored_at, ttl_offsets, bytes(data[10 + 2 * count:])
+
+def cache_response(qname, qtype, qclass, packet, max_ttl=None):
+    """
+    Cache a raw upstream response for min(TTL) seconds.
+    With max_ttl (the negative TTL of NXDOMAIN/NODATA answers) every TTL in
+    the stored packet is capped at max_ttl first.
+    Returns True if it was cached, False otherwise.
+    """
+    try:
+        ttl_offsets = find_ttl_offsets(packet)
+        if not ttl_offsets:
+            return False
+        if max_ttl is not None:
+            packet = bytearray(packet)
+            for offset in ttl_offsets:
+                ttl = struct.unpack_from("!I", packet, offset)[0]
+                struct.pack_into("!I", packet, offset, min(ttl, max_ttl))
+        ttl = cached_response_ttl(packet, ttl_offsets)
+        if ttl <= 0:
+            return False
+        stored_at = time.time()
+        key = generate_response_key(qname, qtype, qclass)
+        r = get_redis_client()
+        r.setex(key, ttl + get_stale_window(), _encode_cached_response(stored_at, ttl_offsets, packet))
+        get_local_cache().set(('wire', key), (stored_at, tuple(ttl_offsets), bytes(packet)), ttl)
+        return True
+    except Exception:
+        return False
+
+def cached_response_ttl(packet, ttl_offsets):
+    """Smallest TTL in a cached wire-format response, as stored"""
+    return min(struct.unpack_from("!I", packet, offset)[0] for offset in ttl_offsets)
+
+def _load_cached_response(key, data, include_stale):
+    if not data:
+        return None
+    cached = _decode_cached_response(data)
+    remaining = cached_response_ttl(cached[2], cached[1]) - (time.time() - cached[0])
+    if remaining > 0:
+        get_local_cache().set(('wire', key), cached, remaining)
+    elif not include_stale:
+        return None
+    return cached
+
+def get_cached_response(qname, qtype, qclass=1, include_stale=False):
+    """
+    Get a cached wire-format response.
+    Returns (stored_at, ttl_offsets, packet) or None on miss. Expired
+    responses still within the serve-stale window are only returned when
+    include_stale is set.
+    """
+    key = generate_response_key(qname, qtype, qclass)
+    cached = get_local_cache().get(('wire', key))
+    if cached is not None:
+        return cached
+    try:
+        return _load_cached_response(key, get_redis_client().get(key), include_stale)
+    except Exception:
+        return None
+
+async def get_cached_response_async(qname, qtype, qclass=1, include_stale=False):
+    """get_cached_response for asyncio code"""
+    key = generate_response_key(qname, qtype, qclass)
+    cached = get_local_cache().get(('wire', key))
+    if cached is not None:
+        return cached
+    try:
+        data = await get_async_redis_client().get(key)
+        return _load_cached_response(key, data, include_stale)
+    except Exception:
+        return None
+
+def _plan_cache_batch(questions, wire_mode):
+    """
+    Answer what the L1 cache can for get_cached_batch and list the Redis keys
+    still needed as (question index, kind, redis key, L1 key).
+    """
+    local_cache = get_local_cache()
+    results = [[[], None, None] for _ in questions]
+    pending = []
+    for index, (domain, record_type) in enumerate(questions):
+        if wire_mode:
+            key = generate_response_key(domain, TYPE_CODE[record_type])
+            cached = local_cache.get(('wire', key))
+            if cached is not None:
+                results[index][2] = cached
+            else:
+                pending.append((index, 'wire', key, key))
+            continue
+        local_key = _local_key(domain, record_type)
+        records = local_cache.get(local_key)
+        if records is not None:
+            results[index][0] = records
+            continue
+        negative = local_cache.get(('neg',) + local_key)
+        if negative is not None:
+            results[index][1] = negative
+            continue
+        pending.append((index, 'rrset', generate_rrset_key(domain, record_type), local_key))
+        pending.append((index, 'neg', generate_negative_key(domain, record_type), ('neg',) + local_key))
+    return results, pending
+
+def _apply_cache_batch(results, pending, values):
+    local_cache = get_local_cache()
+    now = time.time()
+    for (index, kind, key, local_key), data in zip(pending, values):
+        try:
+            if kind == 'wire':
+                results[index][2] = _load_cached_response(key, data, False)
+            elif kind == 'neg':
+                results[index][1] = _load_negative_entry(local_key, data)
+            else:
+                records = _decode_rrset(data, now)
+                if records:
+                    local_cache.set(local_key, records, _remaining_ttl(records))
+                results[index][0] = records
+        except (ValueError, struct.error):
+            continue
+    return [tuple(result) for result in results]
+
+def get_cached_batch(questions, wire_mode=False):
+    """
+    Cache lookups for many (domain, record type) questions in one pipelined
+    round trip. Returns one (records, negative entry, wire response) tuple
+    per question, as get_cached_records, get_negative_entry and
+    get_cached_response would (only the wire response is looked up in wire
+    mode). ANY questions are not supported; use get_cached_records_any.
+    """
+    results, pending = _plan_cache_batch(questions, wire_mode)
+    if not pending:
+        return [tuple(result) for result in results]
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for _, _, key, _ in pending:
+            pipe.get(key)
+        values = pipe.execute()
+    except Exception:
+        values = [None] * len(pending)
+    return _apply_cache_batch(results, pending, values)
+
+async def get_cached_batch_async(questions, wire_mode=False):
+    """get_cached_batch for asyncio code"""
+    results, pending = _plan_cache_batch(questions, wire_mode)
+    if not pending:
+        return [tuple(result) for result in results]
+    try:
+        pipe = get_async_redis_client().pipeline(transaction=False)
+        for _, _, key, _ in pending:
+            pipe.get(key)
+        values = await pipe.execute()
+    except Exception:
+        values = [None] * len(pending)
+    return _apply_cache_batch(results, pending, values)
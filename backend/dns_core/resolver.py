@@ -1,76 +1,131 @@
-import socket
+import contextvars
 import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import timedelta
 from django.utils import timezone
-from .packet import parse_qname, build_response, TYPE_MAP, build_query, parse_dns_response
+from django.conf import settings
+from .packet import (
+    parse_qname, build_response, RR_TYPE_MAP, TYPE_CODE, build_query, parse_dns_response, Message,
+    patch_cached_response, skip_name, set_edns_payload, strip_opt_record
+)
 from .records import UPSTREAM_SERVERS
-from records.models import DNSRecord
 from .redis_cache import (
     get_cached_records,
     get_cached_records_any,
-    cache_record,
-    delete_cached_records
+    get_stale_records,
+    get_stale_window,
+    cache_rrsets,
+    get_cache_mode,
+    get_cached_response,
+    cached_response_ttl,
+    cache_response,
+    cache_negative,
+    get_negative_entry,
+    get_cached_batch,
+    normalize_domain
 )
+from .manual_records import get_manual_records
+from .upstream import get_upstream_client
+from .prefetch import get_prefetcher
+from .singleflight import SingleFlight, acquire_lock, release_lock, wait_for_lock_release
 from .logger import log_dns_query
+from .metrics import timed
+from .tracing import traced, annotate
+
+# Coalesces concurrent upstream queries for the same (qname, qtype, qclass)
+_upstream_flights = SingleFlight()
+
+# Retries in the background the upstream queries that missed the client
+# deadline when serving stale
+_refresh_queue = None
+_refresh_queue_lock = threading.Lock()
+
+# Resolves the upstream misses of batch DNS-JSON requests concurrently
+_batch_executor = None
 
+@traced
 def resolve_dns(data, client_ip=None, source='binary'):
     transaction_id = data[:2]
     offset = 12
-    domain, offset = parse_qname(data, offset)
-    qtype, qclass = struct.unpack("!HH", data[offset:offset + 4])
+    with timed('parse'):
+        domain, offset = parse_qname(data, offset)
+        qtype, qclass = struct.unpack("!HH", data[offset:offset + 4])
     question_section = data[12:offset + 4]
-    qtype_name = TYPE_MAP.get(qtype, str(qtype))
+    qtype_name = RR_TYPE_MAP.get(qtype, str(qtype))
+    annotate(domain=domain, type=qtype_name, source=source)
+    wire_mode = get_cache_mode() == 'wire'
 
     # Check Redis cache first
     cached_records = []
-    if qtype_name == "ANY":
-        cached_records = get_cached_records_any(domain)
-    else:
-        cached_records = get_cached_records(domain, qtype_name)
+    with timed('cache'):
+        if wire_mode:
+            pass  # Whole responses are cached; checked after manual records
+        elif qtype_name == "ANY":
+            cached_records = get_cached_records_any(domain)
+        else:
+            cached_records = get_cached_records(domain, qtype_name)
     
-    # Also check manual records from database
-    manual_records = []
-    if qtype_name == "ANY":
-        manual_records = DNSRecord.objects.filter(domain=domain, is_manual=True)
-    else:
-        manual_records = DNSRecord.objects.filter(domain=domain, record_type=qtype_name, is_manual=True)
+    if cached_records:
+        _maybe_prefetch(domain, qtype, qclass, qtype_name, wire_mode,
+                        *_records_lifetime(cached_records))
+
+    # Also check manual records (in-memory index, kept in sync with the database)
+    with timed('manual'):
+        manual_records = get_manual_records(domain, qtype_name)
     
     # Combine cached and manual records
-    answers = []
-    from_cache = False
-    for record in cached_records:
-        answers.append({
-            "type": record["record_type"],
-            "value": record["value"],
-            "ttl": record["ttl"],  # Redis TTL is handled by Redis expiration
-            "priority": record.get("priority"),
-        })
-        from_cache = True
+    answers = _cached_answers(cached_records)
+    from_cache = bool(answers)
     
     for record in manual_records:
-        answers.append({
-            "type": record.record_type,
-            "value": record.value,
-            "ttl": record.ttl,
-            "priority": record.priority,
-        })
+        answers.append(record)  # Already in answer shape, with pre-encoded rdata
         from_cache = True
     
     if answers:
-        response = build_response(transaction_id, question_section, answers)
+        with timed('build'):
+            response = build_response(transaction_id, question_section, answers)
         log_dns_query(domain, qtype_name, source=source, status='success', 
                      answer_count=len(answers), from_cache=from_cache, client_ip=client_ip)
         return response
+
+    if wire_mode:
+        with timed('cache'):
+            cached = get_cached_response(domain, qtype, qclass)
+        if cached:
+            stored_at, ttl_offsets, packet = cached
+            elapsed = int(time.time() - stored_at)
+            with timed('build'):
+                response = patch_cached_response(
+                    packet, ttl_offsets, elapsed, transaction_id, question_section
+                )
+            ttl = cached_response_ttl(packet, ttl_offsets)
+            _maybe_prefetch(domain, qtype, qclass, qtype_name, wire_mode, ttl - elapsed, ttl)
+            log_dns_query(domain, qtype_name, source=source,
+                         status='nxdomain' if response[3] & 0x0F == 3 else 'success',
+                         answer_count=struct.unpack_from("!H", response, 6)[0],
+                         from_cache=True, client_ip=client_ip)
+            return response
+    else:
+        with timed('cache'):
+            negative = get_negative_entry(domain, qtype_name)
+        if negative:
+            rcode, authority = _negative_answer(negative)
+            log_dns_query(domain, qtype_name, source=source,
+                         status='nxdomain' if rcode == 3 else 'success',
+                         answer_count=0, from_cache=True, client_ip=client_ip)
+            return build_response(transaction_id, question_section, [], rcode=rcode,
+                                  authority=authority)
     
     # Forward to upstream if no valid cached records
-    response = forward_to_upstream(data)
+    with timed('upstream'):
+        response, stale = resolve_miss(data, domain, qtype, qclass, qtype_name, wire_mode)
     if response:
-        # Cache the upstream response
-        cache_upstream_response(domain, qtype_name, response)
-        parsed = parse_dns_response(response)
-        log_dns_query(domain, qtype_name, source=source, status='success', 
-                     answer_count=len(parsed.get('Answer', [])), 
-                     from_cache=False, client_ip=client_ip)
+        log_dns_query(domain, qtype_name, source=source,
+                     status=_query_status(response[3] & 0x0F, stale),
+                     answer_count=struct.unpack_from("!H", response, 6)[0], 
+                     from_cache=stale, client_ip=client_ip)
         return response
 
     # NXDOMAIN if nothing found
@@ -79,33 +134,331 @@ def resolve_dns(data, client_ip=None, source='binary'):
     return build_response(transaction_id, question_section, [], rcode=3)
 
 
-def forward_to_upstream(data):
-    for server, port in UPSTREAM_SERVERS:
+def resolve_miss(data, domain, qtype, qclass, qtype_name, wire_mode):
+    """
+    Resolve a cache miss upstream, falling back to stale data (RFC 8767).
+
+    If expired data for the question is still within the serve-stale window,
+    the upstream query runs on the caller's thread with a deadline of
+    DNS_SERVE_STALE_CLIENT_TIMEOUT seconds; when it is slower, fails or
+    returns SERVFAIL/REFUSED the stale answer is served with a short TTL. A
+    query left unanswered is retried on the background refresh queue.
+    Returns (response, served_stale).
+    """
+    stale = _stale_response(data, domain, qtype, qclass, qtype_name, wire_mode)
+    if stale is None:
+        return resolve_upstream(data, domain, qtype, qclass, qtype_name, wire_mode), False
+
+    deadline = time.monotonic() + getattr(settings, 'DNS_SERVE_STALE_CLIENT_TIMEOUT', 1.8)
+    try:
+        response = resolve_upstream(data, domain, qtype, qclass, qtype_name, wire_mode, deadline)
+    except Exception:
+        response = None
+    if not response:
+        _get_refresh_queue().submit(
+            (normalize_domain(domain), qtype, qclass),
+            lambda: resolve_upstream(data, domain, qtype, qclass, qtype_name, wire_mode)
+        )
+        return stale, True
+    if struct.unpack("!H", response[2:4])[0] & 0x000F in (2, 5):
+        return stale, True
+    return response, False
+
+
+class RefreshQueue:
+    """
+    Background upstream refreshes on a small thread pool. At most one refresh
+    per key is queued or running, and at most max_pending altogether: others
+    are coalesced or dropped, so an upstream outage cannot pile up work.
+    """
+
+    def __init__(self, max_workers=8, max_pending=256):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dns-refresh')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.counters = {'scheduled': 0, 'coalesced': 0, 'dropped': 0}
+
+    def submit(self, key, refresh):
+        """Run refresh() in the background unless key is pending or the queue is full"""
+        with self._lock:
+            if key in self._pending:
+                self.counters['coalesced'] += 1
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.counters['dropped'] += 1
+                return False
+            self._pending.add(key)
+            self.counters['scheduled'] += 1
+        self.executor.submit(self._run, key, refresh)
+        return True
+
+    def _run(self, key, refresh):
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(2)
-            sock.sendto(data, (server, port))
-            resp, _ = sock.recvfrom(512)
-            sock.close()
-            return resp
+            refresh()
         except Exception:
-            continue
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=len(self._pending))
+
+
+def get_refresh_stats():
+    """Counters of this process's serve-stale refresh queue (empty if it was never used)"""
+    return _refresh_queue.stats() if _refresh_queue is not None else {}
+
+def _get_refresh_queue():
+    global _refresh_queue
+    with _refresh_queue_lock:
+        if _refresh_queue is None:
+            _refresh_queue = RefreshQueue(
+                max_workers=getattr(settings, 'DNS_SERVE_STALE_WORKERS', 8),
+                max_pending=getattr(settings, 'DNS_SERVE_STALE_QUEUE_SIZE', 256),
+            )
+        return _refresh_queue
+
+def _stale_response(data, domain, qtype, qclass, qtype_name, wire_mode):
+    """Build an answer from expired cache data kept for serve-stale, or None"""
+    if not get_stale_window():
+        return None
+    if wire_mode:
+        return _stale_from_wire(data, get_cached_response(domain, qtype, qclass, include_stale=True))
+    if qtype_name == "ANY":
+        return None
+    return _stale_from_records(data, get_stale_records(domain, qtype_name))
+
+def _stale_from_wire(data, cached):
+    if not cached:
+        return None
+    _, ttl_offsets, packet = cached
+    return patch_cached_response(
+        packet, ttl_offsets, 0, data[:2], _question_section(data),
+        fixed_ttl=getattr(settings, 'DNS_SERVE_STALE_TTL', 30)
+    )
+
+def _stale_from_records(data, records):
+    if not records:
+        return None
+    answers = _cached_answers(records)
+    for answer in answers:
+        answer["ttl"] = getattr(settings, 'DNS_SERVE_STALE_TTL', 30)
+    return build_response(data[:2], _question_section(data), answers)
+
+def resolve_upstream(data, domain, qtype, qclass, qtype_name, wire_mode, deadline=None):
+    """
+    Forward a query upstream and cache the reply, coalescing concurrent misses
+    for the same question: only one upstream query is outstanding per process
+    (and, with DNS_SINGLEFLIGHT_REDIS_LOCK, per cluster) and the other callers
+    get the same answer under their own transaction ID. Returns None once the
+    deadline (a time.monotonic() value) has passed.
+    """
+    key = (normalize_domain(domain), qtype, qclass)
+    response, shared = _upstream_flights.do(
+        key, lambda: _fetch_and_cache(data, domain, qtype, qclass, qtype_name, wire_mode, deadline),
+        deadline
+    )
+    if response and shared:
+        response = patch_cached_response(response, (), 0, data[:2], _question_section(data))
+    return response
+
+def _query_status(rcode, stale=False):
+    """Query log status of an upstream (or stale) answer"""
+    if rcode == 3:
+        return 'nxdomain'
+    if rcode:
+        return 'error'
+    return 'stale' if stale else 'success'
+
+def _records_lifetime(records):
+    """Return (remaining seconds, TTL) of the record that expires first"""
+    now = time.time()
+    lifetimes = [
+        (record["cached_at"] + record["ttl"] - now, record["ttl"])
+        for record in records
+        if record.get("cached_at") is not None
+    ]
+    return min(lifetimes) if lifetimes else (0, 0)
+
+def _maybe_prefetch(domain, qtype, qclass, qtype_name, wire_mode, remaining, ttl):
+    """Refresh a popular cache entry in the background when it is about to expire"""
+    prefetcher = get_prefetcher()
+    if prefetcher is None or qclass != 1 or qtype_name not in TYPE_CODE:
+        return
+
+    def refresh():
+        _, query = build_query(domain, qtype_name)
+        return resolve_upstream(query, domain, qtype, qclass, qtype_name, wire_mode) is not None
+
+    prefetcher.observe((normalize_domain(domain), qtype, qclass), remaining, ttl, refresh)
+
+def _question_section(data):
+    return data[12:skip_name(data, 12) + 4]
+
+def _fetch_and_cache(data, domain, qtype, qclass, qtype_name, wire_mode, deadline=None):
+    lock_name = token = None
+    if getattr(settings, 'DNS_SINGLEFLIGHT_REDIS_LOCK', False):
+        lock_ttl = getattr(settings, 'DNS_SINGLEFLIGHT_LOCK_TTL', 3.0)
+        lock_name = f"{normalize_domain(domain)}:{qtype}:{qclass}"
+        token = acquire_lock(lock_name, lock_ttl)
+        if token is None:
+            # Another process is fetching this name; wait for it to fill the cache
+            if deadline is not None:
+                lock_ttl = max(min(lock_ttl, deadline - time.monotonic()), 0)
+            wait_for_lock_release(lock_name, lock_ttl)
+            response = _response_from_cache(data, domain, qtype, qclass, qtype_name, wire_mode)
+            if response:
+                return response
+    try:
+        with timed('forward'):
+            response = forward_to_upstream(data, deadline)
+        if response:
+            with timed('cache_write'):
+                cache_upstream(domain, qtype, qclass, qtype_name, wire_mode, response)
+        return response
+    finally:
+        if token is not None:
+            release_lock(lock_name, token)
+
+def _response_from_cache(data, domain, qtype, qclass, qtype_name, wire_mode):
+    """Answer a query from the cache only (used after waiting on another process)"""
+    if wire_mode:
+        cached = get_cached_response(domain, qtype, qclass)
+        if not cached:
+            return None
+        stored_at, ttl_offsets, packet = cached
+        return patch_cached_response(
+            packet, ttl_offsets, int(time.time() - stored_at), data[:2], _question_section(data)
+        )
+    if qtype_name == "ANY":
+        records = get_cached_records_any(domain)
+    else:
+        records = get_cached_records(domain, qtype_name)
+    if records:
+        return build_response(data[:2], _question_section(data), _cached_answers(records))
+    negative = get_negative_entry(domain, qtype_name)
+    if negative:
+        rcode, authority = _negative_answer(negative)
+        return build_response(data[:2], _question_section(data), [], rcode=rcode,
+                              authority=authority)
     return None
 
+def _remaining_ttl(record, now):
+    """TTL of a cached record counted down from when it was cached"""
+    if record.get("cached_at") is None:
+        return record["ttl"]
+    return max(int(record["cached_at"] + record["ttl"] - now), 0)
+
+def _cached_answers(records):
+    """Convert cached records into build_response answers, TTLs decayed"""
+    now = time.time()
+    return [
+        {
+            "type": record["record_type"],
+            "value": record["value"],
+            "ttl": _remaining_ttl(record, now),
+            "priority": record.get("priority"),
+        }
+        for record in records
+    ]
+
+def _negative_answer(negative):
+    """Return (rcode, authority records) for a cached negative answer, TTLs decayed"""
+    ttl = max(int(negative["cached_at"] + negative["ttl"] - time.time()), 0)
+    soa = negative.get("soa")
+    if not soa:
+        return negative["rcode"], []
+    return negative["rcode"], [{
+        "name": soa["name"],
+        "type": "SOA",
+        "value": soa["data"],
+        "ttl": min(soa["ttl"], ttl),
+    }]
+
+def _negative_ttl(message):
+    """
+    TTL for caching a negative answer (RFC 2308): min(SOA TTL, SOA MINIMUM)
+    of the authority SOA, capped by DNS_NEGATIVE_CACHE_MAX_TTL.
+    Returns (ttl, SOA record dict) or (0, None) when it must not be cached.
+    """
+    max_ttl = getattr(settings, 'DNS_NEGATIVE_CACHE_MAX_TTL', 3600)
+    for record in message.authority:
+        soa = record.to_dict() if record.rtype == 6 else None
+        if not soa or not soa["data"]:
+            continue
+        minimum = int(soa["data"].split()[6])
+        return min(soa["ttl"], minimum, max_ttl), soa
+    return 0, None
+
+def forward_to_upstream(data, deadline=None):
+    """
+    Forward a query over the shared upstream socket pool; None if nobody answered
+    (before the deadline, a time.monotonic() value, if given).
+    The query advertises DNS_EDNS_UDP_PAYLOAD bytes (EDNS0) and truncated
+    replies are retried over TCP. The OPT record is stripped from the reply.
+    """
+    try:
+        udp_payload = getattr(settings, 'DNS_EDNS_UDP_PAYLOAD', 1232)
+        if udp_payload:
+            data = set_edns_payload(data, udp_payload)
+        client = get_upstream_client(UPSTREAM_SERVERS)
+        response = client.query(data, deadline)
+        if response and response[2] & 0x02:
+            response = client.query_tcp(data, deadline) or response
+        return strip_opt_record(response) if response else None
+    except Exception:
+        return None
+
+def cache_upstream(domain, qtype, qclass, qtype_name, wire_mode, response_data):
+    """Cache an upstream reply in the configured cache mode"""
+    if wire_mode:
+        cache_upstream_packet(domain, qtype, qclass, response_data)
+    else:
+        cache_upstream_response(domain, qtype_name, response_data)
+
+def cache_upstream_packet(domain, qtype, qclass, response_data):
+    """Cache a raw upstream response in wire format (DNS_CACHE_MODE = 'wire')"""
+    flags = struct.unpack("!H", response_data[2:4])[0]
+    rcode = flags & 0x000F
+    if rcode not in (0, 3) or flags & 0x0200:
+        return  # Don't cache errors or truncated answers
+    if rcode == 3 or struct.unpack("!H", response_data[6:8])[0] == 0:
+        # NXDOMAIN/NODATA: cache for the negative TTL, if there is an SOA
+        try:
+            ttl, _ = _negative_ttl(Message.parse(response_data))
+        except Exception:
+            return
+        if ttl > 0:
+            cache_response(domain, qtype, qclass, response_data, max_ttl=ttl)
+        return
+    cache_response(domain, qtype, qclass, response_data)
+
 def cache_upstream_response(domain, qtype_name, response_data):
     """Cache upstream DNS response in Redis"""
     try:
-        parsed = parse_dns_response(response_data)
-        if parsed.get("Status") != 0:
+        message = Message.parse(response_data)
+        if message.flags & 0x0200:
+            return  # Don't cache truncated answers
+        if message.rcode in (0, 3) and not message.answers:
+            # NXDOMAIN/NODATA: remember the negative answer (RFC 2308)
+            ttl, soa = _negative_ttl(message)
+            if ttl > 0:
+                cache_negative(domain, qtype_name, message.rcode,
+                               {"name": soa["name"], "ttl": soa["ttl"], "data": soa["data"]}, ttl)
+            return
+        if message.rcode != 0:
             return  # Don't cache errors
 
-        # Collect all answers first (cache all types, not just the queried type)
-        answers = []
-        for answer in parsed.get("Answer", []):
-            answer_domain = answer.get("name", domain)
-            record_type = answer.get("type")
-            value = answer.get("data")
-            ttl = answer.get("ttl", 60)
+        # Group answers into RRsets (cache all types, not just the queried type)
+        rrsets = {}
+        for answer in message.answers:
+            answer_domain = answer.name
+            record_type = answer.type_name
+            value = answer.value()
+            ttl = answer.ttl
             
             if not value:
                 continue
@@ -121,83 +474,226 @@ def cache_upstream_response(domain, qtype_name, response_data):
                     except ValueError:
                         pass
 
-            answers.append((answer_domain, record_type, value, ttl, priority))
-
-        # Delete existing cached records per (domain, type) once
-        to_delete = set((a[0], a[1]) for a in answers)
-        for d_domain, d_type in to_delete:
-            delete_cached_records(d_domain, d_type)
+            rrsets.setdefault((answer_domain, record_type), []).append((value, ttl, priority))
 
-        # Cache all records in Redis
-        for answer_domain, record_type, value, ttl, priority in answers:
-            cache_record(answer_domain, record_type, value, ttl, priority)
+        # Replace each cached (domain, type) RRset in a single pipelined write
+        if rrsets:
+            cache_rrsets(rrsets)
     except Exception:
         # Silently fail caching to not break DNS resolution
         pass
 
+def _json_answers(domain, cached_records, manual_records):
+    """DNS-JSON answers for cached (TTLs decayed) and manual records"""
+    now = time.time()
+    answers = [
+        {"name": domain, "type": record["record_type"], "ttl": _remaining_ttl(record, now),
+         "data": record["value"]}
+        for record in cached_records
+    ]
+    answers.extend(
+        {"name": domain, "type": record["type"], "ttl": record["ttl"], "data": record["value"]}
+        for record in manual_records
+    )
+    return answers
+
+def _json_negative(domain, qtype_name, negative):
+    """DNS-JSON result for a cached negative answer"""
+    rcode, authority = _negative_answer(negative)
+    return {
+        "Status": rcode,
+        "Question": [{"name": domain, "type": qtype_name}],
+        "Answer": [],
+        "Authority": [
+            {"name": record["name"], "type": "SOA", "ttl": record["ttl"], "data": record["value"]}
+            for record in authority
+        ],
+    }
+
+@traced
 def resolve_dns_json(domain, qtype_name, client_ip=None):
     # Check local records first
     if not domain.endswith("."):
         domain = domain + "."
-    
+    annotate(domain=domain, type=qtype_name)
+    qtype = TYPE_CODE[qtype_name]
+    wire_mode = get_cache_mode() == 'wire'
+
     # Check Redis cache first
     cached_records = []
-    if qtype_name == "ANY":
-        cached_records = get_cached_records_any(domain)
-    else:
-        cached_records = get_cached_records(domain, qtype_name)
-    
-    # Also check manual records from database
-    manual_records = []
-    if qtype_name == "ANY":
-        manual_records = DNSRecord.objects.filter(domain=domain, is_manual=True)
+    with timed('cache'):
+        if wire_mode:
+            pass  # Whole responses are cached; checked after manual records
+        elif qtype_name == "ANY":
+            cached_records = get_cached_records_any(domain)
+        else:
+            cached_records = get_cached_records(domain, qtype_name)
+
+    # Also check manual records (in-memory index, kept in sync with the database)
+    with timed('manual'):
+        manual_records = get_manual_records(domain, qtype_name)
+    result = _json_from_records(domain, qtype, qtype_name, wire_mode, cached_records,
+                                manual_records, client_ip)
+    if result:
+        return result
+
+    with timed('cache'):
+        if wire_mode:
+            cached = get_cached_response(domain, qtype)
+        else:
+            negative = get_negative_entry(domain, qtype_name)
+    if wire_mode:
+        result = _json_from_wire(domain, qtype, qtype_name, cached, client_ip)
     else:
-        manual_records = DNSRecord.objects.filter(domain=domain, record_type=qtype_name, is_manual=True)
-    
-    # Combine cached and manual records
-    answers = []
-    from_cache = False
-    for record in cached_records:
-        answers.append({
-            "name": domain,
-            "type": record["record_type"],
-            "ttl": record["ttl"],
-            "data": record["value"],
-        })
-        from_cache = True
-    
-    for record in manual_records:
-        answers.append({
-            "name": domain,
-            "type": record.record_type,
-            "ttl": record.ttl,
-            "data": record.value,
-        })
-        from_cache = True
-    
-    if answers:
-        result = {
-            "Status": 0,
-            "Question": [{"name": domain, "type": qtype_name}],
-            "Answer": answers,
-        }
-        log_dns_query(domain, qtype_name, source='doh-json', status='success', 
-                     answer_count=len(answers), from_cache=from_cache, client_ip=client_ip)
+        result = _json_from_negative(domain, qtype_name, negative, client_ip)
+    if result:
         return result
-    
+
     # Forward to upstream if no valid cached records
     _, query = build_query(domain, qtype_name)
-    response = forward_to_upstream(query)
+    with timed('upstream'):
+        response, stale = resolve_miss(query, domain, qtype, 1, qtype_name, wire_mode)
+    return _json_from_upstream(domain, qtype_name, response, stale, client_ip)
+
+@traced
+def resolve_dns_json_batch(questions, client_ip=None):
+    """
+    Resolve many (name, type) questions for the batch DNS-JSON endpoint.
+    Cache lookups for all of them share one Redis pipeline and the misses are
+    resolved upstream concurrently. Returns results in question order, each
+    shaped like resolve_dns_json's.
+    """
+    questions = [(domain if domain.endswith(".") else domain + ".", qtype_name)
+                 for domain, qtype_name in questions]
+    wire_mode = get_cache_mode() == 'wire'
+    unique = list(dict.fromkeys(questions))
+    annotate(questions=len(questions))
+    batched = [question for question in unique if question[1] != "ANY"]
+    with timed('cache'):
+        cached = dict(zip(batched, get_cached_batch(batched, wire_mode)))
+
+    results = {}
+    misses = []
+    for domain, qtype_name in unique:
+        qtype = TYPE_CODE[qtype_name]
+        if qtype_name == "ANY":
+            cached_records, negative, wire = get_cached_records_any(domain), None, None
+        else:
+            cached_records, negative, wire = cached[(domain, qtype_name)]
+        result = (
+            _json_from_records(domain, qtype, qtype_name, wire_mode, cached_records,
+                               get_manual_records(domain, qtype_name), client_ip)
+            or _json_from_wire(domain, qtype, qtype_name, wire, client_ip)
+            or _json_from_negative(domain, qtype_name, negative, client_ip)
+        )
+        if result:
+            results[(domain, qtype_name)] = result
+        else:
+            misses.append((domain, qtype_name))
+
+    if misses:
+        # Each miss runs in a copy of this context so its spans join the batch's trace
+        futures = [
+            _get_batch_executor().submit(
+                contextvars.copy_context().run, _resolve_json_miss, domain, qtype_name, wire_mode
+            )
+            for domain, qtype_name in misses
+        ]
+        # Misses still unresolved at the deadline keep running and fill the cache
+        deadline = time.monotonic() + getattr(settings, 'DNS_BATCH_TIMEOUT', 5)
+        for (domain, qtype_name), future in zip(misses, futures):
+            try:
+                response, stale = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeout:
+                results[(domain, qtype_name)] = _json_servfail(domain, qtype_name, client_ip)
+                continue
+            results[(domain, qtype_name)] = _json_from_upstream(
+                domain, qtype_name, response, stale, client_ip
+            )
+    return [results[question] for question in questions]
+
+def _get_batch_executor():
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'DNS_BATCH_WORKERS', 16),
+            thread_name_prefix='dns-batch'
+        )
+    return _batch_executor
+
+def _resolve_json_miss(domain, qtype_name, wire_mode):
+    _, query = build_query(domain, qtype_name)
+    try:
+        with timed('upstream'):
+            return resolve_miss(query, domain, TYPE_CODE[qtype_name], 1, qtype_name, wire_mode)
+    except Exception:
+        return None, False
+
+def _json_from_records(domain, qtype, qtype_name, wire_mode, cached_records, manual_records,
+                       client_ip):
+    """DNS-JSON result for cached and manual records, or None if there are none"""
+    if cached_records:
+        _maybe_prefetch(domain, qtype, 1, qtype_name, wire_mode,
+                        *_records_lifetime(cached_records))
+    answers = _json_answers(domain, cached_records, manual_records)
+    if not answers:
+        return None
+    log_dns_query(domain, qtype_name, source='doh-json', status='success',
+                 answer_count=len(answers), from_cache=True, client_ip=client_ip)
+    return {
+        "Status": 0,
+        "Question": [{"name": domain, "type": qtype_name}],
+        "Answer": answers,
+    }
+
+def _json_from_wire(domain, qtype, qtype_name, cached, client_ip):
+    """DNS-JSON result for a cached wire-format response, or None"""
+    if not cached:
+        return None
+    stored_at, ttl_offsets, packet = cached
+    elapsed = int(time.time() - stored_at)
+    response = patch_cached_response(packet, ttl_offsets, elapsed, packet[:2])
+    ttl = cached_response_ttl(packet, ttl_offsets)
+    _maybe_prefetch(domain, qtype, 1, qtype_name, True, ttl - elapsed, ttl)
+    result = parse_dns_response(response)
+    log_dns_query(domain, qtype_name, source='doh-json',
+                 status='nxdomain' if result['Status'] == 3 else 'success',
+                 answer_count=len(result.get('Answer', [])),
+                 from_cache=True, client_ip=client_ip)
+    return result
+
+def _json_from_negative(domain, qtype_name, negative, client_ip):
+    """DNS-JSON result for a cached negative answer, or None"""
+    if not negative:
+        return None
+    result = _json_negative(domain, qtype_name, negative)
+    log_dns_query(domain, qtype_name, source='doh-json',
+                 status='nxdomain' if result["Status"] == 3 else 'success',
+                 answer_count=0, from_cache=True, client_ip=client_ip)
+    return result
+
+def _json_servfail(domain, qtype_name, client_ip):
+    """DNS-JSON SERVFAIL for a batch question not resolved before the batch deadline"""
+    log_dns_query(domain, qtype_name, source='doh-json', status='error',
+                 answer_count=0, from_cache=False, client_ip=client_ip)
+    return {
+        "Status": 2,
+        "Question": [{"name": domain, "type": qtype_name}],
+        "Answer": [],
+    }
+
+def _json_from_upstream(domain, qtype_name, response, stale, client_ip):
+    """DNS-JSON result for an upstream (or stale) response; NXDOMAIN if there is none"""
     if response:
-        # Cache the upstream response
-        cache_upstream_response(domain, qtype_name, response)
         result = parse_dns_response(response)
-        log_dns_query(domain, qtype_name, source='doh-json', status='success', 
-                     answer_count=len(result.get('Answer', [])), 
-                     from_cache=False, client_ip=client_ip)
+        log_dns_query(domain, qtype_name, source='doh-json',
+                     status=_query_status(result['Status'], stale),
+                     answer_count=len(result.get('Answer', [])),
+                     from_cache=stale, client_ip=client_ip)
         return result
-    
-    log_dns_query(domain, qtype_name, source='doh-json', status='nxdomain', 
+
+    # NXDOMAIN if nothing found
+    log_dns_query(domain, qtype_name, source='doh-json', status='nxdomain',
                  answer_count=0, from_cache=False, client_ip=client_ip)
     return {
         "Status": 3,
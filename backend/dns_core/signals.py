@@ -0,0 +1,17 @@
+"""
+Keep the in-memory manual record index in sync with DNSRecord changes.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from records.models import DNSRecord
+from .manual_records import get_manual_index
+
+
+@receiver(post_save, sender=DNSRecord)
+def dns_record_saved(sender, instance, **kwargs):
+    get_manual_index().update_record(instance)
+
+
+@receiver(post_delete, sender=DNSRecord)
+def dns_record_deleted(sender, instance, **kwargs):
+    get_manual_index().remove_record(instance.id)
@@ -0,0 +1,105 @@
+"""
+Request coalescing for concurrent identical cache misses.
+Within a process only one upstream query per key is outstanding and every
+other caller waits for its result. Across processes a short Redis lock lets
+one process fetch while the others wait for the cache to be filled.
+"""
+import os
+import threading
+import time
+from .redis_cache import get_redis_client
+
+LOCK_KEY_PREFIX = "dns:lock:upstream:"
+
+# Delete the lock only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls that share a key"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, deadline=None):
+        """
+        Run fn() unless a call for key is already in flight, in which case
+        wait for it. Returns (result, shared) where shared is True for waiters;
+        a waiter that reaches the deadline (a time.monotonic() value) first
+        gets (None, True).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not call.event.wait(timeout):
+                return None, True
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+def acquire_lock(name, ttl):
+    """
+    Try to take a short cross-process lock for ttl seconds.
+    Returns the lock token, or None if another process holds it.
+    Also returns a token if Redis is unavailable, so callers just proceed.
+    """
+    token = os.urandom(8).hex()
+    try:
+        if get_redis_client().set(LOCK_KEY_PREFIX + name, token, nx=True, px=int(ttl * 1000)):
+            return token
+        return None
+    except Exception:
+        return token
+
+def release_lock(name, token):
+    try:
+        get_redis_client().eval(_RELEASE_SCRIPT, 1, LOCK_KEY_PREFIX + name, token)
+    except Exception:
+        pass
+
+def wait_for_lock_release(name, timeout, poll_interval=0.01):
+    """Wait until the lock is released (or expires); returns False on timeout"""
+    deadline = time.monotonic() + timeout
+    try:
+        r = get_redis_client()
+        while time.monotonic() < deadline:
+            if not r.exists(LOCK_KEY_PREFIX + name):
+                return True
+            time.sleep(poll_interval)
+    except Exception:
+        return True
+    return False
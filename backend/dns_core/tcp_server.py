@@ -1,37 +1,120 @@
+import asyncio
 import socket
 import struct
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .packet import apply_edns
 from .resolver import resolve_dns
 from .logger import log_system_event
 
 DNS_PORT = 8053
 
-def start_tcp_server():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(("0.0.0.0", DNS_PORT))
-    sock.listen(5)
-    print(f"TCP DNS server listening on port {DNS_PORT}")
-    log_system_event('server_start', f'TCP DNS server started on port {DNS_PORT}')
 
-    while True:
-        conn, addr = sock.accept()
+class DNSTCPServer:
+    """
+    Concurrent TCP DNS server (RFC 7766).
+
+    Connections stay open for several queries. Every length-prefixed message
+    read from a connection is resolved as its own task, so pipelined queries
+    are answered out of order as they finish. Idle connections are closed
+    after DNS_TCP_IDLE_TIMEOUT seconds and at most DNS_TCP_MAX_CONNECTIONS are
+    served at once.
+    """
+
+    def __init__(self, max_connections=None, idle_timeout=None, max_concurrency=None,
+                 max_pipeline=None, on_query=None):
+        self.max_connections = max_connections or getattr(settings, 'DNS_TCP_MAX_CONNECTIONS', 1024)
+        self.idle_timeout = idle_timeout or getattr(settings, 'DNS_TCP_IDLE_TIMEOUT', 10)
+        self.max_pipeline = max_pipeline or getattr(settings, 'DNS_TCP_MAX_PIPELINE', 32)
+        max_concurrency = max_concurrency or getattr(settings, 'DNS_TCP_MAX_CONCURRENCY', 128)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='dns-tcp')
+        self.udp_payload = getattr(settings, 'DNS_EDNS_UDP_PAYLOAD', 1232)
+        self.on_query = on_query
+        self.connections = 0
+
+    async def handle_connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.close()
+            return
+        self.connections += 1
+        client_ip = writer.get_extra_info('peername')[0]
+        write_lock = asyncio.Lock()
+        # Bounds the number of queries a single client can have in flight
+        pipeline = asyncio.Semaphore(self.max_pipeline)
+        tasks = set()
         try:
-            length_data = conn.recv(2)
-            if not length_data:
-                conn.close()
-                continue
-            length = struct.unpack("!H", length_data)[0]
-            data = b""
-            while len(data) < length:
-                chunk = conn.recv(length - len(data))
-                if not chunk:
+            while True:
+                try:
+                    length_data = await asyncio.wait_for(reader.readexactly(2), self.idle_timeout)
+                    length = struct.unpack("!H", length_data)[0]
+                    data = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
                     break
-                data += chunk
-            client_ip = addr[0]
-            response = resolve_dns(data, client_ip=client_ip, source='tcp')
-            conn.sendall(struct.pack("!H", len(response)) + response)
+                await pipeline.acquire()
+                task = asyncio.ensure_future(
+                    self.answer(data, client_ip, writer, write_lock, pipeline)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            # Let queries already read finish before closing the connection
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            # The server is shutting down: drop the queries still in flight
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def answer(self, data, client_ip, writer, write_lock, pipeline):
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(
+                self.executor, resolve_dns, data, client_ip, 'tcp'
+            )
+            response = apply_edns(data, response, self.udp_payload, udp=False)
+            async with write_lock:
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+            if self.on_query is not None:
+                self.on_query()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            log_system_event('tcp_error', f'Failed to answer {client_ip}: {e}', level='error')
         finally:
-            conn.close()
+            pipeline.release()
+
+
+async def serve_tcp(host="0.0.0.0", port=DNS_PORT, reuse_port=False, on_query=None):
+    dns_server = DNSTCPServer(on_query=on_query)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    server = await asyncio.start_server(
+        dns_server.handle_connection,
+        sock=sock,
+        backlog=getattr(settings, 'DNS_TCP_BACKLOG', 1024),
+    )
+    print(f"TCP DNS server listening on port {port}")
+    log_system_event(
+        'server_start',
+        f'TCP DNS server started on port {port} (max connections {dns_server.max_connections})'
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def start_tcp_server(port=DNS_PORT, reuse_port=False, on_query=None):
+    asyncio.run(serve_tcp(port=port, reuse_port=reuse_port, on_query=on_query))
 
 if __name__ == "__main__":
     start_tcp_server()
@@ -1,3 +1,1539 @@
-from django.test import TestCase
+import asyncio
+import errno
+import json
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock, skipUnless
+from django.test import SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+import redis
+
+try:
+    import fakeredis
+    import fakeredis.aioredis
+except ImportError:
+    fakeredis = None
+
+from records.models import DNSRecord
+import logging
+from . import logger as dns_logging, manual_records, metrics, profiler, redis_cache, upstream
+from .query_log import QueryAggregator
+from .log_pipeline import BatchRotatingFileHandler, JSONLineFormatter, LogPipeline
+from . import resolver
+from .resolver import resolve_dns, resolve_dns_json_batch, resolve_upstream
+from .async_resolver import resolve_dns_async, resolve_dns_json_async
+from .singleflight import SingleFlight, acquire_lock, release_lock
+from .udp_server import DNSDatagramProtocol
+from .tcp_server import DNSTCPServer
+from .local_cache import LocalCache
+from .prefetch import Prefetcher
+from .workers import DNSWorkerPool
+from .local_cache import get_local_cache
+from .packet import (
+    build_query, build_response, parse_dns_response, skip_name, find_ttl_offsets,
+    patch_cached_response, apply_edns, parse_edns, set_edns_payload, strip_opt_record,
+    truncate_response, Message, ResourceRecord, MessageWriter, encode_qname,
+)
+
+
+def upstream_reply(answers=(), rcode=0, authority=None):
+    """
+    side_effect for forward_to_upstream: answers each query with the given
+    records (dicts as build_response takes them) under its own ID and question.
+    """
+    def reply(query, deadline=None):
+        question = query[12:skip_name(query, 12) + 4]
+        return build_response(query[:2], question, [dict(answer) for answer in answers],
+                              rcode=rcode, authority=authority)
+    return reply
+
+
+class FakeUpstream:
+    """A UDP DNS server on localhost answering every query with reply(query)"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                query, client = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            self.queries += 1
+            response = self.reply(query)
+            if response:
+                try:
+                    self.sock.sendto(response, client)
+                except OSError:
+                    return  # closed while answering
+
+    def close(self):
+        self.sock.close()
+
+
+def isolate_metrics(test):
+    """Give a test its own metrics registry, so no pusher thread writes into its Redis"""
+    registry = metrics.MetricsRegistry(push_interval=3600)
+    patcher = mock.patch.object(metrics, '_registry', registry)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    test.addCleanup(registry._stopping.set)
+    return registry
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.05)
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class RedisTestCase(TestCase):
+    """Runs each test against an empty in-memory Redis and an empty L1 cache"""
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        for patcher in (
+            mock.patch.object(redis_cache, '_redis_client', self.redis),
+            mock.patch.object(redis_cache, 'get_async_redis_client',
+                              lambda: fakeredis.aioredis.FakeRedis(server=server)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        get_local_cache().clear()
+        self.addCleanup(get_local_cache().clear)
+        self.registry = isolate_metrics(self)
+
+    def patch_upstream(self, *args, **kwargs):
+        """Answer upstream queries with upstream_reply(*args, **kwargs); returns the mock"""
+        patcher = mock.patch('dns_core.resolver.forward_to_upstream',
+                             side_effect=upstream_reply(*args, **kwargs))
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def age_cache(self, seconds):
+        """Make time.time() run `seconds` ahead for the rest of the test"""
+        now = time.time() + seconds
+        patcher = mock.patch('time.time', return_value=now)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+
+class _StopWatcher(BaseException):
+    pass
+
+
+class ProfilerTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(profiler, 'get_profiles_dir', return_value=Path(directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_request_runs_once_per_process(self):
+        request = profiler.request_profile(0.05, interval=0.01)
+        watcher = profiler.ProfileWatcher(poll_interval=0.01)
+        path = watcher.check()
+        self.assertEqual(path.name, f"profile-{request['id']}-{os.getpid()}.txt")
+        self.assertIn('# folded stacks', path.read_text())
+        self.assertIsNone(watcher.check())
+        self.assertEqual(profiler.list_profiles(), [path.name])
+
+    def test_watcher_survives_errors(self):
+        watcher = profiler.ProfileWatcher(poll_interval=0)
+        with mock.patch.object(watcher, 'check', side_effect=[RuntimeError('redis down'), None]) as check, \
+                mock.patch.object(profiler, 'time') as clock, \
+                mock.patch('dns_core.logger.log_system_event') as log:
+            clock.sleep.side_effect = [None, None, _StopWatcher]
+            with self.assertRaises(_StopWatcher):
+                watcher.run()
+        self.assertEqual(check.call_count, 2)
+        self.assertIn('redis down', log.call_args.args[1])
+
+    def test_malformed_request_is_an_error(self):
+        self.redis.set(profiler.PROFILE_REQUEST_KEY, b'not json')
+        with self.assertRaises(ValueError):
+            profiler.ProfileWatcher().check()
+
+
+class UpstreamClientTests(SimpleTestCase):
+    def setUp(self):
+        isolate_metrics(self)
+        self.upstream = FakeUpstream(upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}]))
+        self.addCleanup(self.upstream.close)
+
+    def upstream_client(self, **kwargs):
+        kwargs.setdefault('sockets_per_server', 2)
+        client = upstream.UpstreamClient([self.upstream.address], timeout=1.0, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_replies_keep_the_callers_transaction_id(self):
+        client = self.upstream_client()
+        for name in ('a.example.', 'b.example.', 'c.example.'):
+            transaction_id, query = build_query(name, 'A')
+            response = client.query(query)
+            self.assertEqual(response[:2], query[:2])
+            result = parse_dns_response(response)
+            self.assertEqual(result["Question"][0]["name"], name)
+            self.assertEqual(result["Answer"][0]["data"], "10.0.0.1")
+        self.assertEqual(client.stats()[f'127.0.0.1:{self.upstream.address[1]}']['responses'], 3)
+
+    def test_mismatched_replies_are_dropped(self):
+        self.upstream.reply = lambda query: upstream_reply()(build_query('other.example.', 'A')[1])
+        client = self.upstream_client()
+        client.timeout = 0.2
+        self.assertIsNone(client.query(build_query('a.example.', 'A')[1]))
+
+    def test_query_name_case_is_randomized_and_must_be_echoed(self):
+        seen = []
+        reply = self.upstream.reply
+        self.upstream.reply = lambda query: seen.append(query[12:skip_name(query, 12)]) or reply(query)
+        client = self.upstream_client(randomize_case=True)
+        transaction_id, query = build_query('abcdefghijklmnop.example.', 'A')
+        response = client.query(query)
+        name = query[12:skip_name(query, 12)]
+        self.assertEqual(response[:2], query[:2])
+        self.assertEqual(response[12:12 + len(name)], name)
+        self.assertEqual(seen[0].lower(), name)
+        self.assertNotEqual(seen[0], name)
+
+        # An upstream (or spoofer) that does not echo the exact spelling is ignored
+        self.upstream.reply = lambda query: reply(query[:12] + query[12:].lower())
+        client.timeout = 0.2
+        self.assertIsNone(client.query(query))
+
+    def test_sockets_are_rotated_after_max_queries(self):
+        client = self.upstream_client(sockets_per_server=1, socket_max_queries=2)
+        old = client.pools[self.upstream.address][0]
+        port = old.sock.getsockname()[1]
+        for name in ('a.example.', 'b.example.', 'c.example.'):
+            self.assertIsNotNone(client.query(build_query(name, 'A')[1]))
+        new = client.pools[self.upstream.address][0]
+        self.assertIsNot(new, old)
+        self.assertTrue(old.closed)
+        self.assertNotEqual(new.sock.getsockname()[1], port)
+        self.assertEqual(new.queries, 1)
+
+    def test_retired_sockets_close_once_their_queries_are_done(self):
+        upstream_socket = upstream.UpstreamSocket(*self.upstream.address)
+        self.addCleanup(upstream_socket.close)
+        waiter = upstream._PendingQuery(None)
+        txid = upstream_socket.send(build_query('a.example.', 'A')[1], waiter)
+        upstream_socket.retire()
+        self.assertFalse(upstream_socket.closed)
+        upstream_socket.cancel(txid, waiter)
+        self.assertTrue(upstream_socket.closed)
+
+    def test_close_stops_the_receiver_threads(self):
+        client = upstream.UpstreamClient([self.upstream.address], sockets_per_server=2)
+        receivers = [s.receiver for pool in client.pools.values() for s in pool]
+        client.close()
+        for receiver in receivers:
+            receiver.join(1)
+            self.assertFalse(receiver.is_alive())
+
+    def test_receive_loop_retries_transient_errors_only(self):
+        upstream_socket = upstream.UpstreamSocket(*self.upstream.address)
+        upstream_socket.close()
+        upstream_socket.receiver.join(1)
+        upstream_socket.closed = False
+        upstream_socket.sock = mock.Mock(recv=mock.Mock(side_effect=[
+            OSError(errno.ECONNREFUSED, 'refused'), OSError(errno.EBADF, 'closed'),
+        ]))
+        upstream_socket._receive_loop()
+        self.assertEqual(upstream_socket.sock.recv.call_count, 2)
+
+    def test_changing_servers_closes_the_old_client(self):
+        with mock.patch.object(upstream, '_upstream_client', None):
+            old = upstream.get_upstream_client([self.upstream.address])
+            self.assertIs(upstream.get_upstream_client([self.upstream.address]), old)
+            new = upstream.get_upstream_client([self.upstream.address, ('127.0.0.1', 9)])
+            self.addCleanup(new.close)
+            self.assertIsNot(new, old)
+            self.assertTrue(all(s.closed for pool in old.pools.values() for s in pool))
+
+
+class WorkerPoolTests(SimpleTestCase):
+    def pool(self, workers=2, port=None):
+        pool = DNSWorkerPool(workers, port=port or free_port(), check_interval=0.05)
+        self.addCleanup(pool.stop)
+        pool.start()
+        return pool
+
+    def test_stop_terminates_and_joins_the_workers(self):
+        pool = self.pool()
+        processes = list(pool.processes)
+        pool.stop()
+        for process in processes:
+            self.assertFalse(process.is_alive())
+            self.assertEqual(process.exitcode, 0)
+
+    def test_worker_exits_when_its_tcp_server_fails(self):
+        port = free_port()
+        # A TCP listener without SO_REUSEPORT makes the workers' TCP bind fail
+        blocker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(blocker.close)
+        blocker.bind(('0.0.0.0', port))
+        blocker.listen()
+        pool = self.pool(workers=1, port=port)
+        process = pool.processes[0]
+        process.join(10)
+        self.assertEqual(process.exitcode, 1)
+        pool.check_workers()
+        self.assertEqual(pool.restarts[0], 1)
+        self.assertIsNot(pool.processes[0], process)
+
+    def test_sigterm_ends_supervise(self):
+        previous = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+        for signum, handler in previous.items():
+            self.addCleanup(signal.signal, signum, handler)
+        pool = self.pool(workers=1)
+        pool.stop_on_signals()
+        threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        pool.supervise()
+        pool.stop()
+        self.assertFalse(pool.processes[0].is_alive())
+
+
+class MetricsTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        # Process stats are tested on their own below
+        self.process_samples_patcher = mock.patch.object(metrics, '_process_samples', return_value=[])
+        self.process_samples = self.process_samples_patcher.start()
+        self.addCleanup(self.process_samples_patcher.stop)
+
+    def test_render_counters_and_histograms(self):
+        metrics.inc('dns_queries_total', transport='udp', status='success')
+        metrics.inc('dns_queries_total', 2, transport='udp', status='success')
+        metrics.observe('dns_stage_duration_seconds', 0.003, stage='cache')
+        metrics.observe('dns_stage_duration_seconds', 0.2, stage='cache')
+        lines = metrics.render_metrics().splitlines()
+        self.assertIn('# TYPE dns_queries_total counter', lines)
+        self.assertIn('dns_queries_total{transport="udp",status="success"} 3', lines)
+        self.assertIn('# TYPE dns_stage_duration_seconds histogram', lines)
+        buckets = [line for line in lines if line.startswith('dns_stage_duration_seconds_bucket')]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertIn('dns_stage_duration_seconds_bucket{stage="cache",le="0.0025"} 0', lines)
+        self.assertIn('dns_stage_duration_seconds_bucket{stage="cache",le="0.005"} 1', lines)
+        self.assertEqual(buckets[-1], 'dns_stage_duration_seconds_bucket{stage="cache",le="+Inf"} 2')
+        count = 'dns_stage_duration_seconds_count{stage="cache"} 2'
+        self.assertIn(count, lines)
+        self.assertLess(lines.index(buckets[-1]), lines.index(count))
+
+    def test_totals_add_up_across_processes(self):
+        other = metrics.MetricsRegistry()
+        other.inc('dns_queries_total', (('transport', 'tcp'),), 5)
+        self.assertTrue(other.push())
+        metrics.inc('dns_queries_total', transport='tcp')
+        self.assertIn('dns_queries_total{transport="tcp"} 6', metrics.render_metrics().splitlines())
+
+    def test_failed_push_is_retried(self):
+        metrics.inc('dns_queries_total', transport='udp')
+        with mock.patch.object(redis_cache, '_redis_client', mock.Mock(pipeline=mock.Mock(
+                side_effect=ConnectionError('redis down')))):
+            self.assertFalse(self.registry.push())
+        metrics.inc('dns_queries_total', transport='udp')
+        self.assertIn('dns_queries_total{transport="udp"} 2', metrics.render_metrics().splitlines())
+
+    def test_scrapes_push_at_most_once_per_interval(self):
+        metrics.inc('dns_queries_total', transport='udp')
+        metrics.render_metrics()
+        metrics.inc('dns_queries_total', transport='udp')
+        self.assertIn('dns_queries_total{transport="udp"} 1', metrics.render_metrics().splitlines())
+        with override_settings(DNS_METRICS_SCRAPE_PUSH_INTERVAL=0):
+            self.assertIn('dns_queries_total{transport="udp"} 2',
+                          metrics.render_metrics().splitlines())
+
+    def test_gauges_are_found_through_the_index(self):
+        self.process_samples.return_value = [('gauge', 'dns_l1_cache_entries', (), 3)]
+        self.registry.push()
+        # A process that stopped pushing long ago
+        gone = metrics.GAUGES_KEY_PREFIX + 'gone:1'
+        self.redis.hset(gone, 'dns_l1_cache_entries{instance="gone:1"}', 7)
+        self.redis.zadd(metrics.GAUGES_INDEX_KEY, {gone: time.time() - 1})
+        with mock.patch.object(self.redis, 'scan_iter', side_effect=AssertionError), \
+                mock.patch.object(self.redis, 'keys', side_effect=AssertionError):
+            lines = metrics.render_metrics().splitlines()
+        instance = f'{socket.gethostname()}:{os.getpid()}'
+        self.assertIn(f'dns_l1_cache_entries{{instance="{instance}"}} 3', lines)
+        self.assertNotIn('dns_l1_cache_entries{instance="gone:1"} 7', lines)
+        self.assertEqual(self.redis.zrange(metrics.GAUGES_INDEX_KEY, 0, -1),
+                         [f'{metrics.GAUGES_KEY_PREFIX}{instance}'.encode()])
+
+    def test_escapes_label_values(self):
+        metrics.inc('dns_upstream_queries_total', server='a"b\\c')
+        self.assertIn('dns_upstream_queries_total{server="a\\"b\\\\c"} 1', metrics.render_metrics())
+
+    def test_process_stats_counters_are_pushed_as_increments(self):
+        self.process_samples.return_value = [
+            ('counter', 'dns_l1_cache_lookups_total', (('result', 'hit'),), 10),
+            ('gauge', 'dns_l1_cache_entries', (), 3),
+        ]
+        self.registry.push()
+        self.process_samples.return_value = [
+            ('counter', 'dns_l1_cache_lookups_total', (('result', 'hit'),), 15),
+            ('gauge', 'dns_l1_cache_entries', (), 4),
+        ]
+        self.registry.push()
+        lines = metrics.render_metrics().splitlines()
+        self.assertIn('dns_l1_cache_lookups_total{result="hit"} 15', lines)
+        self.assertIn('# TYPE dns_l1_cache_entries gauge', lines)
+        instance = f'{socket.gethostname()}:{os.getpid()}'
+        self.assertIn(f'dns_l1_cache_entries{{instance="{instance}"}} 4', lines)
+
+    def collect_samples(self):
+        self.process_samples_patcher.stop()
+        return {(name, labels): (kind, value)
+                for kind, name, labels, value in metrics._process_samples()}
+
+    def test_upstream_stats_are_exported(self):
+        with mock.patch('dns_core.upstream.get_upstream_stats', return_value={
+            '10.0.0.1:53': {'srtt_ms': 12.5, 'queries': 4, 'responses': 4, 'timeouts': 0,
+                            'race_wins': 1, 'outstanding': 2, 'dropped_replies': 3},
+        }):
+            samples = self.collect_samples()
+        server = (('server', '10.0.0.1:53'),)
+        self.assertEqual(samples[('dns_upstream_srtt_seconds', server)], ('gauge', 0.0125))
+        self.assertEqual(samples[('dns_upstream_outstanding_queries', server)], ('gauge', 2))
+        self.assertEqual(samples[('dns_upstream_race_wins_total', server)], ('counter', 1))
+        self.assertEqual(samples[('dns_upstream_dropped_replies_total', server)], ('counter', 3))
+
+    def test_upstream_stats_combine_all_clients(self):
+        upstream_server = FakeUpstream(upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}]))
+        self.addCleanup(upstream_server.close)
+        client = upstream.UpstreamClient([upstream_server.address], sockets_per_server=1)
+        self.addCleanup(client.close)
+        client.query(build_query('a.example.', 'A')[1])
+        with mock.patch.object(upstream, '_upstream_client', client), \
+                mock.patch.object(upstream, '_upstream_client_pid', os.getpid()):
+            stats = upstream.get_upstream_stats()
+        server = f'127.0.0.1:{upstream_server.address[1]}'
+        self.assertEqual(stats[server]['responses'], 1)
+        self.assertIsNotNone(stats[server]['srtt_ms'])
+
+    def test_l1_cache_stats_are_exported(self):
+        cache = LocalCache(max_entries=1)
+        cache.set('a', 'value', 60)
+        cache.set('b', 'value', 60)
+        cache.get('b')
+        cache.get('a')
+        with mock.patch('dns_core.local_cache._local_cache', cache):
+            samples = self.collect_samples()
+        self.assertEqual(samples[('dns_l1_cache_lookups_total', (('result', 'hit'),))], ('counter', 1))
+        self.assertEqual(samples[('dns_l1_cache_lookups_total', (('result', 'miss'),))], ('counter', 1))
+        self.assertEqual(samples[('dns_l1_cache_evictions_total', ())], ('counter', 1))
+        self.assertEqual(samples[('dns_l1_cache_entries', ())], ('gauge', 1))
+
+    def test_singleflight_stats_are_exported(self):
+        from . import async_resolver, resolver
+        with mock.patch.object(resolver._upstream_flights, 'coalesced', 3), \
+                mock.patch.object(async_resolver, '_coalesced_flights', 2):
+            samples = self.collect_samples()
+        self.assertEqual(samples[('dns_singleflight_coalesced_total', ())], ('counter', 5))
+
+    def test_prefetch_stats_are_exported(self):
+        prefetcher = Prefetcher(min_hits=1, max_per_second=1.0)
+        self.addCleanup(prefetcher.executor.shutdown)
+        refreshed = threading.Event()
+        prefetcher.observe('a', 1, 100, refreshed.set)
+        prefetcher.observe('b', 1, 100, lambda: True)
+        refreshed.wait(1)
+        with mock.patch('dns_core.prefetch._prefetcher', prefetcher):
+            samples = self.collect_samples()
+        self.assertEqual(samples[('dns_prefetch_refreshes_total', (('result', 'scheduled'),))],
+                         ('counter', 1))
+        self.assertEqual(samples[('dns_prefetch_refreshes_total', (('result', 'rate_limited'),))],
+                         ('counter', 1))
+        self.assertIn(('dns_prefetch_inflight', ()), samples)
+
+    def test_serve_stale_refresh_stats_are_exported(self):
+        queue = resolver.RefreshQueue(max_workers=1, max_pending=1)
+        self.addCleanup(queue.executor.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        queue.submit('a', release.wait)
+        queue.submit('b', release.wait)
+        with mock.patch.object(resolver, '_refresh_queue', queue):
+            samples = self.collect_samples()
+        self.assertEqual(samples[('dns_serve_stale_refreshes_total', (('result', 'dropped'),))],
+                         ('counter', 1))
+        self.assertEqual(samples[('dns_serve_stale_refreshes_pending', ())], ('gauge', 1))
+
+    def test_log_stats_are_exported(self):
+        with mock.patch('dns_core.logger.get_log_stats',
+                        return_value={'queued': 7, 'queue_size': 100, 'dropped': 9}):
+            samples = self.collect_samples()
+        self.assertEqual(samples[('dns_log_dropped_records_total', ())], ('counter', 9))
+        self.assertEqual(samples[('dns_log_queue_depth', ())], ('gauge', 7))
+
+    def test_metrics_endpoint(self):
+        metrics.inc('dns_queries_total', transport='udp')
+        response = self.client.get('/api/v1/metrics', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'dns_queries_total{transport="udp"} 1', response.content)
+
+
+SOA = {"name": "example.", "type": "SOA", "ttl": 300,
+       "value": "ns.example. admin.example. 1 3600 600 86400 120"}
+
+
+class NegativeCacheTests(RedisTestCase):
+    def resolve(self, name, qtype='A'):
+        return parse_dns_response(resolve_dns(build_query(name, qtype)[1]))
+
+    def test_nxdomain_is_cached_with_its_soa(self):
+        upstream = self.patch_upstream(rcode=3, authority=[SOA])
+        self.assertEqual(self.resolve('missing.example.')["Status"], 3)
+        self.age_cache(100)
+        response = self.resolve('missing.example.')
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(response["Status"], 3)
+        [soa] = response["Authority"]
+        self.assertEqual((soa["type"], soa["data"]), ("SOA", SOA["value"]))
+        self.assertLessEqual(soa["ttl"], 20)
+
+    def test_nodata_is_cached_per_type(self):
+        upstream = self.patch_upstream(authority=[SOA])
+        self.resolve('v4only.example.', 'AAAA')
+        response = self.resolve('v4only.example.', 'AAAA')
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual((response["Status"], response["Answer"]), (0, []))
+        self.resolve('v4only.example.', 'MX')
+        self.assertEqual(upstream.call_count, 2)
+
+    def test_negative_ttl_is_capped(self):
+        self.patch_upstream(rcode=3, authority=[SOA])
+        with self.settings(DNS_NEGATIVE_CACHE_MAX_TTL=30):
+            self.resolve('missing.example.')
+        self.assertEqual(redis_cache.get_negative_entry('missing.example.', 'A')["ttl"], 30)
+
+    def test_answers_without_soa_are_not_cached(self):
+        upstream = self.patch_upstream(rcode=3)
+        self.resolve('missing.example.')
+        self.resolve('missing.example.')
+        self.assertEqual(upstream.call_count, 2)
+
+
+def answer_a(data, *args):
+    """Stand-in for resolve_dns: one A record for whatever was asked"""
+    return upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}])(data)
+
+
+class UDPServerTests(SimpleTestCase):
+    def test_queries_are_resolved_concurrently(self):
+        # Every resolve_dns call blocks until all of them are running
+        barrier = threading.Barrier(4, timeout=5)
+
+        def resolve(data, *args):
+            barrier.wait()
+            return answer_a(data)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            executor = ThreadPoolExecutor(max_workers=4)
+            server, _ = await loop.create_datagram_endpoint(
+                lambda: DNSDatagramProtocol(executor, 4), local_addr=('127.0.0.1', 0))
+            received = asyncio.Queue()
+            client, _ = await loop.create_datagram_endpoint(
+                lambda: type('Client', (asyncio.DatagramProtocol,), {
+                    'datagram_received': lambda self, data, addr: received.put_nowait(data),
+                })(), remote_addr=server.get_extra_info('sockname'))
+            queries = [build_query(f'{i}.example.', 'A')[1] for i in range(4)]
+            for query in queries:
+                client.sendto(query)
+            responses = [await asyncio.wait_for(received.get(), 5) for _ in queries]
+            client.close()
+            server.close()
+            executor.shutdown()
+            return queries, responses
+
+        with mock.patch('dns_core.udp_server.resolve_dns', side_effect=resolve):
+            queries, responses = asyncio.run(run())
+        self.assertEqual({r[:2] for r in responses}, {q[:2] for q in queries})
+
+    def test_datagrams_beyond_the_backlog_are_dropped(self):
+        protocol = DNSDatagramProtocol(executor=None, max_concurrency=1)
+        protocol.pending = 2
+        with mock.patch('asyncio.ensure_future') as ensure_future:
+            protocol.datagram_received(build_query('a.example.', 'A')[1], ('127.0.0.1', 53))
+        ensure_future.assert_not_called()
+
+
+class TCPServerTests(SimpleTestCase):
+    async def exchange(self, server, run, handler=None):
+        listener = await asyncio.start_server(handler or server.handle_connection, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname())
+
+        async def read_response():
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), 5))[0]
+            return await reader.readexactly(length)
+
+        try:
+            return await run(reader, writer, read_response)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+            # Let the server side of the connection finish before the loop ends
+            while server.connections:
+                await asyncio.sleep(0.01)
+            listener.close()
+            await listener.wait_closed()
+            server.executor.shutdown()
+
+    def test_pipelined_queries_are_answered_as_they_finish(self):
+        slow_release = threading.Event()
+
+        def resolve(data, *args):
+            if b"\x04slow" in data:
+                slow_release.wait(5)
+            return answer_a(data)
+
+        async def run(reader, writer, read_response):
+            for name in ('slow.example.', 'fast.example.'):
+                query = build_query(name, 'A')[1]
+                writer.write(struct.pack("!H", len(query)) + query)
+            first = await read_response()
+            slow_release.set()
+            second = await read_response()
+            return [parse_dns_response(r)["Question"][0]["name"] for r in (first, second)]
+
+        with mock.patch('dns_core.tcp_server.resolve_dns', side_effect=resolve):
+            names = asyncio.run(self.exchange(DNSTCPServer(max_concurrency=2), run))
+        self.assertEqual(names, ['fast.example.', 'slow.example.'])
+
+    def test_cancelled_connections_drop_their_queries(self):
+        server = DNSTCPServer(max_concurrency=1)
+        started, release = threading.Event(), threading.Event()
+        handlers = []
+
+        def resolve(data, *args):
+            started.set()
+            release.wait(5)
+            return answer_a(data)
+
+        async def handle(reader, writer):
+            # Cancel the handler itself, not the task asyncio.start_server watches
+            handlers.append(asyncio.ensure_future(server.handle_connection(reader, writer)))
+            try:
+                await handlers[-1]
+            except asyncio.CancelledError:
+                pass
+
+        async def run(reader, writer, read_response):
+            query = build_query('a.example.', 'A')[1]
+            writer.write(struct.pack("!H", len(query)) + query)
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            handlers[0].cancel()
+            rest = await asyncio.wait_for(reader.read(), 5)
+            release.set()
+            return rest
+
+        with mock.patch('dns_core.tcp_server.resolve_dns', side_effect=resolve):
+            rest = asyncio.run(self.exchange(server, run, handle))
+        self.assertEqual(rest, b"")
+        self.assertTrue(handlers[0].cancelled())
+        self.assertEqual(server.connections, 0)
+
+    def test_idle_connections_are_closed(self):
+        async def run(reader, writer, read_response):
+            query = build_query('a.example.', 'A')[1]
+            writer.write(struct.pack("!H", len(query)) + query)
+            await read_response()
+            return await asyncio.wait_for(reader.read(), 5)
+
+        with mock.patch('dns_core.tcp_server.resolve_dns', side_effect=answer_a):
+            rest = asyncio.run(self.exchange(DNSTCPServer(idle_timeout=0.1), run))
+        self.assertEqual(rest, b"")
+
+
+class LocalCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1, 30)
+        cache.set('b', 2, 30)
+        cache.get('a')
+        cache.set('c', 3, 30)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire_after_min_of_ttl_and_max_ttl(self):
+        cache = LocalCache(max_ttl=10)
+        with mock.patch('time.monotonic', return_value=1000):
+            cache.set('short', 1, 5)
+            cache.set('long', 2, 300)
+            cache.set('expired', 3, 0)
+        with mock.patch('time.monotonic', return_value=1006):
+            self.assertEqual((cache.get('short'), cache.get('long')), (None, 2))
+        with mock.patch('time.monotonic', return_value=1011):
+            self.assertIsNone(cache.get('long'))
+        self.assertIsNone(cache.get('expired'))
+
+
+class L1CacheTests(RedisTestCase):
+    def test_hits_are_served_without_redis(self):
+        redis_cache.cache_record('a.example.', 'A', '10.0.0.1', 300)
+        self.assertEqual(redis_cache.get_cached_records('a.example.', 'A')[0]['value'], '10.0.0.1')
+        with mock.patch.object(self.redis, 'get', side_effect=AssertionError):
+            self.assertEqual(redis_cache.get_cached_records('a.example.', 'A')[0]['value'],
+                             '10.0.0.1')
+
+    def test_writes_invalidate_the_local_entry(self):
+        redis_cache.cache_record('a.example.', 'A', '10.0.0.1', 300)
+        redis_cache.get_cached_records('a.example.', 'A')
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.2', 300, None)])
+        self.assertEqual([r['value'] for r in redis_cache.get_cached_records('a.example.', 'A')],
+                         ['10.0.0.2'])
+        redis_cache.delete_cached_records('a.example.', 'A')
+        self.assertEqual(redis_cache.get_cached_records('a.example.', 'A'), [])
+
+
+class RRsetCacheTests(RedisTestCase):
+    def test_rrset_is_one_redis_value(self):
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 300, None), ('10.0.0.2', 60, None)])
+        self.assertEqual(self.redis.keys('dns:cache:rrset:*'), [b'dns:cache:rrset:a.example.:A'])
+        self.assertAlmostEqual(self.redis.ttl('dns:cache:rrset:a.example.:A'),
+                               300 + max(redis_cache.CACHE_TTL_BUFFER, redis_cache.get_stale_window()),
+                               delta=1)
+        get_local_cache().clear()
+        with mock.patch.object(self.redis, 'get', wraps=self.redis.get) as get:
+            records = redis_cache.get_cached_records('a.example.', 'A')
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(sorted(r['value'] for r in records), ['10.0.0.1', '10.0.0.2'])
+
+    def test_cache_record_replaces_the_same_value(self):
+        redis_cache.cache_record('a.example.', 'MX', 'mx1.example.', 300, priority=10)
+        redis_cache.cache_record('a.example.', 'MX', 'MX1.example.', 300, priority=10)
+        redis_cache.cache_record('a.example.', 'MX', 'mx1.example.', 300, priority=20)
+        records = redis_cache.get_cached_records('a.example.', 'MX')
+        self.assertEqual(sorted(r['priority'] for r in records), [10, 20])
+
+    def test_concurrent_cache_record_calls_keep_both_records(self):
+        get = redis.client.Pipeline.get
+        calls = []
+
+        def racing_get(pipe, key):
+            calls.append(key)
+            if len(calls) == 1:
+                # Another process adds a record between our read and our write
+                self.redis.setex(key, 300, json.dumps([redis_cache._make_record(
+                    'a.example.', 'A', '10.0.0.2', 300)]))
+            return get(pipe, key)
+
+        with mock.patch.object(redis.client.Pipeline, 'get', racing_get):
+            self.assertTrue(redis_cache.cache_record('a.example.', 'A', '10.0.0.1', 300))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(r['value'] for r in redis_cache.get_cached_records('a.example.', 'A')),
+                         ['10.0.0.1', '10.0.0.2'])
+
+    def test_upstream_answers_replace_the_rrset(self):
+        upstream = self.patch_upstream([{"type": "MX", "value": "mx.example.", "priority": 5,
+                                         "ttl": 300}])
+        resolve_dns(build_query('a.example.', 'MX')[1])
+        upstream.side_effect = upstream_reply([{"type": "MX", "value": "mx2.example.",
+                                                "priority": 7, "ttl": 300}])
+        self.age_cache(400)
+        resolve_dns(build_query('a.example.', 'MX')[1])
+        records = redis_cache.get_cached_records('a.example.', 'MX')
+        self.assertEqual([(r['value'], r['priority']) for r in records], [('mx2.example.', 7)])
+
+    def test_expired_records_are_not_returned(self):
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 30, None), ('10.0.0.2', 300, None)])
+        get_local_cache().clear()
+        self.age_cache(30 + redis_cache.CACHE_TTL_BUFFER)
+        self.assertEqual([r['value'] for r in redis_cache.get_cached_records('a.example.', 'A')],
+                         ['10.0.0.2'])
+
+
+class TypeIndexTests(RedisTestCase):
+    def test_any_reads_the_type_index_instead_of_scanning(self):
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 300, None)])
+        redis_cache.cache_rrset('a.example.', 'TXT', [('hello', 300, None)])
+        redis_cache.cache_rrset('b.example.', 'A', [('10.0.0.2', 300, None)])
+        with mock.patch.object(self.redis, 'scan_iter', side_effect=AssertionError), \
+                mock.patch.object(self.redis, 'scan', side_effect=AssertionError):
+            records = redis_cache.get_cached_records_any('a.example.')
+        self.assertEqual(sorted(r['value'] for r in records), ['10.0.0.1', 'hello'])
+
+    def test_expired_types_are_pruned_from_the_index(self):
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 300, None)])
+        self.redis.hset(redis_cache.generate_type_index_key('a.example.'), 'TXT', int(time.time()) - 1)
+        self.assertEqual([r['value'] for r in redis_cache.get_cached_records_any('a.example.')],
+                         ['10.0.0.1'])
+        self.assertEqual(self.redis.hkeys(redis_cache.generate_type_index_key('a.example.')), [b'A'])
+
+    def test_deleting_an_rrset_updates_the_index_and_any(self):
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 300, None)])
+        redis_cache.cache_rrset('a.example.', 'TXT', [('hello', 300, None)])
+        redis_cache.get_cached_records_any('a.example.')
+        redis_cache.delete_cached_records('a.example.', 'TXT')
+        self.assertEqual([r['value'] for r in redis_cache.get_cached_records_any('a.example.')],
+                         ['10.0.0.1'])
+
+
+class PatchCachedResponseTests(SimpleTestCase):
+    def test_rewrites_id_question_case_and_ttls(self):
+        query = build_query('a.example.', 'A')[1]
+        packet = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300},
+                                 {"type": "A", "value": "10.0.0.2", "ttl": 20}])(query)
+        client_query = build_query('A.Example.', 'A')[1]
+        question = client_query[12:]
+        response = patch_cached_response(packet, find_ttl_offsets(packet), 30, b"\xab\xcd", question)
+        result = parse_dns_response(response)
+        self.assertEqual(response[:2], b"\xab\xcd")
+        self.assertEqual(result["Question"][0]["name"], 'A.Example.')
+        self.assertEqual([a["ttl"] for a in result["Answer"]], [270, 0])
+        self.assertEqual(parse_dns_response(packet)["Answer"][0]["ttl"], 300)
+
+
+@override_settings(DNS_CACHE_MODE='wire')
+class WireCacheTests(RedisTestCase):
+    def resolve(self, name, qtype='A'):
+        query = build_query(name, qtype)[1]
+        return query, resolve_dns(query)
+
+    def test_cached_packets_are_served_with_the_new_id_and_decayed_ttls(self):
+        upstream = self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+        self.resolve('a.example.')
+        self.age_cache(100)
+        query, response = self.resolve('a.example.')
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(response[:2], query[:2])
+        self.assertEqual(parse_dns_response(response)["Answer"][0]["ttl"], 200)
+        self.assertEqual(redis_cache.get_cached_records('a.example.', 'A'), [])
+
+    def test_negative_packets_are_capped_at_the_negative_ttl(self):
+        self.patch_upstream(rcode=3, authority=[SOA])
+        self.resolve('missing.example.')
+        _, _, packet = redis_cache.get_cached_response('missing.example.', 1)
+        self.assertEqual(parse_dns_response(packet)["Authority"][0]["ttl"], 120)
+
+    def test_errors_are_not_cached(self):
+        upstream = self.patch_upstream(rcode=2)
+        self.resolve('broken.example.')
+        self.resolve('broken.example.')
+        self.assertEqual(upstream.call_count, 2)
+
+
+class ManualRecordIndexTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = manual_records.ManualRecordIndex(recheck_interval=0)
+        patcher = mock.patch.object(manual_records, '_manual_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookups_are_case_insensitive_and_skip_the_database(self):
+        DNSRecord.objects.create(domain='Host.Example.', record_type='A', value='10.0.0.1',
+                                 is_manual=True)
+        DNSRecord.objects.create(domain='host.example.', record_type='A', value='10.0.0.9')
+        self.index.load()
+        with self.assertNumQueries(0):
+            answers = manual_records.get_manual_records('HOST.example.', 'A')
+        self.assertEqual([a["value"] for a in answers], ['10.0.0.1'])
+        self.assertIsNotNone(answers[0]["rdata"])
+
+    def test_saves_and_deletes_update_the_index(self):
+        self.index.load()
+        record = DNSRecord.objects.create(domain='host.example.', record_type='A',
+                                          value='10.0.0.1', is_manual=True)
+        self.assertEqual(len(manual_records.get_manual_records('host.example.', 'ANY')), 1)
+        record.record_type, record.value = 'TXT', 'hello'
+        record.save()
+        self.assertEqual(manual_records.get_manual_records('host.example.', 'A'), [])
+        self.assertEqual([a["value"] for a in manual_records.get_manual_records('host.example.', 'TXT')],
+                         ['hello'])
+        record.delete()
+        self.assertEqual(manual_records.get_manual_records('host.example.', 'ANY'), [])
+
+    def test_other_processes_reload_when_the_version_changes(self):
+        other = manual_records.ManualRecordIndex(recheck_interval=0)
+        self.assertEqual(other.lookup('host.example.', 'A'), [])
+        DNSRecord.objects.create(domain='host.example.', record_type='A', value='10.0.0.1',
+                                 is_manual=True)
+        self.assertEqual([a["value"] for a in other.lookup('host.example.', 'A')], ['10.0.0.1'])
+
+    def test_manual_records_are_answered_without_upstream(self):
+        DNSRecord.objects.create(domain='host.example.', record_type='A', value='10.0.0.1',
+                                 is_manual=True)
+        upstream = self.patch_upstream()
+        result = parse_dns_response(resolve_dns(build_query('host.example.', 'A')[1]))
+        self.assertEqual(result["Answer"][0]["data"], '10.0.0.1')
+        upstream.assert_not_called()
+
+
+class UpstreamSelectionTests(SimpleTestCase):
+    def setUp(self):
+        isolate_metrics(self)
+        self.upstreams = []
+        for _ in range(2):
+            fake = FakeUpstream(upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}]))
+            self.addCleanup(fake.close)
+            self.upstreams.append(fake)
+
+    def test_fastest_upstream_first_and_unmeasured_before_it(self):
+        servers = [('192.0.2.1', 53), ('192.0.2.2', 53), ('192.0.2.3', 53)]
+        selector = upstream._UpstreamSelector(servers, explore_ratio=0)
+        selector.upstream_stats[servers[0]].record(rtt=0.2)
+        selector.upstream_stats[servers[1]].record(rtt=0.01)
+        self.assertEqual(selector.ordered_servers(), [servers[2], servers[1], servers[0]])
+        selector.race = True
+        self.assertEqual(selector.attempts(), [[servers[2], servers[1]], [servers[0]]])
+
+    def test_unanswered_upstream_falls_back_to_the_next(self):
+        self.upstreams[0].reply = lambda query: None
+        client = upstream.UpstreamClient([u.address for u in self.upstreams], sockets_per_server=1,
+                                         timeout=0.2, explore_ratio=0)
+        self.addCleanup(client.close)
+        self.assertIsNotNone(client.query(build_query('a.example.', 'A')[1]))
+        stats = client.upstream_stats
+        self.assertEqual(stats[self.upstreams[0].address].timeouts, 1)
+        self.assertEqual(stats[self.upstreams[1].address].responses, 1)
+        # The timed-out upstream now has the worse RTT and is tried last
+        self.assertEqual(client.ordered_servers()[0], self.upstreams[1].address)
+
+    def test_racing_sends_to_both_and_counts_the_winner(self):
+        client = upstream.UpstreamClient([u.address for u in self.upstreams], sockets_per_server=1,
+                                         timeout=1.0, race=True, explore_ratio=0)
+        self.addCleanup(client.close)
+        self.assertIsNotNone(client.query(build_query('a.example.', 'A')[1]))
+        wait_for(lambda: all(u.queries == 1 for u in self.upstreams))
+        self.assertEqual(sum(s.race_wins for s in client.upstream_stats.values()), 1)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, count, fn):
+        results = [None] * count
+
+        def call(index):
+            try:
+                results[index] = fn()
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'answer'
+
+        threads, results = self.run_concurrently(5, lambda: flights.do('key', fetch))
+        wait_for(lambda: flights.coalesced == 4)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('answer', False)] + [('answer', True)] * 4)
+
+    def test_errors_reach_every_waiter(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise OSError('upstream down')
+
+        threads, results = self.run_concurrently(3, lambda: flights.do('key', fetch))
+        wait_for(lambda: flights.coalesced == 2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(all(isinstance(result, OSError) for result in results))
+        self.assertEqual(flights.do('key', lambda: 'again'), ('again', False))
+
+
+class CoalescingTests(RedisTestCase):
+    def test_concurrent_misses_send_one_upstream_query(self):
+        release = threading.Event()
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+        def forward(query, deadline=None):
+            release.wait(5)
+            return reply(query)
+
+        upstream = self.patch_upstream()
+        upstream.side_effect = forward
+        queries = [build_query('a.example.', 'A')[1] for _ in range(4)]
+        responses = [None] * len(queries)
+        coalesced = resolver._upstream_flights.coalesced
+
+        def resolve(index):
+            responses[index] = resolve_dns(queries[index])
+
+        threads = [threading.Thread(target=resolve, args=(i,)) for i in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        wait_for(lambda: resolver._upstream_flights.coalesced - coalesced == 3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(upstream.call_count, 1)
+        for query, response in zip(queries, responses):
+            self.assertEqual(response[:2], query[:2])
+            self.assertEqual(parse_dns_response(response)["Answer"][0]["data"], '10.0.0.1')
+
+    @override_settings(DNS_SINGLEFLIGHT_REDIS_LOCK=True)
+    def test_waits_for_another_process_holding_the_lock(self):
+        upstream = self.patch_upstream()
+        token = acquire_lock('a.example.:1:1', 3.0)
+        redis_cache.cache_rrset('a.example.', 'A', [('10.0.0.1', 300, None)])
+        threading.Timer(0.1, release_lock, ('a.example.:1:1', token)).start()
+        query = build_query('a.example.', 'A')[1]
+        response = resolve_upstream(query, 'a.example.', 1, 1, 'A', False)
+        self.assertEqual(parse_dns_response(response)["Answer"][0]["data"], '10.0.0.1')
+        upstream.assert_not_called()
+
+
+class PrefetchTests(RedisTestCase):
+    def prefetcher(self, **kwargs):
+        prefetcher = Prefetcher(**kwargs)
+        self.addCleanup(prefetcher.executor.shutdown)
+        return prefetcher
+
+    def test_only_popular_entries_near_expiry_are_refreshed(self):
+        prefetcher = self.prefetcher(min_hits=2, threshold=0.1)
+        release = threading.Event()
+        refresh = mock.Mock(side_effect=lambda: release.wait(5))
+        self.assertFalse(prefetcher.observe('key', 5, 100, refresh))
+        self.assertFalse(prefetcher.observe('key', 50, 100, refresh))
+        self.assertTrue(prefetcher.observe('key', 5, 100, refresh))
+        # Already being refreshed
+        self.assertFalse(prefetcher.observe('key', 5, 100, refresh))
+        release.set()
+        prefetcher.executor.shutdown(wait=True)
+        self.assertEqual(refresh.call_count, 1)
+        self.assertEqual(prefetcher.stats()['completed'], 1)
+
+    def test_refreshes_are_rate_limited(self):
+        prefetcher = self.prefetcher(min_hits=1, max_per_second=2)
+        with mock.patch('time.monotonic', return_value=prefetcher._tokens_at):
+            scheduled = [prefetcher.observe(i, 0, 100, lambda: True) for i in range(3)]
+        self.assertEqual(scheduled, [True, True, False])
+        self.assertEqual(prefetcher.stats()['rate_limited'], 1)
+
+    def test_hot_names_are_refreshed_before_they_expire(self):
+        prefetcher = self.prefetcher(min_hits=2, threshold=0.1)
+        upstream = self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 100}])
+        query = build_query('hot.example.', 'A')[1]
+        with mock.patch('dns_core.resolver.get_prefetcher', return_value=prefetcher):
+            resolve_dns(query)
+            self.age_cache(95)
+            get_local_cache().clear()
+            resolve_dns(query)
+            resolve_dns(query)
+            prefetcher.executor.shutdown(wait=True)
+        self.assertEqual(upstream.call_count, 2)
+        self.assertEqual(prefetcher.stats()['completed'], 1)
+        records = redis_cache.get_cached_records('hot.example.', 'A')
+        self.assertAlmostEqual(records[0]['cached_at'], time.time(), delta=1)
+
+
+@override_settings(DNS_SERVE_STALE_WINDOW=3600, DNS_SERVE_STALE_TTL=30,
+                   DNS_SERVE_STALE_CLIENT_TIMEOUT=0.1)
+class ServeStaleTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.refresh_queue()
+
+    def refresh_queue(self, **kwargs):
+        """Give the test its own refresh queue, drained before the test ends"""
+        queue = resolver.RefreshQueue(**kwargs)
+        self.addCleanup(queue.executor.shutdown)
+        patcher = mock.patch.object(resolver, '_refresh_queue', queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return queue
+
+    def expire(self, name='a.example.'):
+        """Cache an answer for name and let it expire"""
+        self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 60}])
+        resolve_dns(build_query(name, 'A')[1])
+        get_local_cache().clear()
+        self.age_cache(60 + redis_cache.CACHE_TTL_BUFFER + 10)
+
+    def resolve(self, name='a.example.'):
+        return parse_dns_response(resolve_dns(build_query(name, 'A')[1]))
+
+    def test_stale_answer_when_upstream_is_down_or_failing(self):
+        self.expire()
+        for reply in (lambda query, deadline=None: None, upstream_reply(rcode=2)):
+            self.patch_upstream().side_effect = reply
+            result = self.resolve()
+            self.assertEqual(result["Status"], 0)
+            self.assertEqual([(a["data"], a["ttl"]) for a in result["Answer"]], [('10.0.0.1', 30)])
+
+    def slow_upstream(self):
+        """Make upstream answers wait (within the caller's deadline) for the returned event"""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.2", "ttl": 60}])
+
+        def forward(query, deadline=None):
+            timeout = 5 if deadline is None else deadline - time.monotonic()
+            return reply(query) if release.wait(timeout) else None
+
+        self.patch_upstream().side_effect = forward
+        return release
+
+    def cached_values(self, name='a.example.'):
+        return [r['value'] for r in redis_cache.get_cached_records(name, 'A')]
+
+    @override_settings(DNS_SERVE_STALE_CLIENT_TIMEOUT=0.2)
+    def test_slow_upstream_gets_the_stale_answer_and_refreshes_the_cache(self):
+        self.expire()
+        release = self.slow_upstream()
+        self.assertEqual(self.resolve()["Answer"][0]["data"], '10.0.0.1')
+        release.set()
+        wait_for(lambda: self.cached_values() == ['10.0.0.2'])
+
+    @override_settings(DNS_SERVE_STALE_CLIENT_TIMEOUT=0.2)
+    def test_stale_misses_beyond_the_refresh_workers_are_answered_in_time(self):
+        names = ['a.example.', 'b.example.', 'c.example.']
+        for name in names:
+            self.expire(name)
+        queue = self.refresh_queue(max_workers=1, max_pending=2)
+        release = self.slow_upstream()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(self.resolve, names * 2))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual([r["Answer"][0]["data"] for r in results], ['10.0.0.1'] * 6)
+        # One refresh per name, and none beyond the queue size
+        self.assertEqual(queue.stats(), {'scheduled': 2, 'coalesced': 2, 'dropped': 2, 'pending': 2})
+        release.set()
+        wait_for(lambda: sorted(self.cached_values(name) for name in names)
+                 == [[], ['10.0.0.2'], ['10.0.0.2']])
+
+    def test_fresh_upstream_answer_wins(self):
+        self.expire()
+        self.patch_upstream([{"type": "A", "value": "10.0.0.2", "ttl": 60}])
+        self.assertEqual(self.resolve()["Answer"][0]["data"], '10.0.0.2')
+
+    @override_settings(DNS_CACHE_MODE='wire')
+    def test_stale_wire_answers(self):
+        self.expire()
+        self.patch_upstream().side_effect = lambda query, deadline=None: None
+        self.assertEqual([(a["data"], a["ttl"]) for a in self.resolve()["Answer"]],
+                         [('10.0.0.1', 30)])
+
+    @override_settings(DNS_SERVE_STALE_WINDOW=0)
+    def test_disabled_without_a_window(self):
+        self.expire()
+        self.patch_upstream().side_effect = lambda query, deadline=None: None
+        self.assertEqual(self.resolve()["Answer"], [])
+
+
+class EDNSTests(SimpleTestCase):
+    def setUp(self):
+        isolate_metrics(self)
+        self.query = build_query('big.example.', 'TXT')[1]
+        self.big = upstream_reply([{"type": "TXT", "value": "x" * 200, "ttl": 60}] * 4)(self.query)
+
+    def test_payload_size_follows_the_client_and_server_limits(self):
+        self.assertEqual(parse_edns(set_edns_payload(self.query, 4096))["udp_payload"], 4096)
+        response = apply_edns(set_edns_payload(self.query, 4096), self.big, 1232)
+        self.assertEqual(parse_edns(response)["udp_payload"], 1232)
+        self.assertEqual(len(parse_dns_response(response)["Answer"]), 4)
+        response = apply_edns(set_edns_payload(self.query, 512), self.big, 1232)
+        self.assertTrue(parse_dns_response(response)["TC"])
+        self.assertIsNotNone(parse_edns(response))
+
+    def test_udp_answers_without_edns_are_cut_at_512_bytes(self):
+        response = apply_edns(self.query, self.big, 1232)
+        self.assertLessEqual(len(response), 512)
+        self.assertTrue(parse_dns_response(response)["TC"])
+        self.assertEqual(parse_dns_response(response)["Answer"], [])
+        self.assertEqual(apply_edns(self.query, self.big, 1232, udp=False), self.big)
+
+    def test_opt_record_is_stripped(self):
+        self.assertEqual(strip_opt_record(set_edns_payload(self.query, 1232)), self.query)
+
+    def test_truncated_upstream_replies_are_retried_over_tcp(self):
+        client = mock.Mock()
+        client.query.return_value = truncate_response(set_edns_payload(self.big, 1232))
+        client.query_tcp.return_value = set_edns_payload(self.big, 1232)
+        with mock.patch('dns_core.resolver.get_upstream_client', return_value=client):
+            response = resolver.forward_to_upstream(self.query)
+        self.assertEqual(response, self.big)
+        self.assertEqual(parse_edns(client.query.call_args[0][0])["udp_payload"], 1232)
+
+    def test_query_tcp(self):
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+
+        def serve():
+            conn, _ = listener.accept()
+            with conn:
+                length = struct.unpack("!H", conn.recv(2))[0]
+                query = conn.recv(length)
+                conn.sendall(struct.pack("!H", len(self.big)) + query[:2] + self.big[2:])
+
+        threading.Thread(target=serve, daemon=True).start()
+        client = upstream.UpstreamClient([listener.getsockname()], sockets_per_server=1)
+        self.addCleanup(client.close)
+        response = client.query_tcp(self.query)
+        self.assertEqual(response[:2], self.query[:2])
+        self.assertEqual(len(parse_dns_response(response)["Answer"]), 4)
+
+    def test_udp_server_truncates_oversized_answers(self):
+        protocol = DNSDatagramProtocol(ThreadPoolExecutor(max_workers=1), 1)
+        self.addCleanup(protocol.executor.shutdown)
+        protocol.transport = mock.Mock()
+        with mock.patch('dns_core.udp_server.resolve_dns', return_value=self.big):
+            asyncio.run(protocol.handle_query(self.query, ('127.0.0.1', 53)))
+        response = protocol.transport.sendto.call_args[0][0]
+        self.assertTrue(parse_dns_response(response)["TC"])
+
+
+class PacketCodecTests(SimpleTestCase):
+    ANSWERS = [
+        {"type": "A", "value": "10.0.0.1", "ttl": 60},
+        {"type": "AAAA", "value": "2001:db8::1", "ttl": 60},
+        {"type": "CNAME", "value": "alias.example.", "ttl": 60},
+        {"type": "NS", "value": "ns1.example.", "ttl": 60},
+        {"type": "PTR", "value": "host.example.", "ttl": 60},
+        {"type": "MX", "value": "mail.example.", "priority": 10, "ttl": 60},
+        {"type": "TXT", "value": "v=spf1 -all", "ttl": 60},
+    ]
+
+    def test_every_type_round_trips(self):
+        query = build_query('a.example.', 'ANY')[1]
+        response = upstream_reply(self.ANSWERS, authority=[SOA])(query)
+        result = parse_dns_response(bytearray(response))
+        self.assertEqual(result["TransactionID"], int.from_bytes(query[:2], "big"))
+        self.assertEqual(result["Question"], [{"name": "a.example.", "type": 255}])
+        self.assertEqual([(a["type"], a["data"]) for a in result["Answer"]], [
+            ("A", "10.0.0.1"), ("AAAA", "2001:db8::1"), ("CNAME", "alias.example."),
+            ("NS", "ns1.example."), ("PTR", "host.example."), ("MX", "10 mail.example."),
+            ("TXT", "v=spf1 -all"),
+        ])
+        self.assertEqual([(a["type"], a["data"]) for a in result["Authority"]],
+                         [("SOA", SOA["value"])])
+
+    def test_messages_use_slots_and_parse_rdata_lazily(self):
+        query = build_query('a.example.', 'A')[1]
+        message = Message.parse(upstream_reply(self.ANSWERS[:1])(query))
+        record = message.answers[0]
+        self.assertIsInstance(record, ResourceRecord)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertIsInstance(message.view, memoryview)
+        with mock.patch('socket.inet_ntoa', wraps=socket.inet_ntoa) as inet_ntoa:
+            Message.parse(upstream_reply(self.ANSWERS[:1])(query))
+            inet_ntoa.assert_not_called()
+            self.assertEqual(record.value(), '10.0.0.1')
+
+    def test_malformed_messages_raise_value_error(self):
+        query = build_query('a.example.', 'A')[1]
+        response = upstream_reply(self.ANSWERS[:1])(query)
+        with self.assertRaises(ValueError):
+            Message.parse(response[:-2])
+        # A compression pointer to itself
+        looping = query[:4] + b"\x00\x01" + query[6:12] + b"\xc0\x0c\x00\x01\x00\x01"
+        with self.assertRaises(ValueError):
+            Message.parse(looping)
+
+
+class NameCompressionTests(SimpleTestCase):
+    def response(self, name, answers, authority=None):
+        return upstream_reply(answers, authority=authority)(build_query(name, 'ANY')[1])
+
+    def test_repeated_names_become_pointers(self):
+        answers = [{"type": "NS", "value": f"ns{i}.a.example.", "ttl": 60} for i in range(5)]
+        response = self.response('a.example.', answers)
+        uncompressed = sum(len(encode_qname(a["value"])) for a in answers)
+        self.assertLess(len(response), len(build_query('a.example.', 'ANY')[1])
+                        + len(answers) * 12 + uncompressed)
+        self.assertEqual([a["data"] for a in parse_dns_response(response)["Answer"]],
+                         [a["value"] for a in answers])
+
+    def test_names_keep_their_case(self):
+        response = self.response('Host.Example.', [
+            {"type": "CNAME", "value": "host.example.", "ttl": 60},
+            {"type": "CNAME", "value": "www.Host.Example.", "ttl": 60},
+        ])
+        self.assertEqual([a["data"] for a in parse_dns_response(response)["Answer"]],
+                         ["host.example.", "www.Host.Example."])
+
+    def test_no_pointers_past_the_16k_limit(self):
+        # ~18K of TXT records pushes later names beyond what a pointer can reach
+        answers = [{"type": "TXT", "value": "x" * 250, "ttl": 60}] * 72
+        answers += [{"type": "NS", "value": f"ns{i}.far.example.", "ttl": 60} for i in range(3)]
+        answers += [{"type": "NS", "value": "ns0.far.example.", "ttl": 60}]
+        response = self.response('a.example.', answers)
+        self.assertGreater(len(response), 0x4000)
+        result = parse_dns_response(response)
+        self.assertEqual([a["data"] for a in result["Answer"][72:]],
+                         ["ns0.far.example.", "ns1.far.example.", "ns2.far.example.",
+                          "ns0.far.example."])
+
+    def test_uncompressed_writer_never_emits_pointers(self):
+        writer = MessageWriter(compress=False)
+        writer.write_name('a.example.')
+        writer.write_name('a.example.')
+        self.assertEqual(bytes(writer), encode_qname('a.example.') * 2)
+
+
+class AsyncResolverTests(RedisTestCase):
+    def patch_async_upstream(self, reply):
+        patcher = mock.patch('dns_core.async_resolver.forward_to_upstream_async',
+                             new_callable=mock.AsyncMock, side_effect=reply)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_misses_are_cached_and_shared_with_the_sync_resolver(self):
+        upstream = self.patch_async_upstream(
+            upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}]))
+        query = build_query('a.example.', 'A')[1]
+        first = asyncio.run(resolve_dns_async(query))
+        second = asyncio.run(resolve_dns_async(query))
+        self.assertEqual(upstream.await_count, 1)
+        self.assertEqual([a["data"] for a in parse_dns_response(second)["Answer"]],
+                         [a["data"] for a in parse_dns_response(first)["Answer"]])
+        self.patch_upstream().side_effect = AssertionError
+        self.assertEqual(parse_dns_response(resolve_dns(query))["Answer"][0]["data"], '10.0.0.1')
+        result = asyncio.run(resolve_dns_json_async('a.example', 'A'))
+        self.assertEqual(result["Answer"][0]["data"], '10.0.0.1')
+
+    def test_concurrent_misses_share_one_upstream_query(self):
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+        async def slow_reply(query):
+            await asyncio.sleep(0.05)
+            return reply(query)
+
+        upstream = self.patch_async_upstream(slow_reply)
+        queries = [build_query('a.example.', 'A')[1] for _ in range(3)]
+
+        async def run():
+            return await asyncio.gather(*(resolve_dns_async(query) for query in queries))
+
+        responses = asyncio.run(run())
+        self.assertEqual(upstream.await_count, 1)
+        self.assertEqual([r[:2] for r in responses], [q[:2] for q in queries])
+
+    def test_async_upstream_client(self):
+        fake = FakeUpstream(upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}]))
+        self.addCleanup(fake.close)
+
+        async def run():
+            client = upstream.AsyncUpstreamClient([fake.address], sockets_per_server=1, timeout=1.0)
+            query = build_query('a.example.', 'A')[1]
+            return query, await client.query(query)
+
+        query, response = asyncio.run(run())
+        self.assertEqual(response[:2], query[:2])
+        self.assertEqual(parse_dns_response(response)["Answer"][0]["data"], '10.0.0.1')
+
+    def test_async_upstream_client_rotates_endpoints(self):
+        fake = FakeUpstream(upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 60}]))
+        self.addCleanup(fake.close)
+
+        async def run():
+            client = upstream.AsyncUpstreamClient([fake.address], sockets_per_server=1, timeout=1.0,
+                                                  socket_max_queries=1, randomize_case=True)
+            responses = [await client.query(build_query(name, 'A')[1])
+                         for name in ('a.example.', 'b.example.')]
+            old = client.pools[fake.address][0]
+            await client.query(build_query('c.example.', 'A')[1])
+            new = client.pools[fake.address][0]
+            client.close()
+            return responses, old, new
+
+        responses, old, new = asyncio.run(run())
+        self.assertTrue(all(responses))
+        self.assertIsNot(new, old)
+        self.assertTrue(old.transport.is_closing())
+
+
+class LogPipelineTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = Path(directory.name)
+
+    def logger(self, name, pipeline, **kwargs):
+        logger = logging.getLogger(f'dns.test.{self._testMethodName}.{name}')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = BatchRotatingFileHandler(self.dir / f'{name}.log', **kwargs)
+        handler.setFormatter(logging.Formatter('%(name)s %(levelname)s %(message)s'))
+        pipeline.add(logger, handler)
+        self.addCleanup(logger.removeHandler, pipeline.handler)
+        self.addCleanup(handler.close)
+        return logger
+
+    def read(self, name):
+        return (self.dir / f'{name}.log').read_text().splitlines()
+
+    def test_records_are_written_to_their_own_files_by_the_writer_thread(self):
+        pipeline = LogPipeline(queue_size=100, batch_size=10)
+        queries, system = self.logger('queries', pipeline), self.logger('system', pipeline)
+        pipeline.start()
+        queries.info("query %s", "a.example.")
+        system.warning("started")
+        pipeline.stop()
+        self.assertEqual(self.read('queries'), [f'{queries.name} INFO query a.example.'])
+        self.assertEqual(self.read('system'), [f'{system.name} WARNING started'])
+
+    def test_full_queue_drops_and_reports_instead_of_blocking(self):
+        pipeline = LogPipeline(queue_size=2)
+        queries, system = self.logger('queries', pipeline), self.logger('system', pipeline)
+        pipeline.drop_logger = system.name
+        for i in range(5):
+            queries.info("query %d", i)
+        self.assertEqual(pipeline.stats(), {'queued': 2, 'queue_size': 2, 'dropped': 3})
+        pipeline.start()
+        pipeline.stop()
+        self.assertEqual(self.read('queries'), [f'{queries.name} INFO query 0',
+                                                f'{queries.name} INFO query 1'])
+        self.assertEqual(self.read('system'),
+                         [f'{system.name} WARNING Log queue full, dropped 3 records'])
+
+    def test_files_rotate_past_max_bytes(self):
+        handler = BatchRotatingFileHandler(self.dir / 'rotating.log', max_bytes=100, backup_count=2)
+        self.addCleanup(handler.close)
+        for i in range(10):
+            handler.emit(logging.makeLogRecord({'msg': f'line {i:02d} ' + 'x' * 20}))
+        # Written without a flush per record; rotation happens on the batch flush
+        handler.flush()
+        self.assertEqual(len((self.dir / 'rotating.log.1').read_text().splitlines()), 10)
+        self.assertEqual((self.dir / 'rotating.log').read_text(), '')
+
+    def test_file_rotated_by_another_process_is_reopened(self):
+        handler = BatchRotatingFileHandler(self.dir / 'shared.log', max_bytes=10)
+        self.addCleanup(handler.close)
+        handler.emit(logging.makeLogRecord({'msg': 'x' * 20}))
+        os.rename(self.dir / 'shared.log', self.dir / 'shared.log.1')
+        handler.flush()
+        handler.emit(logging.makeLogRecord({'msg': 'after'}))
+        handler.flush()
+        self.assertEqual(self.read('shared'), ['after'])
+        self.assertFalse((self.dir / 'shared.log.2').exists())
+
+    def test_json_lines(self):
+        record = logging.makeLogRecord({'name': 'dns.queries', 'levelname': 'INFO',
+                                        'msg': 'query %s', 'args': ('a.example.',)})
+        entry = json.loads(JSONLineFormatter().format(record))
+        self.assertEqual((entry['logger'], entry['level'], entry['message']),
+                         ('dns.queries', 'INFO', 'query a.example.'))
+
+
+class QueryLogTests(SimpleTestCase):
+    def setUp(self):
+        isolate_metrics(self)
+        patcher = mock.patch.object(dns_logging.dns_logger, 'info')
+        self.info = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sampling_keeps_failures(self):
+        with mock.patch.object(dns_logging, 'QUERY_LOG_SAMPLE_RATE', 0.0):
+            dns_logging.log_dns_query('a.example.', 'A', status='success')
+            dns_logging.log_dns_query('b.example.', 'A', status='nxdomain')
+            dns_logging.log_dns_query('c.example.', 'A', status='error')
+        self.assertEqual([call.args[1] for call in self.info.call_args_list],
+                         ['b.example.', 'c.example.'])
+
+    def test_aggregated_counts_are_written_per_interval(self):
+        write = mock.Mock()
+        aggregator = QueryAggregator(write, interval=3600, max_keys=2)
+        self.addCleanup(aggregator.stop)
+        with mock.patch.object(dns_logging, '_query_aggregator', aggregator):
+            for name in ('a.example.', 'a.example.', 'b.example.', 'c.example.'):
+                dns_logging.log_dns_query(name, 'A', source='udp', from_cache=True)
+        aggregator.flush()
+        counts, overflow, _ = write.call_args[0]
+        self.assertEqual(counts, {('a.example.', 'A', 'udp', 'success', True): 2,
+                                  ('b.example.', 'A', 'udp', 'success', True): 1})
+        self.assertEqual(overflow, 1)
+        aggregator.flush()
+        self.assertEqual(write.call_count, 1)
+
+    def test_summary_lines(self):
+        dns_logging._write_query_summary({('a.example.', 'A', 'udp', 'success', True): 1,
+                                          ('b.example.', 'A', 'udp', 'success', False): 5}, 3, 60)
+        lines = [call.args[0] % call.args[1:] for call in self.info.call_args_list]
+        self.assertIn('Domain: b.example.', lines[0])
+        self.assertIn('Count: 5', lines[0])
+        self.assertEqual(lines[2], 'DNS Query Summary | Other keys: 3 queries | Interval: 60s')
+
+
+class TracingTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('dns_core.logger.log_slow_query')
+        self.log_slow_query = patcher.start()
+        self.addCleanup(patcher.stop)
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+        self.patch_upstream().side_effect = lambda query, deadline=None: time.sleep(0.02) or reply(query)
+
+    @override_settings(DNS_SLOW_QUERY_MS=10)
+    def test_slow_queries_are_logged_with_their_stages(self):
+        resolve_dns(build_query('a.example.', 'A')[1], source='udp')
+        self.log_slow_query.assert_called_once()
+        name, elapsed, spans, details = self.log_slow_query.call_args[0]
+        self.assertEqual(name, 'resolve_dns')
+        self.assertGreaterEqual(elapsed, 0.02)
+        stages = [stage for stage, _ in spans]
+        for stage in ('parse', 'cache', 'manual', 'forward', 'cache_write', 'upstream', 'log'):
+            self.assertIn(stage, stages)
+        self.assertEqual(details, {'domain': 'a.example.', 'type': 'A', 'source': 'udp'})
+
+    @override_settings(DNS_SLOW_QUERY_MS=10)
+    def test_batch_misses_join_the_batch_trace(self):
+        resolve_dns_json_batch([('a.example.', 'A'), ('b.example.', 'A')])
+        self.log_slow_query.assert_called_once()
+        name, _, spans, details = self.log_slow_query.call_args[0]
+        self.assertEqual(name, 'resolve_dns_json_batch')
+        self.assertEqual([stage for stage, _ in spans].count('forward'), 2)
+        self.assertEqual(details, {'questions': 2})
+
+    @override_settings(DNS_SLOW_QUERY_MS=10)
+    def test_fast_queries_are_not_logged(self):
+        query = build_query('a.example.', 'A')[1]
+        resolve_dns(query)
+        self.log_slow_query.reset_mock()
+        resolve_dns(query)
+        self.log_slow_query.assert_not_called()
+
+    @override_settings(DNS_SLOW_QUERY_MS=0)
+    def test_disabled_without_a_threshold(self):
+        resolve_dns(build_query('a.example.', 'A')[1])
+        self.log_slow_query.assert_not_called()
@@ -0,0 +1,90 @@
+"""
+Per-request span tracing for the resolver.
+A query resolved through a @traced function collects the time spent in each
+stage (metrics.timed spans: parse, cache, manual, upstream, forward,
+cache_write, build, log). Queries slower than DNS_SLOW_QUERY_MS are written
+to slow_queries.log with that breakdown.
+"""
+import contextvars
+import functools
+import inspect
+import time
+from django.conf import settings
+from .profiler import ensure_profile_watcher
+
+_current_trace = contextvars.ContextVar('dns_trace', default=None)
+
+
+class Trace:
+    """Spans of one request, as (stage, seconds) in the order they finished"""
+    __slots__ = ('name', 'started', 'spans', 'details')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self.details = {}
+
+
+def add_span(stage, seconds):
+    """Record a finished stage on the current request's trace, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((stage, seconds))
+
+
+def annotate(**details):
+    """Attach details (domain, type, ...) to the current request's trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.details.update(details)
+
+
+def _slow_query_threshold():
+    return getattr(settings, 'DNS_SLOW_QUERY_MS', 0) / 1000.0
+
+
+def _finish(trace, token, threshold):
+    _current_trace.reset(token)
+    elapsed = time.perf_counter() - trace.started
+    if elapsed >= threshold:
+        from .logger import log_slow_query
+        log_slow_query(trace.name, elapsed, trace.spans, trace.details)
+
+
+def traced(func):
+    """
+    Trace each call of a resolver entry point (sync or async) when
+    DNS_SLOW_QUERY_MS is set. Calls made while a trace is already running
+    add to that trace instead.
+    """
+    name = func.__name__
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            ensure_profile_watcher()
+            threshold = _slow_query_threshold()
+            if not threshold or _current_trace.get() is not None:
+                return await func(*args, **kwargs)
+            trace = Trace(name)
+            token = _current_trace.set(trace)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _finish(trace, token, threshold)
+        return wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        ensure_profile_watcher()
+        threshold = _slow_query_threshold()
+        if not threshold or _current_trace.get() is not None:
+            return func(*args, **kwargs)
+        trace = Trace(name)
+        token = _current_trace.set(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _finish(trace, token, threshold)
+    return wrapper
@@ -1,20 +1,97 @@
+import asyncio
 import socket
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .packet import apply_edns
 from .resolver import resolve_dns
 from .logger import log_system_event
 
 DNS_PORT = 8053
 
-def start_udp_server():
+
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Asyncio UDP protocol that resolves many queries concurrently.
+
+    resolve_dns is blocking (Redis, ORM, upstream sockets), so each datagram
+    is handed to a thread pool. The semaphore caps how many queries are in
+    flight; datagrams arriving while the backlog is full are dropped and the
+    client will retry, like any overloaded DNS server.
+
+    Responses larger than the client's EDNS0 buffer (512 bytes without EDNS)
+    are sent truncated with TC set so the client retries over TCP.
+    """
+
+    def __init__(self, executor, max_concurrency, on_query=None):
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.on_query = on_query
+        self.udp_payload = getattr(settings, 'DNS_EDNS_UDP_PAYLOAD', 1232)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.pending = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # Allow a backlog of queued datagrams equal to the concurrency cap
+        if self.pending >= self.max_concurrency * 2:
+            return
+        self.pending += 1
+        asyncio.ensure_future(self.handle_query(data, addr))
+
+    async def handle_query(self, data, addr):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.semaphore:
+                response = await loop.run_in_executor(
+                    self.executor, resolve_dns, data, addr[0], 'udp'
+                )
+            if response and self.transport is not None:
+                self.transport.sendto(apply_edns(data, response, self.udp_payload), addr)
+            if self.on_query is not None:
+                self.on_query()
+        except Exception as e:
+            log_system_event('udp_error', f'Failed to answer {addr[0]}: {e}', level='error')
+        finally:
+            self.pending -= 1
+
+    def error_received(self, exc):
+        log_system_event('udp_error', f'UDP socket error: {exc}', level='warning')
+
+
+async def serve_udp(host="0.0.0.0", port=DNS_PORT, max_concurrency=None,
+                    reuse_port=False, on_query=None):
+    if max_concurrency is None:
+        max_concurrency = getattr(settings, 'DNS_UDP_MAX_CONCURRENCY', 256)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='dns-udp')
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("0.0.0.0", DNS_PORT))
-    print(f"UDP DNS server listening on port {DNS_PORT}")
-    log_system_event('server_start', f'UDP DNS server started on port {DNS_PORT}')
-
-    while True:
-        data, addr = sock.recvfrom(512)
-        client_ip = addr[0]
-        response = resolve_dns(data, client_ip=client_ip, source='udp')
-        sock.sendto(response, addr)
+    if reuse_port:
+        # Lets several worker processes share the port; the kernel balances datagrams
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DNSDatagramProtocol(executor, max_concurrency, on_query),
+        sock=sock,
+    )
+    print(f"UDP DNS server listening on port {port}")
+    log_system_event(
+        'server_start',
+        f'UDP DNS server started on port {port} (max concurrency {max_concurrency})'
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        executor.shutdown(wait=False)
+
+
+def start_udp_server(max_concurrency=None, port=DNS_PORT, reuse_port=False, on_query=None):
+    asyncio.run(serve_udp(port=port, max_concurrency=max_concurrency,
+                          reuse_port=reuse_port, on_query=on_query))
 
 if __name__ == "__main__":
     start_udp_server()
@@ -0,0 +1,668 @@
+"""
+Multiplexed upstream DNS client.
+Keeps a small pool of long-lived UDP sockets per upstream server and sends
+many outstanding queries over them. Replies are matched to queries by
+transaction ID and question; anything else (late, mismatched or spoofed
+replies) is dropped. Truncated UDP replies can be retried over TCP.
+
+Long-lived sockets keep their source port, which leaves an off-path spoofer
+only the 16-bit transaction ID to guess. Two things win that entropy back:
+each socket is replaced by one on a fresh ephemeral port after
+socket_max_queries queries or socket_max_age seconds, and with
+randomize_case the letters of the query name are sent in random case
+(DNS 0x20) and the reply must echo them exactly. Shorter socket lifetimes
+cost more socket churn; 0x20 drops every reply of an upstream that does not
+preserve the question's case, so it can be turned off for such upstreams.
+
+AsyncUpstreamClient does the same on an asyncio event loop for the ASGI
+DoH path.
+"""
+import asyncio
+import errno
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import weakref
+from django.conf import settings
+from .metrics import inc, observe
+from .packet import skip_name
+
+
+def _question_section(data):
+    """Return the question section of a DNS message as sent, or None"""
+    try:
+        if struct.unpack_from("!H", data, 4)[0] != 1:
+            return None
+        end = skip_name(data, 12) + 4
+        if end > len(data):
+            return None
+        return bytes(data[12:end])
+    except (IndexError, struct.error):
+        return None
+
+
+def _question_key(data):
+    """Return the question section (name lowercased) of a DNS message, or None"""
+    question = _question_section(data)
+    return question.lower() if question is not None else None
+
+
+def _reply_matches(data, question, exact):
+    """Whether a reply echoes the question asked (letter case included if exact)"""
+    if exact:
+        return _question_section(data) == question
+    return _question_key(data) == question
+
+
+def _randomize_case(data):
+    """Return the query with the letters of its name in random case (DNS 0x20)"""
+    end = skip_name(data, 12)
+    name = bytearray(data[12:end])
+    # Label length bytes are below 64, so only letters are flipped
+    bits = int.from_bytes(os.urandom(len(name) // 8 + 1), 'big')
+    for i, byte in enumerate(name):
+        if 0x61 <= byte | 0x20 <= 0x7a and bits >> i & 1:
+            name[i] = byte ^ 0x20
+    return data[:12] + bytes(name) + data[end:]
+
+
+def _restore_question(query, response):
+    """The response under the caller's transaction ID and question spelling"""
+    end = 12 + len(_question_section(query))
+    return query[:2] + response[2:12] + query[12:end] + response[end:]
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by upstream")
+        data += chunk
+    return data
+
+
+class _PendingQuery:
+    """A query waiting for its reply; outstanding on several upstreams when racing"""
+    __slots__ = ('question', 'exact', 'event', 'response', 'address', 'claimed')
+
+    def __init__(self, question, exact=False):
+        self.question = question
+        self.exact = exact
+        self.event = threading.Event()
+        self.response = None
+        self.address = None
+        self.claimed = threading.Lock()
+
+    def resolve(self, response, address):
+        # Only the first matching reply wins
+        if self.claimed.acquire(blocking=False):
+            self.response = response
+            self.address = address
+            self.event.set()
+
+
+class UpstreamSocket:
+    """One connected UDP socket with a receiver thread dispatching replies by TXID"""
+
+    def __init__(self, server, port):
+        self.address = (server, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # connect() makes the kernel drop datagrams from any other source address
+        self.sock.connect(self.address)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.queries = 0
+        self.opened_at = time.monotonic()
+        self.retired = False
+        self.closed = False
+        self.pid = os.getpid()
+        self.receiver = threading.Thread(
+            target=self._receive_loop, name=f'dns-upstream-{server}', daemon=True
+        )
+        self.receiver.start()
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except OSError as e:
+                if self.closed or e.errno in (errno.EBADF, errno.ENOTSOCK):
+                    return
+                continue  # e.g. ECONNREFUSED from an ICMP port unreachable
+            if self.closed:
+                return
+            if len(data) < 12:
+                self.dropped += 1
+                continue
+            with self.lock:
+                waiter = self.pending.get(data[:2])
+                if waiter is None or not _reply_matches(data, waiter.question, waiter.exact):
+                    self.dropped += 1
+                    continue
+                del self.pending[data[:2]]
+            waiter.resolve(data, self.address)
+
+    def send(self, data, waiter):
+        """Send a query under a fresh transaction ID; returns the TXID or None"""
+        with self.lock:
+            while True:
+                txid = os.urandom(2)
+                if txid not in self.pending:
+                    break
+            self.pending[txid] = waiter
+            self.queries += 1
+        try:
+            self.sock.send(txid + data[2:])
+            return txid
+        except OSError:
+            self.cancel(txid, waiter)
+            return None
+
+    def cancel(self, txid, waiter):
+        with self.lock:
+            if self.pending.get(txid) is waiter:
+                del self.pending[txid]
+            idle = self.retired and not self.pending
+        if idle:
+            self.close()
+
+    def expired(self, max_queries, max_age):
+        """Whether the socket has sent max_queries queries or is max_age seconds old"""
+        return bool((max_queries and self.queries >= max_queries)
+                    or (max_age and time.monotonic() - self.opened_at >= max_age))
+
+    def retire(self):
+        """Take no new queries; the socket is closed once its outstanding ones are done"""
+        with self.lock:
+            self.retired = True
+            idle = not self.pending
+        if idle:
+            self.close()
+
+    def close(self):
+        """Close the socket and stop the receiver thread"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.pid == os.getpid():
+            # Wakes the receiver blocked in recv(); after a fork the socket is
+            # still the parent's, so the child only closes its descriptor
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+
+
+class UpstreamStats:
+    """Smoothed RTT (EWMA, as in TCP) and counters for one upstream"""
+
+    ALPHA = 0.125
+
+    def __init__(self):
+        self.srtt = None
+        self.queries = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.race_wins = 0
+        self.lock = threading.Lock()
+
+    def record(self, rtt=None, timeout=None, race_win=False):
+        """Record a reply after rtt seconds, or a timeout (counted as an RTT of timeout)"""
+        with self.lock:
+            self.queries += 1
+            if rtt is None:
+                self.timeouts += 1
+                rtt = timeout
+            else:
+                self.responses += 1
+                if race_win:
+                    self.race_wins += 1
+            if self.srtt is None:
+                self.srtt = rtt
+            else:
+                self.srtt += self.ALPHA * (rtt - self.srtt)
+
+    def as_dict(self):
+        return {
+            'srtt_ms': round(self.srtt * 1000, 2) if self.srtt is not None else None,
+            'queries': self.queries,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'race_wins': self.race_wins,
+        }
+
+
+class _UpstreamSelector:
+    """
+    Orders upstream servers by smoothed RTT.
+
+    Upstreams are tried fastest first; servers without a sample yet sort
+    first so they get measured, and a small share of queries (explore_ratio)
+    uses a random order so a recovered server can win back traffic. With
+    race=True each query goes to the two fastest upstreams at once and the
+    first valid answer wins.
+    """
+
+    def __init__(self, servers, timeout=2.0, race=False, explore_ratio=0.05,
+                 socket_max_queries=None, socket_max_age=None, randomize_case=False):
+        self.servers = list(servers)
+        self.timeout = timeout
+        self.race = race
+        self.explore_ratio = explore_ratio
+        self.socket_max_queries = socket_max_queries
+        self.socket_max_age = socket_max_age
+        self.randomize_case = randomize_case
+        self.upstream_stats = {server: UpstreamStats() for server in self.servers}
+        # Dropped replies counted by sockets that have since been rotated out
+        self.retired_dropped = {server: 0 for server in self.servers}
+
+    def ordered_servers(self):
+        """Upstreams sorted by smoothed RTT (unmeasured first)"""
+        servers = list(self.servers)
+        if random.random() < self.explore_ratio:
+            random.shuffle(servers)
+            return servers
+        return sorted(
+            servers,
+            key=lambda server: self.upstream_stats[server].srtt or 0.0
+        )
+
+    def _outgoing(self, data):
+        """The query to send for data and the question its reply must carry"""
+        if self.randomize_case:
+            data = _randomize_case(data)
+            return data, _question_section(data)
+        return data, _question_key(data)
+
+    def attempts(self):
+        """Groups of servers to ask in turn (the first group has two when racing)"""
+        servers = self.ordered_servers()
+        if self.race and len(servers) > 1:
+            return [servers[:2]] + [[server] for server in servers[2:]]
+        return [[server] for server in servers]
+
+    def _timeout(self, deadline):
+        """Seconds to wait for the next upstream: the timeout, cut to the deadline"""
+        if deadline is None:
+            return self.timeout
+        return min(self.timeout, deadline - time.monotonic())
+
+    def _record(self, sent, answered_by, rtt, cut_short=False):
+        if answered_by is None and cut_short:
+            return  # the caller's deadline, not the upstream, ran out
+        for server in sent:
+            if answered_by is not None and server == answered_by:
+                self.upstream_stats[server].record(rtt=rtt, race_win=len(sent) > 1)
+                observe('dns_upstream_duration_seconds', rtt, server=f'{server[0]}:{server[1]}')
+                inc('dns_upstream_queries_total', server=f'{server[0]}:{server[1]}', result='answered')
+            elif answered_by is None:
+                self.upstream_stats[server].record(timeout=self.timeout)
+                inc('dns_upstream_queries_total', server=f'{server[0]}:{server[1]}', result='timeout')
+
+
+class UpstreamClient(_UpstreamSelector):
+    """Pool of UpstreamSockets per upstream server"""
+
+    def __init__(self, servers, sockets_per_server=4, **kwargs):
+        super().__init__(servers, **kwargs)
+        self.pools = {
+            (server, port): [UpstreamSocket(server, port) for _ in range(sockets_per_server)]
+            for server, port in self.servers
+        }
+        self._rotate_lock = threading.Lock()
+
+    def _pick_socket(self, server):
+        pool = self.pools[server]
+        index = random.randrange(len(pool))
+        upstream_socket = pool[index]
+        if upstream_socket.expired(self.socket_max_queries, self.socket_max_age):
+            with self._rotate_lock:
+                if pool[index] is upstream_socket:
+                    pool[index] = UpstreamSocket(*server)
+                    self.retired_dropped[server] += upstream_socket.dropped
+                    upstream_socket.retire()
+                upstream_socket = pool[index]
+        return upstream_socket
+
+    def close(self):
+        for pool in self.pools.values():
+            for upstream_socket in pool:
+                upstream_socket.close()
+
+    def _ask(self, servers, data, timeout):
+        """Send to all given servers at once and return the first matching reply"""
+        outgoing, question = self._outgoing(data)
+        waiter = _PendingQuery(question, exact=self.randomize_case)
+        sent = []
+        started = time.monotonic()
+        for server in servers:
+            upstream_socket = self._pick_socket(server)
+            txid = upstream_socket.send(outgoing, waiter)
+            if txid is not None:
+                sent.append((server, upstream_socket, txid))
+        if not sent:
+            return None
+        answered = waiter.event.wait(timeout)
+        rtt = time.monotonic() - started
+        for server, upstream_socket, txid in sent:
+            upstream_socket.cancel(txid, waiter)
+        self._record([server for server, _, _ in sent], waiter.address if answered else None, rtt,
+                     cut_short=timeout < self.timeout)
+        if not answered:
+            return None
+        return _restore_question(data, waiter.response)
+
+    def query(self, data, deadline=None):
+        """
+        Forward a query, fastest upstream first; return the first matching
+        reply (with the caller's transaction ID) or None. With a deadline
+        (time.monotonic() value) nothing is waited for past it.
+        """
+        if _question_key(data) is None:
+            return None
+        for attempt in self.attempts():
+            timeout = self._timeout(deadline)
+            if timeout <= 0:
+                break
+            response = self._ask(attempt, data, timeout)
+            if response:
+                return response
+        return None
+
+    def query_tcp(self, data, deadline=None):
+        """
+        Forward a query over TCP (used when the UDP reply came back truncated),
+        fastest upstream first; return the first matching reply or None.
+        """
+        question = _question_key(data)
+        if question is None:
+            return None
+        for server in self.ordered_servers():
+            timeout = self._timeout(deadline)
+            if timeout <= 0:
+                break
+            try:
+                with socket.create_connection(server, timeout=timeout) as sock:
+                    sock.sendall(struct.pack("!H", len(data)) + data)
+                    length = struct.unpack("!H", _recv_exactly(sock, 2))[0]
+                    response = _recv_exactly(sock, length)
+            except (OSError, struct.error):
+                continue
+            if len(response) >= 12 and response[:2] == data[:2] and _question_key(response) == question:
+                return response
+        return None
+
+    def stats(self):
+        """Per-upstream smoothed RTT, counters and socket state"""
+        return {
+            f'{server}:{port}': dict(
+                self.upstream_stats[(server, port)].as_dict(),
+                outstanding=sum(len(s.pending) for s in pool),
+                dropped_replies=self.retired_dropped[(server, port)] + sum(s.dropped for s in pool),
+            )
+            for (server, port), pool in self.pools.items()
+        }
+
+
+class _AsyncUpstreamProtocol(asyncio.DatagramProtocol):
+    """One connected UDP endpoint dispatching replies to waiting futures by TXID"""
+
+    def __init__(self, address):
+        self.address = address
+        self.pending = {}
+        self.dropped = 0
+        self.queries = 0
+        self.opened_at = time.monotonic()
+        self.rotating = False
+        self.retired = False
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        waiter = self.pending.get(data[:2]) if len(data) >= 12 else None
+        if waiter is None or not _reply_matches(data, waiter[0], waiter[2]):
+            self.dropped += 1
+            return
+        del self.pending[data[:2]]
+        future = waiter[1]
+        # Only the first matching reply wins
+        if not future.done():
+            future.set_result((data, self.address))
+
+    def error_received(self, exc):
+        pass
+
+    def send(self, data, waiter):
+        """Send a query under a fresh transaction ID; returns the TXID"""
+        while True:
+            txid = os.urandom(2)
+            if txid not in self.pending:
+                break
+        self.pending[txid] = waiter
+        self.queries += 1
+        self.transport.sendto(txid + data[2:])
+        return txid
+
+    def cancel(self, txid, waiter):
+        if self.pending.get(txid) is waiter:
+            del self.pending[txid]
+        if self.retired and not self.pending:
+            self.transport.close()
+
+    expired = UpstreamSocket.expired
+
+    def retire(self):
+        """Take no new queries; the endpoint is closed once its outstanding ones are done"""
+        self.retired = True
+        if not self.pending:
+            self.transport.close()
+
+
+class AsyncUpstreamClient(_UpstreamSelector):
+    """UpstreamClient for an asyncio event loop; endpoints are opened on first use"""
+
+    def __init__(self, servers, sockets_per_server=4, **kwargs):
+        super().__init__(servers, **kwargs)
+        self.sockets_per_server = sockets_per_server
+        self.pools = {}
+        self._opening = {}
+
+    async def _open_endpoint(self, server):
+        _, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _AsyncUpstreamProtocol(server), remote_addr=server
+        )
+        return protocol
+
+    async def _open_pool(self, server):
+        pool = []
+        for _ in range(self.sockets_per_server):
+            pool.append(await self._open_endpoint(server))
+        self.pools[server] = pool
+        return pool
+
+    async def _pick_endpoint(self, server):
+        pool = self.pools.get(server)
+        if pool is None:
+            # Concurrent first queries share one pool being opened
+            opening = self._opening.get(server)
+            if opening is None:
+                opening = self._opening[server] = asyncio.ensure_future(self._open_pool(server))
+            try:
+                pool = await asyncio.shield(opening)
+            finally:
+                if opening.done():
+                    self._opening.pop(server, None)
+        endpoint = random.choice(pool)
+        if (not endpoint.rotating
+                and endpoint.expired(self.socket_max_queries, self.socket_max_age)):
+            # Others keep using the old endpoint while its replacement opens
+            endpoint.rotating = True
+            replacement = await self._open_endpoint(server)
+            if self.pools.get(server) is not pool:
+                replacement.transport.close()  # the client was closed meanwhile
+                return endpoint
+            pool[pool.index(endpoint)] = replacement
+            self.retired_dropped[server] += endpoint.dropped
+            endpoint.retire()
+            endpoint = replacement
+        return endpoint
+
+    def close(self):
+        for pool in self.pools.values():
+            for endpoint in pool:
+                endpoint.transport.close()
+        self.pools = {}
+
+    async def _ask(self, servers, data, timeout):
+        """Send to all given servers at once and return the first matching reply"""
+        outgoing, question = self._outgoing(data)
+        waiter = (question, asyncio.get_running_loop().create_future(), self.randomize_case)
+        sent = []
+        started = time.monotonic()
+        for server in servers:
+            try:
+                endpoint = await self._pick_endpoint(server)
+                sent.append((server, endpoint, endpoint.send(outgoing, waiter)))
+            except OSError:
+                continue
+        if not sent:
+            return None
+        try:
+            response, address = await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            response = address = None
+        finally:
+            for _, endpoint, txid in sent:
+                endpoint.cancel(txid, waiter)
+        self._record([server for server, _, _ in sent], address, time.monotonic() - started)
+        if response is None:
+            return None
+        return _restore_question(data, response)
+
+    async def query(self, data):
+        """
+        Forward a query, fastest upstream first; return the first matching
+        reply (with the caller's transaction ID) or None.
+        """
+        if _question_key(data) is None:
+            return None
+        for attempt in self.attempts():
+            response = await self._ask(attempt, data, self.timeout)
+            if response:
+                return response
+        return None
+
+    async def query_tcp(self, data):
+        """Forward a query over TCP, fastest upstream first; the first matching reply or None"""
+        question = _question_key(data)
+        if question is None:
+            return None
+        for server in self.ordered_servers():
+            try:
+                response = await asyncio.wait_for(self._exchange_tcp(server, data), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, struct.error):
+                continue
+            if len(response) >= 12 and response[:2] == data[:2] and _question_key(response) == question:
+                return response
+        return None
+
+    async def _exchange_tcp(self, server, data):
+        reader, writer = await asyncio.open_connection(*server)
+        try:
+            writer.write(struct.pack("!H", len(data)) + data)
+            await writer.drain()
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    def stats(self):
+        """Per-upstream smoothed RTT, counters and endpoint state"""
+        return {
+            f'{server}:{port}': dict(
+                self.upstream_stats[(server, port)].as_dict(),
+                outstanding=sum(len(p.pending) for p in self.pools.get((server, port), [])),
+                dropped_replies=self.retired_dropped[(server, port)]
+                + sum(p.dropped for p in self.pools.get((server, port), [])),
+            )
+            for server, port in self.servers
+        }
+
+
+_upstream_client = None
+_upstream_client_pid = None
+_upstream_client_lock = threading.Lock()
+
+def get_upstream_client(servers):
+    """Get or create the process-wide upstream client (recreated after fork)"""
+    global _upstream_client, _upstream_client_pid
+    with _upstream_client_lock:
+        if (_upstream_client is None or _upstream_client_pid != os.getpid()
+                or _upstream_client.servers != list(servers)):
+            if _upstream_client is not None:
+                _upstream_client.close()
+            _upstream_client = UpstreamClient(
+                servers,
+                sockets_per_server=getattr(settings, 'DNS_UPSTREAM_SOCKETS_PER_SERVER', 4),
+                timeout=getattr(settings, 'DNS_UPSTREAM_TIMEOUT', 2.0),
+                race=getattr(settings, 'DNS_UPSTREAM_RACE', False),
+                explore_ratio=getattr(settings, 'DNS_UPSTREAM_EXPLORE_RATIO', 0.05),
+                socket_max_queries=getattr(settings, 'DNS_UPSTREAM_SOCKET_MAX_QUERIES', 1000),
+                socket_max_age=getattr(settings, 'DNS_UPSTREAM_SOCKET_MAX_AGE', 60.0),
+                randomize_case=getattr(settings, 'DNS_UPSTREAM_RANDOMIZE_CASE', True),
+            )
+            _upstream_client_pid = os.getpid()
+        return _upstream_client
+
+def get_upstream_stats():
+    """
+    Per-upstream stats of this process's upstream clients (the blocking one
+    and one per event loop): counters are summed and the smoothed RTT is the
+    one of the client that sent the most queries.
+    """
+    clients = list(_async_upstream_clients.values())
+    if _upstream_client is not None and _upstream_client_pid == os.getpid():
+        clients.append(_upstream_client)
+    combined = {}
+    for client in clients:
+        for server, stats in client.stats().items():
+            total = combined.get(server)
+            if total is None:
+                combined[server] = dict(stats)
+                continue
+            if stats['queries'] > total['queries']:
+                total['srtt_ms'] = stats['srtt_ms']
+            for key in ('queries', 'responses', 'timeouts', 'race_wins', 'outstanding',
+                        'dropped_replies'):
+                total[key] += stats[key]
+    return combined
+
+_async_upstream_clients = weakref.WeakKeyDictionary()
+
+def get_async_upstream_client(servers):
+    """Get or create the upstream client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_upstream_clients.get(loop)
+    if client is None or client.servers != list(servers):
+        if client is not None:
+            client.close()
+        client = AsyncUpstreamClient(
+            servers,
+            sockets_per_server=getattr(settings, 'DNS_UPSTREAM_SOCKETS_PER_SERVER', 4),
+            timeout=getattr(settings, 'DNS_UPSTREAM_TIMEOUT', 2.0),
+            race=getattr(settings, 'DNS_UPSTREAM_RACE', False),
+            explore_ratio=getattr(settings, 'DNS_UPSTREAM_EXPLORE_RATIO', 0.05),
+            socket_max_queries=getattr(settings, 'DNS_UPSTREAM_SOCKET_MAX_QUERIES', 1000),
+            socket_max_age=getattr(settings, 'DNS_UPSTREAM_SOCKET_MAX_AGE', 60.0),
+            randomize_case=getattr(settings, 'DNS_UPSTREAM_RANDOMIZE_CASE', True),
+        )
+        _async_upstream_clients[loop] = client
+    return client
@@ -0,0 +1,169 @@
+"""
+Multi-process DNS worker pool.
+Forks N worker processes that each bind the DNS port with SO_REUSEPORT, so the
+kernel spreads UDP/TCP traffic across cores, and supervises them.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from django import db
+
+from .logger import log_system_event, stop_logging
+from .tcp_server import serve_tcp
+from .udp_server import DNS_PORT, serve_udp
+
+
+def _increment(counter):
+    with counter.get_lock():
+        counter.value += 1
+
+
+async def _serve(port, on_query):
+    """UDP and TCP servers of one worker on one event loop; returns only by raising"""
+    # SIGTERM has been blocked since the fork; unblocking it only once the loop
+    # handles it means a stop request cancels the servers instead of
+    # interrupting the loop's own setup
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    await asyncio.gather(
+        serve_udp(port=port, reuse_port=True, on_query=on_query),
+        serve_tcp(port=port, reuse_port=True, on_query=on_query),
+    )
+
+
+def _worker_main(index, counter, port):
+    """
+    Entry point of a forked DNS worker. If the UDP or the TCP server fails the
+    worker exits, so the supervisor restarts it with both.
+    """
+    # The supervisor handles Ctrl+C and stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Connections inherited from the parent must not be shared across processes
+    db.connections.close_all()
+    on_query = lambda: _increment(counter)
+    log_system_event('worker_start', f'DNS worker {index} started (pid {os.getpid()})')
+    exit_code = 0
+    try:
+        asyncio.run(_serve(port, on_query))
+    except asyncio.CancelledError:
+        log_system_event('worker_stop', f'DNS worker {index} stopped (pid {os.getpid()})')
+    except Exception as e:
+        log_system_event('worker_crash', f'DNS worker {index} (pid {os.getpid()}) failed: {e!r}',
+                         level='error')
+        exit_code = 1
+    finally:
+        # The loop's handler is gone; a second SIGTERM must not cut the log flush short
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        # Forked processes skip atexit, so write out queued log records here
+        stop_logging()
+    sys.exit(exit_code)
+
+
+class DNSWorkerPool:
+    """Starts, restarts and reports on a fixed number of DNS worker processes"""
+
+    def __init__(self, num_workers, port=DNS_PORT, check_interval=1.0, report_interval=60.0):
+        self.num_workers = num_workers
+        self.port = port
+        self.check_interval = check_interval
+        self.report_interval = report_interval
+        self.ctx = multiprocessing.get_context('fork')
+        self.counters = [self.ctx.Value('Q', 0) for _ in range(num_workers)]
+        self.restarts = [0] * num_workers
+        self.processes = [None] * num_workers
+        self._stopping = threading.Event()
+
+    def _spawn(self, index):
+        process = self.ctx.Process(
+            target=_worker_main,
+            args=(index, self.counters[index], self.port),
+            name=f'dns-worker-{index}',
+            daemon=True,
+        )
+        # A SIGTERM sent before the worker has its own handler waits until it does
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        self.processes[index] = process
+        return process
+
+    def start(self):
+        db.connections.close_all()
+        for index in range(self.num_workers):
+            self._spawn(index)
+        log_system_event(
+            'server_start',
+            f'Started {self.num_workers} DNS worker processes on port {self.port}'
+        )
+
+    def check_workers(self):
+        """Restart any worker that has exited"""
+        for index, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                continue
+            log_system_event(
+                'worker_crash',
+                f'DNS worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting',
+                level='warning'
+            )
+            self.restarts[index] += 1
+            self._spawn(index)
+
+    def stats(self):
+        """Return per-worker pid, query count and restart count"""
+        return [
+            {
+                'worker': index,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'queries': self.counters[index].value,
+                'restarts': self.restarts[index],
+            }
+            for index, process in enumerate(self.processes)
+        ]
+
+    def report(self):
+        summary = ', '.join(
+            f"worker {s['worker']} (pid {s['pid']}): {s['queries']} queries, {s['restarts']} restarts"
+            for s in self.stats()
+        )
+        log_system_event('worker_stats', summary)
+        return summary
+
+    def stop_on_signals(self):
+        """Make SIGTERM and SIGINT end supervise(); call from the main thread"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._stopping.set())
+
+    def supervise(self, on_report=None):
+        """Block, restarting crashed workers and reporting stats periodically"""
+        last_report = time.monotonic()
+        while not self._stopping.wait(self.check_interval):
+            self.check_workers()
+            if time.monotonic() - last_report >= self.report_interval:
+                summary = self.report()
+                if on_report is not None:
+                    on_report(summary)
+                last_report = time.monotonic()
+
+    def stop(self, timeout=5):
+        """Send SIGTERM to every worker and wait for them, killing any still running after timeout"""
+        self._stopping.set()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout=max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
@@ -0,0 +1,50 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .views import doh_query, doh_query_async, doh_batch, doh_batch_async
+
+# The DoH endpoints are routed both under /api/v1/ and at the site root
+DOH_PATHS = frozenset({'/api/v1/dns-query', '/dns-query'})
+DOH_BATCH_PATHS = frozenset({'/api/v1/dns-query/batch', '/dns-query/batch'})
+
+
+class DoHFastPathMiddleware:
+    """
+    Answer DoH requests before the rest of the middleware stack and URL
+    resolution run. Sessions, CSRF, auth and messages do nothing for an
+    anonymous DNS query but cost more than a cached lookup.
+    Place it right after SecurityMiddleware.
+
+    The Host header is still checked against ALLOWED_HOSTS, as CommonMiddleware
+    would: request.get_host() raises DisallowedHost, which Django answers with
+    a 400 and logs to django.security.
+
+    Under ASGI the middleware chain runs async and queries are answered by
+    the async resolver on the event loop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if request.path_info in DOH_PATHS:
+            request.get_host()
+            return doh_query(request)
+        if request.path_info in DOH_BATCH_PATHS:
+            request.get_host()
+            return doh_batch(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.path_info in DOH_PATHS:
+            request.get_host()
+            return await doh_query_async(request)
+        if request.path_info in DOH_BATCH_PATHS:
+            request.get_host()
+            return await doh_batch_async(request)
+        return await self.get_response(request)
@@ -1,3 +1,226 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import re
+import threading
+from unittest import mock
+from django.test import AsyncClient, Client, override_settings
+from dns_core.async_resolver import resolve_dns_json_batch_async
+from dns_core.packet import build_query, parse_dns_response
+from dns_core.tests import RedisTestCase, upstream_reply
 
-# Create your tests here.
+
+def body(response):
+    return json.loads(response.content)
+
+
+def max_age(response):
+    return int(re.search(r'max-age=(\d+)', response['Cache-Control']).group(1))
+
+
+class DoHCachingTests(RedisTestCase):
+    """Cache-Control, ETag and conditional GET on DoH answers"""
+
+    def setUp(self):
+        super().setUp()
+        self.upstream = self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+    def get_json(self, name='cached.example.', **headers):
+        return self.client.get('/dns-query', {'name': name, 'type': 'A'}, secure=True,
+                               HTTP_ACCEPT='application/dns-json', **headers)
+
+    def test_max_age_counts_down_from_cache_time(self):
+        response = self.get_json()
+        self.assertEqual(max_age(response), 300)
+        self.age_cache(290)
+        response = self.get_json()
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertLessEqual(max_age(response), 10)
+        self.assertLessEqual(body(response)["Answer"][0]["ttl"], 10)
+
+    def test_wire_format_max_age_counts_down_from_cache_time(self):
+        _, query = build_query('cached.example.', 'A')
+        dns = base64.urlsafe_b64encode(query).rstrip(b'=').decode()
+        response = self.client.get('/dns-query', {'dns': dns}, secure=True)
+        self.assertEqual(max_age(response), 300)
+        self.age_cache(290)
+        response = self.client.get('/dns-query', {'dns': dns}, secure=True)
+        self.assertLessEqual(max_age(response), 10)
+        self.assertLessEqual(parse_dns_response(response.content)["Answer"][0]["ttl"], 10)
+
+    def test_etag_is_the_same_for_upstream_and_cached_answers(self):
+        first = self.get_json()
+        cached = self.get_json()
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(first['ETag'], cached['ETag'])
+        response = self.get_json(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+    def test_etag_changes_with_the_records(self):
+        first = self.get_json()
+        self.patch_upstream([{"type": "A", "value": "10.0.0.2", "ttl": 300}])
+        other = self.get_json('other.example.')
+        self.assertNotEqual(first['ETag'], other['ETag'])
+        self.assertEqual(self.get_json('other.example.', HTTP_IF_NONE_MATCH=first['ETag']).status_code,
+                         200)
+
+    def test_nxdomain_max_age_is_the_negative_ttl(self):
+        self.patch_upstream(rcode=3, authority=[{
+            "name": "example.", "type": "SOA", "ttl": 300,
+            "value": "ns.example. admin.example. 1 3600 600 86400 120",
+        }])
+        response = self.get_json('missing.example.')
+        self.assertEqual(body(response)["Status"], 3)
+        self.assertEqual(max_age(response), 120)
+
+    def test_servfail_is_not_cached(self):
+        self.patch_upstream(rcode=2)
+        response = self.get_json('broken.example.')
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', response)
+
+    def test_soa_is_not_a_query_type(self):
+        response = self.client.get('/dns-query', {'name': 'example.', 'type': 'SOA'}, secure=True,
+                                   HTTP_ACCEPT='application/dns-json')
+        self.assertEqual(response.status_code, 400)
+
+
+class DoHBatchTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.upstream = self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+    def post(self, payload):
+        return self.client.post('/dns-query/batch', json.dumps(payload),
+                                content_type='application/json', secure=True)
+
+    def test_results_follow_question_order(self):
+        response = self.post([["b.example.", "A"], {"name": "a.example"}, ["b.example."]])
+        self.assertEqual(response.status_code, 200)
+        results = body(response)
+        self.assertEqual([result["Question"][0]["name"] for result in results],
+                         ["b.example.", "a.example.", "b.example."])
+        self.assertEqual(self.upstream.call_count, 2)
+
+    def test_invalid_batches_are_rejected(self):
+        self.assertEqual(self.post({"queries": []}).status_code, 400)
+        self.assertEqual(self.post([["a.example.", "SOA"]]).status_code, 400)
+        response = self.post([["a.example."], {"type": "A"}])
+        self.assertEqual(body(response), {"error": "invalid query at index 1"})
+        with self.settings(DNS_BATCH_MAX_QUERIES=2):
+            response = self.post([["a.example."]] * 3)
+        self.assertEqual(body(response), {"error": "too many queries"})
+        self.assertEqual(self.client.get('/dns-query/batch', secure=True).status_code, 405)
+
+    @override_settings(DNS_BATCH_TIMEOUT=0.2)
+    def test_slow_questions_are_servfail_at_the_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+        def forward(query, deadline=None):
+            if b"\x04slow" in query:
+                release.wait(5)
+            return reply(query)
+
+        self.upstream.side_effect = forward
+        results = body(self.post([["fast.example."], ["slow.example."]]))
+        self.assertEqual([result["Status"] for result in results], [0, 2])
+        self.assertEqual(results[1]["Question"], [{"name": "slow.example.", "type": "A"}])
+
+    @override_settings(DNS_BATCH_TIMEOUT=0.2)
+    def test_async_batch_deadline(self):
+        reply = upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+        async def resolve_upstream(data, domain, *args):
+            if domain == "slow.example.":
+                await asyncio.sleep(1)
+            return reply(data)
+
+        with mock.patch('dns_core.async_resolver.resolve_upstream_async', resolve_upstream):
+            results = asyncio.run(resolve_dns_json_batch_async(
+                [("fast.example.", "A"), ("slow.example.", "A")]
+            ))
+        self.assertEqual([result["Status"] for result in results], [0, 2])
+
+
+class DoHFastPathTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch_upstream([{"type": "A", "value": "10.0.0.1", "ttl": 300}])
+
+    def test_doh_skips_the_middleware_stack(self):
+        with mock.patch('django.contrib.sessions.middleware.SessionMiddleware.process_request',
+                        side_effect=AssertionError), \
+                mock.patch('django.contrib.auth.middleware.AuthenticationMiddleware.process_request',
+                           side_effect=AssertionError):
+            for path in ('/dns-query', '/api/v1/dns-query'):
+                response = self.client.get(path, {'name': 'a.example.'}, secure=True)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('Vary', response)
+                self.assertEqual(response.cookies, {})
+
+    def test_wire_format_post_needs_no_csrf_token(self):
+        _, query = build_query('a.example.', 'A')
+        response = Client(enforce_csrf_checks=True).post(
+            '/dns-query', query, content_type='application/dns-message', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/dns-message')
+        self.assertEqual(parse_dns_response(response.content)["Answer"][0]["data"], '10.0.0.1')
+
+    def test_hosts_outside_allowed_hosts_are_rejected(self):
+        for path, method in (('/dns-query', self.client.get), ('/dns-query/batch', self.client.post)):
+            with self.assertLogs('django.security.DisallowedHost', 'ERROR'):
+                response = method(path, {'name': 'a.example.'}, secure=True, HTTP_HOST='evil.example')
+            self.assertEqual(response.status_code, 400)
+
+    def test_options_and_head(self):
+        response = self.client.options('/dns-query', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Allow'], 'GET, HEAD, POST, OPTIONS')
+        response = self.client.options('/dns-query/batch', secure=True)
+        self.assertEqual(response['Allow'], 'POST, OPTIONS')
+        response = self.client.head('/dns-query', {'name': 'a.example.'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/dns-json')
+        self.assertEqual(self.client.put('/dns-query', secure=True).status_code, 405)
+
+    def test_other_paths_still_use_the_stack(self):
+        response = self.client.get('/records/', secure=True)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login/', response['Location'])
+
+
+class AsyncDoHTests(RedisTestCase):
+    def test_asgi_requests_use_the_async_resolver(self):
+        self.patch_upstream().side_effect = AssertionError
+        patcher = mock.patch('dns_core.async_resolver.forward_to_upstream_async',
+                             new_callable=mock.AsyncMock,
+                             side_effect=upstream_reply([{"type": "A", "value": "10.0.0.1", "ttl": 300}]))
+        upstream = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        async def run():
+            client = AsyncClient()
+            _, query = build_query('a.example.', 'A')
+            dns = base64.urlsafe_b64encode(query).rstrip(b'=').decode()
+            return (await client.get('/dns-query', {'name': 'a.example.'}, secure=True),
+                    await client.get('/dns-query', {'dns': dns}, secure=True))
+
+        with mock.patch('records.views.resolve_dns_json', side_effect=AssertionError), \
+                mock.patch('records.views.resolve_dns', side_effect=AssertionError):
+            json_response, wire_response = asyncio.run(run())
+        self.assertEqual(body(json_response)["Answer"][0]["data"], '10.0.0.1')
+        self.assertEqual(parse_dns_response(wire_response.content)["Answer"][0]["data"], '10.0.0.1')
+        self.assertEqual(upstream.await_count, 1)
+        self.assertEqual(max_age(json_response), 300)
+
+    def test_asgi_requests_check_the_host(self):
+        async def run():
+            return await AsyncClient().get('/dns-query', {'name': 'a.example.'}, secure=True,
+                                           headers={'Host': 'evil.example'})
+
+        with self.assertLogs('django.security.DisallowedHost', 'ERROR'):
+            response = asyncio.run(run())
+        self.assertEqual(response.status_code, 400)
@@ -4,9 +4,12 @@ from . import views
 urlpatterns = [
     # API endpoints
     path('dns-query', views.doh_query),
+    path('dns-query/batch', views.doh_batch),
+    path('metrics', views.metrics_view),
     path('admin/record', views.add_record),
     path('admin/records', views.list_records),
     path('admin/record/<str:domain>', views.delete_record),
+    path('admin/profile', views.profile),
     
     # Web UI endpoints
     path('', views.dashboard, name='dashboard'),
@@ -1,96 +1,326 @@
 import base64
 import binascii
+import hashlib
 import json
+import struct
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.conf import settings
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import (
+    HttpResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotAllowed, HttpResponseNotModified
+)
 from django.urls import reverse
 from django.db.models import Q, Count
-from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from django.utils.http import parse_etags
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from dns_core.resolver import resolve_dns, resolve_dns_json
-from dns_core.packet import TYPE_CODE, TYPE_MAP
+from dns_core.resolver import resolve_dns, resolve_dns_json, resolve_dns_json_batch, _negative_ttl
+from dns_core.async_resolver import (
+    resolve_dns_async, resolve_dns_json_async, resolve_dns_json_batch_async
+)
+from dns_core.packet import TYPE_CODE, TYPE_MAP, Message, find_ttl_offsets
+from dns_core.metrics import render_metrics
+from dns_core.profiler import request_profile, list_profiles, MAX_PROFILE_SECONDS
 
 from .models import DNSRecord
 from .serializers import DNSRecordSerializer
-from .renderers import DNSJsonRenderer, DNSMessageRenderer
 from .forms import DNSRecordForm, DNSQueryForm, LoginForm, UserCreateForm
 from dns_core.logger import (
     log_api_request, log_admin_action, log_web_action, get_client_ip
 )
 import time
 
-@api_view(['GET', 'POST'])
-@renderer_classes([DNSJsonRenderer, DNSMessageRenderer])
-def doh_query(request):
+DNS_MESSAGE_TYPE = 'application/dns-message'
+DNS_JSON_TYPE = 'application/dns-json'
+DOH_METHODS = ['GET', 'HEAD', 'POST', 'OPTIONS']
+DOH_BATCH_METHODS = ['POST', 'OPTIONS']
+
+
+def _dns_json_response(data, status=200):
+    # Same encoding as DRF's JSONRenderer (compact, UTF-8)
+    body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return HttpResponse(body, content_type=DNS_JSON_TYPE, status=status)
+
+
+def _accepts_dns_message(accept):
+    return (not accept or DNS_MESSAGE_TYPE in accept
+            or 'application/*' in accept or '*/*' in accept)
+
+
+def _parse_doh_request(request):
+    """
+    Work out what a DoH request asks for: ('json', qname, qtype) for DNS-JSON,
+    ('message', data) for a wire-format query, or an error HttpResponse.
+    """
     accept = request.headers.get("Accept", "")
-    
-    if request.method == 'GET':
+
+    if request.method in ('GET', 'HEAD'):
         # Check for DNS-JSON format first
-        if "application/dns-json" in accept or request.GET.get("name"):
-            qname = request.GET.get("name")
-            qtype = request.GET.get("type", "A").upper()
-            if not qname:
-                return HttpResponse(
-                    json.dumps({"error": "missing name parameter for dns-json"}),
-                    content_type='application/dns-json',
-                    status=400
-                )
-            if qtype not in TYPE_CODE:
-                return HttpResponse(
-                    json.dumps({"error": "unsupported type"}),
-                    content_type='application/dns-json',
-                    status=400
-                )
-            # Return DNS-JSON response using DRF Response with renderer
-            response_data = resolve_dns_json(qname, qtype)
-            return Response(response_data)
-        
+        if DNS_JSON_TYPE in accept or request.GET.get("name"):
+            return _parse_json_query(request.GET.get("name"), request.GET.get("type", "A"),
+                                     "missing name parameter for dns-json")
+
         # Otherwise, expect binary DNS message
         dns_b64 = request.GET.get('dns')
         if not dns_b64:
-            return Response({"error": "missing dns parameter"}, status=400)
+            return _dns_json_response({"error": "missing dns parameter"}, status=400)
         try:
             data = base64.urlsafe_b64decode(dns_b64 + "==")
         except (binascii.Error, ValueError):
-            return Response({"error": "invalid dns parameter"}, status=400)
-        response = resolve_dns(data)
-        # Return binary DNS message using Response with DNSMessageRenderer
-        # The renderer will set the content type based on Accept header
-        return Response(response)
-    
-    else:  # POST
+            return _dns_json_response({"error": "invalid dns parameter"}, status=400)
+    elif request.method == 'POST':
         # Check for DNS-JSON format
-        if request.content_type == "application/dns-json":
-            payload = request.data or {}
-            qname = payload.get("name")
-            qtype = payload.get("type", "A").upper()
-            if not qname:
-                return HttpResponse(
-                    json.dumps({"error": "missing name"}),
-                    content_type='application/dns-json',
-                    status=400
-                )
-            if qtype not in TYPE_CODE:
-                return HttpResponse(
-                    json.dumps({"error": "unsupported type"}),
-                    content_type='application/dns-json',
-                    status=400
-                )
-            # Return DNS-JSON response using DRF Response with renderer
-            response_data = resolve_dns_json(qname, qtype)
-            return Response(response_data)
-        
+        if request.content_type == DNS_JSON_TYPE:
+            try:
+                payload = json.loads(request.body or b"{}")
+            except ValueError:
+                return _dns_json_response({"error": "invalid JSON body"}, status=400)
+            if not isinstance(payload, dict):
+                payload = {}
+            return _parse_json_query(payload.get("name"), payload.get("type", "A"), "missing name")
+
         # Otherwise, expect binary DNS message
         data = request.body
-        response = resolve_dns(data)
-        # Return binary DNS message using Response with DNSMessageRenderer
-        # The renderer will set the content type based on Accept header
-        return Response(response)
+    elif request.method == 'OPTIONS':
+        return _options_response(DOH_METHODS)
+    else:
+        return HttpResponseNotAllowed(DOH_METHODS)
+
+    if not _accepts_dns_message(accept):
+        return _dns_json_response(
+            {"detail": "Could not satisfy the request Accept header."}, status=406
+        )
+    return ('message', data)
+
+
+def _options_response(methods):
+    """Empty 200 listing the allowed methods, like Django's View.options()"""
+    response = HttpResponse(headers={'Allow': ', '.join(methods)})
+    response['Content-Length'] = '0'
+    return response
+
+
+def _parse_json_query(qname, qtype, missing_name_error):
+    if not qname:
+        return _dns_json_response({"error": missing_name_error}, status=400)
+    qtype = str(qtype).upper()
+    if qtype not in TYPE_CODE:
+        return _dns_json_response({"error": "unsupported type"}, status=400)
+    return ('json', qname, qtype)
+
+
+def _parse_batch_request(request):
+    """
+    Questions of a batch DNS-JSON request as a list of (name, type), or an
+    error HttpResponse. The POST body is a JSON list (or {"queries": [...]})
+    of {"name": ..., "type": ...} objects or [name, type] pairs.
+    """
+    if request.method == 'OPTIONS':
+        return _options_response(DOH_BATCH_METHODS)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(DOH_BATCH_METHODS)
+    try:
+        payload = json.loads(request.body or b"[]")
+    except ValueError:
+        return _dns_json_response({"error": "invalid JSON body"}, status=400)
+    if isinstance(payload, dict):
+        payload = payload.get("queries")
+    if not isinstance(payload, list) or not payload:
+        return _dns_json_response({"error": "expected a list of queries"}, status=400)
+    if len(payload) > getattr(settings, 'DNS_BATCH_MAX_QUERIES', 1000):
+        return _dns_json_response({"error": "too many queries"}, status=400)
+
+    questions = []
+    for index, item in enumerate(payload):
+        if isinstance(item, dict):
+            qname, qtype = item.get("name"), item.get("type", "A")
+        elif isinstance(item, list) and len(item) in (1, 2):
+            qname, qtype = item[0], item[1] if len(item) == 2 else "A"
+        else:
+            qname = qtype = None
+        qtype = str(qtype).upper()
+        if not qname or not isinstance(qname, str) or qtype not in TYPE_CODE:
+            return _dns_json_response({"error": f"invalid query at index {index}"}, status=400)
+        questions.append((qname, qtype))
+    return questions
+
+
+def _invalid_dns_message():
+    return _dns_json_response({"error": "invalid dns message"}, status=400)
+
+
+def _etag(payload):
+    return 'W/"%s"' % hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+def _message_cache_info(response):
+    """
+    Smallest TTL and ETag of a wire-format answer. The ETag ignores the
+    message ID and TTLs, so it only changes when the records do.
+    """
+    if response[3] & 0x0F not in (0, 3):
+        return None, None
+    ttl_offsets = find_ttl_offsets(response)
+    if struct.unpack_from("!H", response, 6)[0]:
+        min_ttl = min(struct.unpack_from("!I", response, offset)[0] for offset in ttl_offsets)
+    else:
+        # NXDOMAIN/NODATA: the negative caching TTL of the authority SOA
+        min_ttl = _negative_ttl(Message.parse(response))[0] or None
+    if min_ttl is None:
+        return None, None
+    normalized = bytearray(response)
+    normalized[0:2] = b"\x00\x00"
+    for offset in ttl_offsets:
+        normalized[offset:offset + 4] = b"\x00\x00\x00\x00"
+    return min_ttl, _etag(bytes(normalized))
+
+
+def _json_cache_info(result):
+    """Smallest TTL and ETag of a DNS-JSON answer, like _message_cache_info"""
+    if result.get("Status") not in (0, 3):
+        return None, None
+    if result.get("Answer"):
+        min_ttl = min(record["ttl"] for record in result["Answer"])
+    else:
+        min_ttl = _json_negative_ttl(result.get("Authority", []))
+    if min_ttl is None:
+        return None, None
+    return min_ttl, _etag(_json_etag_payload(result))
+
+
+def _json_etag_payload(result):
+    """
+    The parts of a DNS-JSON answer its ETag covers: question, rcode and the
+    answer records without TTLs. Results built from the cache and straight
+    from an upstream reply differ in shape, so only these are compared.
+    """
+    def name(value):
+        value = str(value).lower()
+        return value if value.endswith(".") else value + "."
+
+    def rtype(value):
+        return TYPE_MAP.get(value, str(value)) if isinstance(value, int) else str(value).upper()
+
+    questions = [(name(question.get("name", "")), rtype(question.get("type", "")))
+                 for question in result.get("Question", [])]
+    answers = sorted((name(record["name"]), rtype(record["type"]), str(record["data"]))
+                     for record in result.get("Answer", []))
+    return json.dumps([result.get("Status"), questions, answers],
+                      separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _json_negative_ttl(authority):
+    for record in authority:
+        if record["type"] == "SOA" and record["data"]:
+            return min(record["ttl"], int(record["data"].split()[6]),
+                       getattr(settings, 'DNS_NEGATIVE_CACHE_MAX_TTL', 3600))
+    return None
+
+
+def _cacheable(request, response, min_ttl, etag):
+    """
+    Add HTTP caching headers to a DoH answer (RFC 8484 section 5.1):
+    max-age is the smallest TTL in the answer, which is already counted down
+    from when the records were cached. A GET whose If-None-Match still matches
+    gets a 304, so the client or CDN keeps its copy for another max-age.
+    Answers without records (errors, NXDOMAIN without SOA) are not cached.
+    """
+    if min_ttl is None:
+        response['Cache-Control'] = 'no-store'
+        return response
+    response['Cache-Control'] = 'max-age=%d' % min_ttl
+    response['ETag'] = etag
+    if request.method == 'GET':
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            opaque = etag[2:]
+            if '*' in etags or any(tag.removeprefix('W/') == opaque for tag in etags):
+                not_modified = HttpResponseNotModified()
+                not_modified['Cache-Control'] = response['Cache-Control']
+                not_modified['ETag'] = etag
+                return not_modified
+    return response
+
+
+@csrf_exempt
+def doh_query(request):
+    """
+    DNS over HTTPS (RFC 8484) and DNS-JSON endpoint.
+
+    A plain Django view, normally called straight from DoHFastPathMiddleware:
+    DoH is anonymous, so DRF, sessions, CSRF and auth are skipped entirely.
+    """
+    query = _parse_doh_request(request)
+    if isinstance(query, HttpResponse):
+        return query
+    client_ip = get_client_ip(request)
+    if query[0] == 'json':
+        result = resolve_dns_json(query[1], query[2], client_ip=client_ip)
+        return _cacheable(request, _dns_json_response(result), *_json_cache_info(result))
+    try:
+        response = resolve_dns(query[1], client_ip=client_ip)
+    except (IndexError, ValueError, struct.error):
+        return _invalid_dns_message()
+    return _cacheable(request, HttpResponse(response, content_type=DNS_MESSAGE_TYPE),
+                      *_message_cache_info(response))
+
+
+@csrf_exempt
+async def doh_query_async(request):
+    """doh_query for ASGI: resolves on the event loop with the async resolver"""
+    query = _parse_doh_request(request)
+    if isinstance(query, HttpResponse):
+        return query
+    client_ip = get_client_ip(request)
+    if query[0] == 'json':
+        result = await resolve_dns_json_async(query[1], query[2], client_ip=client_ip)
+        return _cacheable(request, _dns_json_response(result), *_json_cache_info(result))
+    try:
+        response = await resolve_dns_async(query[1], client_ip=client_ip)
+    except (IndexError, ValueError, struct.error):
+        return _invalid_dns_message()
+    return _cacheable(request, HttpResponse(response, content_type=DNS_MESSAGE_TYPE),
+                      *_message_cache_info(response))
+
+@csrf_exempt
+def doh_batch(request):
+    """
+    Batch DNS-JSON endpoint: resolves a list of questions in one request and
+    returns a list of results in the DNS-JSON shape, in the same order.
+    """
+    questions = _parse_batch_request(request)
+    if isinstance(questions, HttpResponse):
+        return questions
+    return _dns_json_response(resolve_dns_json_batch(questions, client_ip=get_client_ip(request)))
+
+
+@csrf_exempt
+async def doh_batch_async(request):
+    """doh_batch for ASGI"""
+    questions = _parse_batch_request(request)
+    if isinstance(questions, HttpResponse):
+        return questions
+    return _dns_json_response(
+        await resolve_dns_json_batch_async(questions, client_ip=get_client_ip(request))
+    )
+
+def metrics_view(request):
+    """Resolver, cache and upstream metrics of all DNS processes, in the Prometheus text format"""
+    if not getattr(settings, 'DNS_METRICS_ENABLED', True):
+        return HttpResponse(status=404)
+    try:
+        body = render_metrics()
+    except Exception as e:
+        return HttpResponse(f"# metrics unavailable: {e}\n", status=503,
+                            content_type='text/plain; charset=utf-8')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 @api_view(['POST'])
 @permission_classes([IsAdminUser])
@@ -132,6 +362,36 @@ def delete_record(request, domain):
     log_admin_action('DELETE_RECORD', request.user, 'DNSRecord', None, f"domain={domain}")
     return Response({"status": "deleted"})
 
+@api_view(['GET', 'POST'])
+@permission_classes([IsAdminUser])
+def profile(request):
+    """
+    POST {"seconds": N} profiles every DNS process for N seconds, results go
+    to logs/profiles/. GET lists the profiles written so far.
+    """
+    start_time = time.time()
+    client_ip = get_client_ip(request)
+    if request.method == 'GET':
+        response_time = int((time.time() - start_time) * 1000)
+        log_api_request('GET', '/api/v1/admin/profile', request.user, 200, response_time, client_ip)
+        return Response({"profiles": list_profiles()})
+    try:
+        seconds = float(request.data.get('seconds', 10))
+        interval = request.data.get('interval')
+        interval = float(interval) if interval is not None else None
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or (interval is not None and interval <= 0):
+            raise ValueError
+    except (TypeError, ValueError):
+        response_time = int((time.time() - start_time) * 1000)
+        log_api_request('POST', '/api/v1/admin/profile', request.user, 400, response_time, client_ip)
+        return Response({"error": f"seconds must be between 0 and {MAX_PROFILE_SECONDS}"}, status=400)
+    profile_request = request_profile(seconds, interval)
+    response_time = int((time.time() - start_time) * 1000)
+    log_api_request('POST', '/api/v1/admin/profile', request.user, 200, response_time, client_ip)
+    log_admin_action('PROFILE', request.user, 'Profiler', None,
+                     f"id={profile_request['id']}, seconds={profile_request['seconds']}")
+    return Response({"status": "ok", "request": profile_request})
+
 # ==================== Web UI Views ====================
 
 def is_admin(user):